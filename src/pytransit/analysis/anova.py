@@ -1,4 +1,5 @@
 import scipy
+import scipy.special
 import numpy
 import math
 import statsmodels.stats.multitest
@@ -79,19 +80,15 @@ class AnovaMethod(base.MultiConditionMethod):
         """
         return [conditionsByFile.get(f, self.unknown_cond_flag) for f in filenamesInCombWig]
 
-    def means_by_condition_for_gene(self, sites, conditions, data):
+    def wigs_by_condition(self, conditions):
         """
-            Returns a dictionary of {Condition: Mean} for each condition.
-            ([Site], [Condition]) -> {Condition: Number}
-            Site :: Number
-            Condition :: String
+            Returns the indexes of the wigs of each condition, in order of first appearance.
+            [Condition] -> {Condition: [Integer]}
         """
-        nTASites = len(sites)
-        wigsByConditions = collections.defaultdict(lambda: [])
+        wigsByConditions = collections.OrderedDict()
         for i, c in enumerate(conditions):
-            wigsByConditions[c].append(i)
-
-        return { c: numpy.mean(data[wigIndex][:, sites]) if nTASites > 0 else 0 for (c, wigIndex) in wigsByConditions.items() }
+            wigsByConditions.setdefault(c, []).append(i)
+        return wigsByConditions
 
     def means_by_rv(self, data, RvSiteindexesMap, genes, conditions):
         """
@@ -102,27 +99,54 @@ class AnovaMethod(base.MultiConditionMethod):
             Gene :: {start, end, rv, gene, strand}
             Condition :: String
         """
+        (siteindexes, nsites) = self.gene_segments(genes, RvSiteindexesMap)
+        X = data[:, siteindexes]
+        means = {}
+        for (c, wigIndex) in self.wigs_by_condition(conditions).items():
+            sums = self.reduce_by_gene(numpy.add, numpy.sum(X[wigIndex], 0), nsites)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                means[c] = numpy.where(nsites > 0, sums / (len(wigIndex)*nsites), 0)
+
         MeansByRv = {}
-        for gene in genes:
-            Rv = gene["rv"]
-            MeansByRv[Rv] = self.means_by_condition_for_gene(RvSiteindexesMap[Rv], conditions, data)
+        for i, gene in enumerate(genes):
+            MeansByRv[gene["rv"]] = {c: means[c][i] for c in means}
         return MeansByRv
 
-    def group_by_condition(self, wigList, conditions):
+    def f_oneway_by_gene(self, data, nsites, conditions):
         """
-            Returns array of datasets, where each dataset corresponds to one condition.
-            ([[Wigdata]], [Condition]) -> [[DataForCondition]]
-            Wigdata :: [Number]
-            Condition :: String
-            DataForCondition :: [Number]
+            One-way ANOVA of the counts of each gene grouped by condition, for all the
+            genes at once. The sums of squares are computed as in scipy.stats.f_oneway,
+            from the counts centered on the mean of each gene, with segment
+            reductions over the contiguous sites of each gene.
+            ([[Wigdata]], [Number], [Condition]) -> Tuple([Number], [Number])
+            Wigdata :: [Number] (the counts of the sites of each gene, one gene after another)
         """
-        countsByCondition = collections.defaultdict(lambda: [])
-        countSum = 0
-        for i, c in enumerate(conditions):
-          countSum += numpy.sum(wigList[i])
-          countsByCondition[c].append(wigList[i])
-
-        return (countSum, [numpy.array(v).flatten() for v in countsByCondition.values()])
+        wigsByConditions = self.wigs_by_condition(conditions)
+        (K, G) = (len(conditions), len(nsites))
+        bign = K * nsites
+        gene_of_site = numpy.repeat(numpy.arange(G), nsites)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            offset = self.reduce_by_gene(numpy.add, numpy.sum(data, 0), nsites) / bign
+            alldata = data - offset[gene_of_site]
+            normalized_ss = self.reduce_by_gene(numpy.add, numpy.sum(alldata, 0), nsites)**2 / bign
+            sstot = self.reduce_by_gene(numpy.add, numpy.sum(alldata**2, 0), nsites) - normalized_ss
+            ssbn = numpy.zeros(G)
+            all_const = numpy.ones(G, dtype=bool)
+            for wigIndex in wigsByConditions.values():
+                ssbn += self.reduce_by_gene(numpy.add, numpy.sum(alldata[wigIndex], 0), nsites)**2 / (len(wigIndex)*nsites)
+                # Counts identical within the condition
+                all_const &= (self.reduce_by_gene(numpy.maximum, numpy.max(data[wigIndex], 0), nsites) ==
+                              self.reduce_by_gene(numpy.minimum, numpy.min(data[wigIndex], 0), nsites))
+            ssbn -= normalized_ss
+            sswn = sstot - ssbn
+            dfbn = len(wigsByConditions) - 1
+            dfwn = bign - len(wigsByConditions)
+            f = (ssbn / dfbn) / (sswn / dfwn)
+        all_same_const = (self.reduce_by_gene(numpy.maximum, numpy.max(data, 0), nsites) ==
+                          self.reduce_by_gene(numpy.minimum, numpy.min(data, 0), nsites))
+        f[all_const & ~all_same_const] = numpy.inf
+        f[all_same_const] = numpy.nan
+        return (f, scipy.special.fdtrc(dfbn, dfwn, f))
 
     def run_anova(self, data, genes, MeansByRv, RvSiteindexesMap, conditions):
         """
@@ -134,34 +158,23 @@ class AnovaMethod(base.MultiConditionMethod):
             SiteIndex: Integer
             Condition :: String
         """
-        count = 0
         self.progress_range(len(genes))
 
-        pvals,Rvs,status = [],[],[]
-        for gene in genes:
-            count += 1
-            Rv = gene["rv"]
-            if (len(RvSiteindexesMap[Rv]) <= 1):
-                status.append("TA sites <= 1")
-                pvals.append(1)
-            else:
-                countSum, countsVec = self.group_by_condition(list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data)), conditions)
-
-                if (countSum == 0):
-                    pval = 1
-                    status.append("No counts in all conditions")
-                    pvals.append(pval)
-                else:
-                    stat,pval = scipy.stats.f_oneway(*countsVec)
-                    status.append("-")
-                    pvals.append(pval)
-            Rvs.append(Rv)
-
-            # Update progress
-            text = "Running Anova Method... %5.1f%%" % (100.0*count/len(genes))
-            self.progress_update(text, count)
-
-        pvals = numpy.array(pvals)
+        (siteindexes, nsites) = self.gene_segments(genes, RvSiteindexesMap)
+        X = data[:, siteindexes]
+        (stat, pvals) = self.f_oneway_by_gene(X, nsites, conditions)
+        countSum = self.reduce_by_gene(numpy.add, numpy.sum(X, 0), nsites)
+
+        status = numpy.full(len(genes), "-", dtype=object)
+        status[countSum == 0] = "No counts in all conditions"
+        status[nsites <= 1] = "TA sites <= 1"
+        pvals[status != "-"] = 1
+        Rvs = [gene["rv"] for gene in genes]
+
+        # Update progress
+        text = "Running Anova Method... %5.1f%%" % 100.0
+        self.progress_update(text, len(genes))
+
         mask = numpy.isfinite(pvals)
         qvals = numpy.full(pvals.shape, numpy.nan)
         qvals[mask] = statsmodels.stats.multitest.fdrcorrection(pvals[mask])[1] # BH, alpha=0.05
@@ -184,7 +197,7 @@ class AnovaMethod(base.MultiConditionMethod):
         (sites, data, filenamesInCombWig) = tnseq_tools.read_combined_wig(self.combined_wig)
 
         self.transit_message("Normalizing using: %s" % self.normalization)
-        (data, factors) = norm_tools.normalize_data(data, self.normalization)
+        (data, factors) = norm_tools.normalize_data(data, self.normalization, inplace=True)
 
         conditionsByFile, _, _, orderingMetadata = tnseq_tools.read_samples_metadata(self.metadata)
         conditions = self.wigs_to_conditions(
@@ -596,6 +596,30 @@ class MultiConditionMethod(AnalysisMethod):
                 numpy.array(covariates_filtered),
                 numpy.array(interactions_filtered))
 
+    def gene_segments(self, genes, RvSiteindexesMap):
+        """
+            Returns the site indexes of all the genes, concatenated in the order of genes,
+            with the number of sites of each gene.
+            ([Gene], {Rv: [SiteIndex]}) -> Tuple([SiteIndex], [Number])
+            Gene :: {start, end, rv, gene, strand}
+            SiteIndex :: Integer
+        """
+        nsites = numpy.array([len(RvSiteindexesMap[gene["rv"]]) for gene in genes], dtype=int)
+        siteindexes = numpy.concatenate([RvSiteindexesMap[gene["rv"]] for gene in genes] + [[]]).astype(int)
+        return (siteindexes, nsites)
+
+    def reduce_by_gene(self, ufunc, values, nsites, empty=0):
+        """
+            Reduces the values of the contiguous sites of each gene (ufunc.reduceat),
+            returning empty for the genes without sites.
+            (numpy.ufunc, [Number], [Number], Number) -> [Number]
+        """
+        result = numpy.full(len(nsites), empty, dtype=float)
+        nonempty = nsites > 0
+        if numpy.any(nonempty):
+            result[nonempty] = ufunc.reduceat(values, (numpy.cumsum(nsites) - nsites)[nonempty])
+        return result
+
 #
 
 class TransitAnalysis:
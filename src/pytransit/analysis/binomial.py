@@ -20,6 +20,7 @@ import math
 import random
 import numpy
 import scipy.stats
+import scipy.special
 import datetime
 
 from pytransit.analysis import base
@@ -132,6 +133,9 @@ class BinomialGUI(base.AnalysisGUI):
 
 ########## CLASS #######################
 
+TINY = numpy.finfo(float).tiny
+EPS = numpy.finfo(float).eps
+
 class BinomialMethod(base.SingleConditionMethod):
     """   
     binomial
@@ -159,7 +163,9 @@ class BinomialMethod(base.SingleConditionMethod):
                 b1=1.0,
                 alpha_w=0.5,
                 beta_w=0.5,
-                wxobj=None):
+                wxobj=None,
+                trace=0,
+                seed=None):
 
         base.SingleConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, annotation_path, output_file, replicates=replicates, normalization=normalization, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
@@ -176,6 +182,8 @@ class BinomialMethod(base.SingleConditionMethod):
         self.b1 = b1
         self.alpha_w = alpha_w
         self.beta_w = beta_w
+        self.trace = trace
+        self.seed = seed
 
 
     @classmethod
@@ -262,6 +270,8 @@ class BinomialMethod(base.SingleConditionMethod):
         b1 = float(kwargs.get("b1", 1.0))
         alpha_w = float(kwargs.get("aw", 0.5))
         beta_w = float(kwargs.get("bw", 0.5))
+        trace = int(kwargs.get("-trace", 0))
+        seed = int(kwargs["-seed"]) if "-seed" in kwargs else None
 
 
         return self(ctrldata,
@@ -284,7 +294,9 @@ class BinomialMethod(base.SingleConditionMethod):
                 b0=b0,
                 b1=b1,
                 alpha_w=alpha_w,
-                beta_w=beta_w)
+                beta_w=beta_w,
+                trace=trace,
+                seed=seed)
 
 
     def Run(self):
@@ -304,7 +316,7 @@ class BinomialMethod(base.SingleConditionMethod):
 
         if self.normalization and self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path, inplace=True)
 
         G = tnseq_tools.Genes(self.ctrldata, self.annotation_path, minread=1, reps=self.replicates, ignoreCodon=self.ignoreCodon, nterm=self.NTerminus, cterm=self.CTerminus, data=data, position=position)
 
@@ -312,154 +324,120 @@ class BinomialMethod(base.SingleConditionMethod):
 
         #Parameters
         self.transit_message("Setting Parameters")
-        w1 = 0.15
-        w0 = 1.0 - w1
-        mu_c = 0
+        if self.seed is None:
+            self.seed = int(numpy.random.randint(0, 2**31-1))
+        rng = numpy.random.RandomState(self.seed)
 
         Ngenes = len(G)
         sample_size = self.samples+self.burnin
         numReps = len(self.ctrldata)
 
-        theta = numpy.zeros((Ngenes, sample_size))
-        theta[:,0] = 0.10
-
-        rho0 = numpy.zeros(sample_size); rho0[0] = 0.5;  Kp0 = numpy.zeros(sample_size); Kp0[0] = 10;
-        rho1 = numpy.zeros(sample_size); rho1[0] = 0.10; Kp1 = numpy.zeros(sample_size); Kp1[0] = 3;
-
-        Z = numpy.zeros((Ngenes, sample_size))
-        pz1 = numpy.zeros(sample_size);
-        n1 = 0
-
-        w1 = scipy.stats.beta.rvs(self.alpha_w, self.beta_w)
-        W1 = numpy.zeros(sample_size); W1[0] = w1
+        # Hyper-parameters of the non-essential (0) and essential (1) classes.
+        # Both classes are updated at once, as their Metropolis steps are independent.
+        rho = numpy.array([0.5, 0.10])
+        Kp = numpy.array([10.0, 3.0])
+        rho_prior = (numpy.array([self.M0*self.pi0, self.M1*self.pi1]), numpy.array([self.M0*(1.0-self.pi0), self.M1*(1.0-self.pi1)]))
+        Kp_prior = (numpy.array([self.a0, self.a1]), numpy.array([self.b0, self.b1]))
+        # Standard deviations of the proposals: rho0, rho1 (first row) and Kp0, Kp1 (second row)
+        proposal_std = numpy.array([[0.010, 0.009], [1.40, 1.1]])
+        acc_rho = numpy.zeros(2, dtype=int)
+        acc_Kp = numpy.zeros(2, dtype=int)
 
+        w1 = rng.beta(self.alpha_w, self.beta_w)
 
 
         #
         self.transit_message("Setting Initial Values")
-        K = numpy.array([sum([1 for x in gene.reads.flatten() if x> 0]) for gene in G])
+        K = numpy.array([numpy.sum(gene.reads.flatten() > 0) for gene in G])
         N = numpy.array([len(gene.reads.flatten()) for gene in G])
 
-        for g,gene in enumerate(G):
-            if N[g] == 0: theta[g][0] = 0.5
-            elif K[g]/float(N[g]) == 0: theta[g][0] = 0.001
-            elif K[g]/float(N[g]) == 1: theta[g][0] = 0.001
-            else: theta[g][0] = K[g]/float(N[g])
-
-            #print(g, ORF[g], K[g], N[g], theta[g][0])
-            Z[g][0] = scipy.stats.bernoulli.rvs(1-theta[g][0])
-
-
-        acc_p0 = 0; acc_k0 = 0;
-        acc_p1 = 0; acc_k1 = 0;
+        theta = numpy.full(Ngenes, 0.5)
+        theta[N > 0] = K[N > 0] / N[N > 0].astype(float)
+        theta[(N > 0) & ((K == 0) | (K == N))] = 0.001
+        Z = (rng.random_sample(Ngenes) < 1-theta).astype(int)
 
+        # Only the current state of the chain is kept, with running sums of
+        # theta and Z over the samples after burn-in.
+        theta_sum = numpy.zeros(Ngenes)
+        z_sum = numpy.zeros(Ngenes)
+        nsum = 0
+        if self.burnin == 0:
+            theta_sum += theta; z_sum += Z; nsum += 1
 
-        rho0c_std = 0.010
-        kp0c_std = 1.40
-        rho1c_std = 0.009
-        kp1c_std = 1.1
+        trace = None
+        if self.trace:
+            trace_path = ".".join(self.output.name.split(".")[:-1]) + "_trace." + self.output.name.split(".")[-1]
+            trace = open(trace_path, "w")
+            trace.write("#Binomial trace: every %d-th sample, including burn-in\n" % self.trace)
+            trace.write("#%s\n" % "\t".join(["sample", "rho0", "Kp0", "rho1", "Kp1", "w1", "essentials"] + [gene.orf for gene in G]))
+            self.write_trace(trace, 0, rho, Kp, w1, Z)
 
 
-        numpy.seterr(divide='ignore')
         for i in range(1, sample_size):
 
-            i0 = Z[:,i-1] == 0; n0 = numpy.sum(i0);
-            i1 = Z[:,i-1] == 1; n1 = numpy.sum(i1);
-
-            theta[i0,i] = scipy.stats.beta.rvs(Kp0[i-1]*rho0[i-1] + K[i0],  Kp0[i-1]*(1-rho0[i-1]) + N[i0] - K[i0])
-            theta[i1,i] = scipy.stats.beta.rvs(Kp1[i-1]*rho1[i-1] + K[i1],  Kp1[i-1]*(1-rho1[i-1]) + N[i1] - K[i1])
-            
-            rho0_c = rho0[i-1] + scipy.stats.norm.rvs(0, rho0c_std)
-            Kp0_c = Kp0[i-1] + scipy.stats.norm.rvs(0, kp0c_std)
-
-
-            if rho0_c <= 0: rho0[i] = rho0[i-1]
-            else:
-                fc = numpy.log(scipy.stats.beta.pdf(rho0_c, self.M0*self.pi0, self.M0*(1.0-self.pi0)))
-                f0 = numpy.log(scipy.stats.beta.pdf(rho0[i-1], self.M0*self.pi0, self.M0*(1.0-self.pi0)))
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0_c, Kp0[i-1]*(1-rho0_c))))
-                f0 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0[i-1], Kp0[i-1]*(1-rho0[i-1]))))
-    
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f0:
-                    rho0[i] = rho0_c
-                    acc_p0+=1
-                else: rho0[i] = rho0[i-1]
-
-
-            if Kp0_c <= 0: Kp0[i] = Kp0[i-1]
-            else:
-                fc = numpy.log(scipy.stats.gamma.pdf(Kp0_c, self.a0, self.b0));
-                f0 = numpy.log(scipy.stats.gamma.pdf(Kp0[i-1], self.a0, self.b0));
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0_c*rho0[i], Kp0_c*(1-rho0[i]))))
-                f0 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0[i], Kp0[i-1]*(1-rho0[i]))))
-    
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f0:
-                    Kp0[i] = Kp0_c
-                    acc_k0+=1
-                else: Kp0[i] = Kp0[i-1]
-
-            rho1_c = rho1[i-1] + scipy.stats.norm.rvs(0, rho1c_std)
-            Kp1_c = Kp1[i-1] + scipy.stats.norm.rvs(0, kp1c_std)
-
-
-            if rho1_c <= 0:
-                rho1[i] = rho1[i-1]
-            else:
-                fc = numpy.log(scipy.stats.beta.pdf(rho1_c, self.M1*self.pi1, self.M1*(1-self.pi1)))
-                f1 = numpy.log(scipy.stats.beta.pdf(rho1[i-1], self.M1*self.pi1, self.M1*(1-self.pi1)))
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1_c, Kp1[i-1]*(1-rho1_c))))
-                f1 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1[i-1], Kp1[i-1]*(1-rho1[i-1]))))
-    
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f1:
-                    rho1[i] = rho1_c
-                    acc_p1+=1
-                else: rho1[i] = rho1[i-1]
-
-            if Kp1_c <= 0: Kp1[i] = Kp1[i-1]
-            else:
-                
-                fc = numpy.log(scipy.stats.gamma.pdf(Kp1_c, self.a1, self.b1));
-                f1 = numpy.log(scipy.stats.gamma.pdf(Kp1[i-1], self.a1, self.b1));
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1_c*rho1[i], Kp1_c*(1-rho1[i]))))
-                f1 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1[i], Kp1[i-1]*(1-rho1[i]))))
-
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f1:
-                    Kp1[i] = Kp1_c
-                    acc_k1+=1
-                else: Kp1[i] = Kp1[i-1]
-
-
-            g0 = scipy.stats.beta.pdf(theta[:,i], Kp0[i]*rho0[i], Kp0[i]*(1-rho0[i])) * (1-w1)
-            g1 = scipy.stats.beta.pdf(theta[:,i], Kp1[i]*rho1[i], Kp1[i]*(1-rho1[i])) * (w1)
-            p1 = g1/(g0+g1)
-            p1 = numpy.nan_to_num(p1)
-
-            
-            try:
-                Z[:,i] = scipy.stats.bernoulli.rvs(p1)
-            except:
-                inan = numpy.isnan(p1)
-                sys.stderr.write("K=\t", K[inan],"\n")
-                sys.stderr.write("N=\t", N[inan],"\n")
-                sys.stderr.write("theta=", theta[inan,i],'\n')
-                sys.exit()
-            pz1[i] = p1[0]
-
-
-            i1 = Z[:,i] == 1; n1 = numpy.sum(i1);
-            #w1 = 0.15
-            w1 = scipy.stats.beta.rvs(self.alpha_w + n1, self.beta_w + Ngenes - n1)
-            W1[i] = w1
+            # theta | Z, rho, Kp, for all genes at once
+            theta = rng.beta(Kp[Z]*rho[Z] + K, Kp[Z]*(1-rho[Z]) + N - K)
+
+            # Sufficient statistics of theta in each class for the Metropolis steps.
+            # theta is kept away from 0 and 1, where it can round to in the tails.
+            log_theta = numpy.log(numpy.clip(theta, TINY, 1.0-EPS))
+            log_1theta = numpy.log(numpy.clip(1.0-theta, TINY, 1.0-EPS))
+            n = numpy.bincount(Z, minlength=2)
+            S1 = numpy.bincount(Z, weights=log_theta, minlength=2)
+            S2 = numpy.bincount(Z, weights=log_1theta, minlength=2)
+
+            # The proposals of both classes, for rho and Kp, drawn in one batch
+            step = rng.normal(0.0, proposal_std)
+            log_u = numpy.log(rng.random_sample((2, 2)))
+
+            # rho | theta, Kp
+            rho_c = rho + step[0]
+            valid = (rho_c > 0) & (rho_c < 1)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                log_ratio = (self.rho_logprior(rho_c, *rho_prior) + self.class_loglik(rho_c, Kp, n, S1, S2)
+                        - self.rho_logprior(rho, *rho_prior) - self.class_loglik(rho, Kp, n, S1, S2))
+            accept = valid & (log_u[0] < log_ratio)
+            rho = numpy.where(accept, rho_c, rho)
+            acc_rho += accept
+
+            # Kp | theta, rho
+            Kp_c = Kp + step[1]
+            valid = (Kp_c > 0) & (Kp_c > Kp_prior[1])
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                log_ratio = (self.Kp_logprior(Kp_c, *Kp_prior) + self.class_loglik(rho, Kp_c, n, S1, S2)
+                        - self.Kp_logprior(Kp, *Kp_prior) - self.class_loglik(rho, Kp, n, S1, S2))
+            accept = valid & (log_u[1] < log_ratio)
+            Kp = numpy.where(accept, Kp_c, Kp)
+            acc_Kp += accept
+
+            # Z | theta, rho, Kp, w1
+            A = Kp*rho; B = Kp*(1.0-rho)
+            log_g0 = (A[0]-1.0)*log_theta + (B[0]-1.0)*log_1theta - scipy.special.betaln(A[0], B[0]) + math.log(1.0-w1)
+            log_g1 = (A[1]-1.0)*log_theta + (B[1]-1.0)*log_1theta - scipy.special.betaln(A[1], B[1]) + math.log(w1)
+            p1 = numpy.nan_to_num(scipy.special.expit(log_g1 - log_g0))
+            Z = (rng.random_sample(Ngenes) < p1).astype(int)
+
+            # w1 | Z
+            n1 = numpy.sum(Z)
+            w1 = rng.beta(self.alpha_w + n1, self.beta_w + Ngenes - n1)
+
+            if i >= self.burnin:
+                theta_sum += theta; z_sum += Z; nsum += 1
+            if trace and i % self.trace == 0:
+                self.write_trace(trace, i, rho, Kp, w1, Z)
 
 
             #Update progress
             text = "Running Binomial Method... %5.1f%%" % (100.0*(i+1)/(sample_size))
             self.progress_update(text, i)
 
-        numpy.seterr(divide='warn')
+        if trace:
+            trace.close()
 
-        z_bar = numpy.apply_along_axis(numpy.mean, 1, Z[:, self.burnin:])
-        theta_bar = numpy.apply_along_axis(numpy.mean, 1, theta[:, self.burnin:])
+        (acc_p0, acc_p1) = acc_rho
+        (acc_k0, acc_k1) = acc_Kp
+        z_bar = z_sum / nsum
+        theta_bar = theta_sum / nsum
         #(ess_threshold, noness_threshold) = stat_tools.fdr_post_prob(z_bar)
         (ess_threshold, noness_threshold) = stat_tools.bayesian_ess_thresholds(z_bar)
 
@@ -482,6 +460,7 @@ class BinomialMethod(base.SingleConditionMethod):
         self.output.write("#Hyperparameters rho: \t%1.2f\t%3.1f\t%1.2f\t%3.1f\n" % (self.pi0, self.M0, self.pi1, self.M1))
         self.output.write("#Hyperparameters Kp: \t%3.1f\t%3.1f\t%3.1f\t%3.1f\n" % (self.a0, self.b0, self.a1, self.b1))
         self.output.write("#Hyperparameters W: \t%1.3f\t%1.3f\n" % (self.alpha_w, self.beta_w))
+        self.output.write("#Seed:\t%d\n" % self.seed)
 
 
         self.output.write("#%s\n" % "\t".join(columns))
@@ -507,6 +486,37 @@ class BinomialMethod(base.SingleConditionMethod):
         self.transit_message("Finished Binomial Method")
 
 
+    def class_loglik(self, rho, Kp, n, S1, S2):
+        """Log-likelihood of the theta of the genes in each class, distributed as
+        Beta(Kp*rho, Kp*(1-rho)), from their sufficient statistics.
+
+        Arguments:
+            rho (numpy.array): rho of each class.
+            Kp (numpy.array): Kp of each class.
+            n (numpy.array): Number of genes in each class.
+            S1 (numpy.array): Sum of log(theta) over the genes in each class.
+            S2 (numpy.array): Sum of log(1-theta) over the genes in each class.
+
+        Returns:
+            numpy.array: Log-likelihood of each class.
+        """
+        A = Kp*rho; B = Kp*(1.0-rho)
+        return (A-1.0)*S1 + (B-1.0)*S2 - n*scipy.special.betaln(A, B)
+
+    def rho_logprior(self, rho, alpha, beta):
+        """Log-density of the Beta(alpha, beta) prior of rho, up to a constant."""
+        return (alpha-1.0)*numpy.log(rho) + (beta-1.0)*numpy.log(1.0-rho)
+
+    def Kp_logprior(self, Kp, a, b):
+        """Log-density of the Gamma prior of Kp, up to a constant. As in
+        scipy.stats.gamma.pdf(Kp, a, b), which the sampler used before, b is the
+        location of the distribution (with unit scale)."""
+        return (a-1.0)*numpy.log(Kp-b) - (Kp-b)
+
+    def write_trace(self, trace, i, rho, Kp, w1, Z):
+        """Writes a sample to the trace file."""
+        trace.write("%d\t%f\t%f\t%f\t%f\t%f\t%d\t%s\n" % (i, rho[0], Kp[0], rho[1], Kp[1], w1, numpy.sum(Z), "\t".join("%d" % z for z in Z)))
+
  
 
     @classmethod
@@ -518,6 +528,8 @@ class BinomialMethod(base.SingleConditionMethod):
             -b <int>        :=  Number of burn-in samples to take. Default: -b 500
             -iN <float>     :=  Ignore TAs occuring at given percentage (as integer) of the N terminus. Default: -iN 0
             -iC <float>     :=  Ignore TAs occuring at given percentage (as integer) of the C terminus. Default: -iC 0
+            --trace <int>   :=  Write every <int>-th sample (hyper-parameters, w1 and Z of each gene) to <output>_trace. Default: no trace
+            --seed <int>    :=  Seed for the random numbers of the sampler. Default: random
 
             Hyper-parameters:
             -pi0 <float>     :=  Hyper-parameters for rho, non-essential genes. Default: -pi0 0.5
@@ -479,7 +479,7 @@ class GIMethod(base.QuadConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0, wxobj=None, resume=False):
 
         base.QuadConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldataA, ctrldataB, expdataA, expdataB, annotation_path, output_file, normalization=normalization, replicates=replicates, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
@@ -490,6 +490,7 @@ class GIMethod(base.QuadConditionMethod):
         self.doFWER = True # TRI
         self.NTerminus = NTerminus
         self.CTerminus = CTerminus
+        self.resume = resume
 
     @classmethod
     def fromGUI(self, wxobj):
@@ -608,6 +609,7 @@ class GIMethod(base.QuadConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.00))
         CTerminus = float(kwargs.get("iC", 0.00))
+        resume = kwargs.get("-resume", False)
 
         return self(ctrldataA,
                 ctrldataB,
@@ -623,7 +625,7 @@ class GIMethod(base.QuadConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus, resume=resume)
 
 
 
@@ -649,7 +651,7 @@ class GIMethod(base.QuadConditionMethod):
         # Normalize data if specified
         if self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, wiglist, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, wiglist, self.annotation_path, inplace=True)
 
         # Do LOESS correction if specified
         if self.LOESS:
@@ -707,14 +709,23 @@ class GIMethod(base.QuadConditionMethod):
 
         k0=1.0
         nu0=1.0
-        data = []
 
-        postprob = []
+        try:
+            checkpoint = transit_tools.ResultCheckpoint(self.output.name, self.checkpoint_parameters(), resume=self.resume)
+        except ValueError as e:
+            self.transit_error(str(e))
+            return
+        if len(checkpoint):
+            self.transit_message("Resuming: %d genes already done" % len(checkpoint))
+
         count = 0
         N = len(G_A1)
         self.progress_range(N)
         # Perform actual analysis
-        for gene in G_A1:
+        for i,gene in enumerate(G_A1):
+            if i in checkpoint:
+                count+=1
+                continue
 
             # If there is some data
             if gene.n > 0:
@@ -807,8 +818,7 @@ class GIMethod(base.QuadConditionMethod):
                 u_delta_logFC = 10
 
 
-            postprob.append(probROPE)
-            data.append((gene.orf, gene.name, gene.n, numpy.mean(muA1_post), numpy.mean(muA2_post), numpy.mean(muB1_post), numpy.mean(muB2_post), mean_logFC_A, mean_logFC_B, mean_delta_logFC, l_delta_logFC, u_delta_logFC, probROPE, not_HDI_overlap_bit))
+            checkpoint.add(i, (gene.orf, gene.name, gene.n, numpy.mean(muA1_post), numpy.mean(muA2_post), numpy.mean(muB1_post), numpy.mean(muB2_post), mean_logFC_A, mean_logFC_B, mean_delta_logFC, l_delta_logFC, u_delta_logFC, probROPE, not_HDI_overlap_bit))
 
 
             text = "Running GI Method... %2.0f%%" % (100.0*(count+1)/N)
@@ -816,6 +826,8 @@ class GIMethod(base.QuadConditionMethod):
             self.transit_message_inplace("Running Export Method... %1.1f%%" % (100.0*count/(N-1)))
             count+=1
 
+        data = [checkpoint[i] for i in range(N)]
+        postprob = [row[-2] for row in data]
         data.sort(key=lambda x: x[-2])
 
         if self.doBFDR or not self.doFWER:
@@ -881,12 +893,23 @@ class GIMethod(base.QuadConditionMethod):
             self.output.write("%s\t%s\t%d\t%1.2f\t%1.2f\t%1.2f\t%1.2f\t%1.2f\t%1.2f\t%1.2f\t%1.2f\t%1.2f\t%1.8f\t%1.8f\t%s\t%s\n" % new_row)
 
 
+        self.output.close()
+        checkpoint.close()
+
         self.transit_message("Adding File: %s" % (self.output.name))
         self.add_file(filetype="GI")
         self.finish()
         self.transit_message("Finished Genetic Interactions Method")
 
 
+    def checkpoint_parameters(self):
+        """Returns the parameters that must match to resume an interrupted run."""
+        return {"method": short_name, "ctrldataA": self.ctrldataA, "ctrldataB": self.ctrldataB,
+                "expdataA": self.expdataA, "expdataB": self.expdataB, "annotation": self.annotation_path,
+                "normalization": self.normalization, "samples": self.samples, "rope": self.rope,
+                "includeZeros": self.includeZeros, "LOESS": self.LOESS,
+                "NTerminus": self.NTerminus, "CTerminus": self.CTerminus}
+
     @staticmethod
     def classify_interaction(delta_logFC, logFC_KO, logFC_WT):
         if delta_logFC < 0:
@@ -917,6 +940,8 @@ class GIMethod(base.QuadConditionMethod):
         -l              :=  Perform LOESS Correction; Helps remove possible genomic position bias. Default: Turned Off.
         -iN <float>     :=  Ignore TAs occuring at given percentage (as integer) of the N terminus. Default: -iN 0
         -iC <float>     :=  Ignore TAs occuring at given percentage (as integer) of the C terminus. Default: -iC 0
+        --resume        :=  Resume an interrupted run with the same arguments, skipping the genes
+                            already saved in <output file>.checkpoint.
         """ % (sys.argv[0])
 
 
@@ -227,7 +227,7 @@ class GriffinMethod(base.SingleConditionMethod):
 
         if self.normalization and self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path, inplace=True)
 
         G = tnseq_tools.Genes(self.ctrldata, self.annotation_path, minread=1, reps=self.replicates, ignoreCodon=self.ignoreCodon, nterm=self.NTerminus, cterm=self.CTerminus, data=data, position=position)
 
@@ -237,29 +237,13 @@ class GriffinMethod(base.SingleConditionMethod):
 
         N = len(G)
         self.progress_range(N)
-        count = 0
         pins = G.global_theta()
-        pnon = 1.0 - pins
-        results = []
-        for gene in G:
-            if gene.n == 0:
-                results.append([gene, 0.0, 1.000])
-            else:
-                B = 1.0/math.log(1.0/pnon)
-                u = math.log(gene.n*pins, 1.0/pnon)
-                exprun = tnseq_tools.ExpectedRuns(gene.n, pnon)
-                pval = 1.0 - tnseq_tools.GumbelCDF(gene.r, u, B)
-                results.append([gene, exprun, pval])
-
-            text = "Running Griffin Method... %5.1f%%" % (100.0*(count+1)/(N))
-            self.progress_update(text, count)
-            count+=1
-
-
-        pval = [row[-1] for row in results]
+        (exprun, pval) = tnseq_tools.griffin_pvalues(G.local_sites(), G.local_runs(), pins, moments=False)
         padj = stat_tools.BH_fdr_correction(pval)
-        for i in range(len(results)):
-            results[i].append(padj[i])
+        text = "Running Griffin Method... %5.1f%%" % 100.0
+        self.progress_update(text, N)
+
+        results = [[gene, exprun[i], pval[i], padj[i]] for (i, gene) in enumerate(G)]
         results.sort()
         
         self.output.write("#Griffin\n")
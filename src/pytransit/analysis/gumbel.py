@@ -23,6 +23,7 @@ import numpy
 import scipy.stats
 import datetime
 import warnings
+import multiprocessing
 
 from pytransit.analysis import base
 import pytransit.transit_tools as transit_tools
@@ -146,6 +147,10 @@ EXACT = 20
 
 ALPHA = 1
 BETA = 1
+
+# Convergence criteria used to stop sampling early (--converge)
+RHAT_MAX = 1.05
+ESS_MIN = 400
 class GumbelMethod(base.SingleConditionMethod):
     """   
     Gumbel
@@ -164,17 +169,21 @@ class GumbelMethod(base.SingleConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0, wxobj=None,
+                chains=1, nprocs=1, seed=None, converge=False, trace=0):
 
         base.SingleConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, annotation_path, output_file, replicates=replicates, normalization=normalization, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
         self.samples = samples
         self.burnin = burnin
         self.trim = trim
         self.minread = minread
-      
+        self.chains = max(1, int(chains))
+        self.nprocs = max(1, int(nprocs))
+        self.seed = seed
+        self.converge = converge
+        self.trace = trace
 
         self.cache_nn = {}
-        self.cache_expruns = {}
 
     @classmethod
     def fromGUI(self, wxobj):
@@ -287,6 +296,11 @@ class GumbelMethod(base.SingleConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.0))
         CTerminus = float(kwargs.get("iC", 0.0))
+        chains = int(kwargs.get("-chains", 1))
+        nprocs = int(kwargs.get("j", 1))
+        seed = int(kwargs["-seed"]) if "-seed" in kwargs else None
+        converge = "-converge" in kwargs
+        trace = int(kwargs.get("-trace", 0))
 
         return self(ctrldata,
                 annotationPath,
@@ -300,7 +314,12 @@ class GumbelMethod(base.SingleConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus,
+                chains=chains,
+                nprocs=nprocs,
+                seed=seed,
+                converge=converge,
+                trace=trace)
 
     def Run(self):
 
@@ -308,19 +327,15 @@ class GumbelMethod(base.SingleConditionMethod):
 
         #Set Default parameter values
         w1 = 0.15
-        w0 = 1.0 - w1
-        ALPHA = 1
-        BETA = 1
         ALPHA_w = 600
         BETA_w = 3400
         mu_c = 0
-        acctot = 0.0
         phi_start = 0.3
         sigma_c = 0.01 
         
         start_time = time.time()
        
-        self.progress_range(self.samples+self.burnin)
+        self.progress_range(self.chains*(self.samples+self.burnin))
         
         #Get orf data
         self.transit_message("Reading Annotation")
@@ -336,7 +351,7 @@ class GumbelMethod(base.SingleConditionMethod):
 
         if self.normalization and self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path, inplace=True)
 
         G = tnseq_tools.Genes(self.ctrldata, self.annotation_path, minread=self.minread, reps=self.replicates, ignoreCodon=self.ignoreCodon, nterm=self.NTerminus, cterm=self.CTerminus, data=data, position=position)
 
@@ -356,70 +371,99 @@ class GumbelMethod(base.SingleConditionMethod):
         N_GOOD = sum(ii_good)
 
         self.transit_message("Setting Initial Class")
-        Z_sample = numpy.zeros((N_GOOD, self.samples))
-        Z = [self.classify(g.n, g.r, 0.5)   for g in G if self.good_orf(g)]
-        Z_sample[:,0] = Z
-        N_ESS = numpy.sum(Z_sample[:,0] == 1)
-        
-        phi_sample = numpy.zeros(self.samples) #[]
-        phi_sample[0] = phi_start
-        phi_old = phi_start
-        phi_new = 0.00
-        
+        Z = numpy.array([self.classify(g.n, g.r, 0.5) for g in G if self.good_orf(g)])
+
         SIG = numpy.array([self.sigmoid(g.s, g.t) * scipy.stats.norm.pdf(g.r, mu_r*g.s, sigma_r) for g in G if self.good_orf(g)])
 
-#        idxG,idxN = -1,0
-#        for i in range(len(G)):
-#          if G[i].name=="glf": idxG = i
-#          if ii_good[i]==True: idxN += 1 # could do sum(ii_good[:idxG])
-
-        i = 1; count = 0;
-        while i < self.samples:
-
-            try:
-                # PHI
-                acc = 1.0
-                phi_new  = phi_old + random.gauss(mu_c, sigma_c)
-                i0 = Z_sample[:,i-1] == 0
-                if phi_new > 1 or phi_new <= 0 or (self.F_non(phi_new, N[i0], R[i0]) - self.F_non(phi_old, N[i0], R[i0])) < math.log(random.uniform(0,1)):
-                    phi_new = phi_old
-                    acc = 0.0
-                    flag = 0
-            
-                # Z
-                Z = self.sample_Z(phi_new, w1, N, R, S, T, mu_s, sigma_s, SIG)
-            
-                # w1
-                N_ESS = sum(Z == 1)
-                w1 = scipy.stats.beta.rvs(N_ESS + ALPHA_w, N_GOOD - N_ESS + BETA_w)
-            
-                count +=1
-                acctot+=acc
-            
-                if (count > self.burnin) and (count % self.trim == 0):
-                    phi_sample[i] = phi_new
-                    Z_sample[:,i] = Z
-                    i+=1
-
-            except ValueError as e:
-                self.transit_message("Error: %s" % e) 
-                self.transit_message("This is likely to have been caused by poor data (e.g. too sparse).") 
-                self.transit_message("If the density of the dataset is too low, the Gumbel method will not work.") 
-                self.transit_message("Quitting.") 
-                return
-
-#            print(i,phi_new,w1,G[idxG].name,N[idxN],R[idxN],Z[idxN])
-            
-            phi_old = phi_new
-            #Update progress
-            text = "Running Gumbel Method... %5.1f%%" % (100.0*(count+1)/(self.samples+self.burnin))
-            self.progress_update(text, count)
-            
+        if self.seed is None:
+            self.seed = int(numpy.random.randint(0, 2**31-1))
+        chains = self.initial_chains(phi_start, w1, Z)
+        params = {"N": N, "R": R, "S": S, "T": T, "SIG": SIG, "mu_s": mu_s, "sigma_s": sigma_s,
+                "mu_c": mu_c, "sigma_c": sigma_c, "ALPHA_w": ALPHA_w, "BETA_w": BETA_w,
+                "burnin": self.burnin, "trim": self.trim, "trace": self.trace}
+
+        # Only running sums of Z are kept, pooled over chains, along with the
+        # traces of phi and of the number of essentials for the diagnostics.
+        # As with a single chain, the initial state of the first chain is kept
+        # as its first sample; the random starting points of the other chains
+        # are not samples of the posterior, and only their draws after burn-in
+        # are pooled. The traces of the diagnostics only hold these draws.
+        phi_blocks = [[numpy.zeros(0)] for chain in chains]
+        ness_blocks = [[numpy.zeros(0, dtype=int)] for chain in chains]
+        Z_sum = Z.copy()
+        nsamples = 1
+
+        trace = None
+        if self.trace:
+            trace_path = ".".join(self.output.name.split(".")[:-1]) + "_trace." + self.output.name.split(".")[-1]
+            trace = open(trace_path, "w")
+            trace.write("#Gumbel trace: every %d-th sample of each chain\n" % self.trace)
+            trace.write("#%s\n" % "\t".join(["chain", "sample", "phi", "w1", "essentials"] + [g.orf for g in G if self.good_orf(g)]))
+            for (c, chain) in enumerate(chains):
+                self.write_trace(trace, c, [(0, chain["phi"], chain["w1"], chain["Z"])])
+
+        # Chains are advanced in rounds of samples, for progress updates and convergence checks
+        block = max(1, int(math.ceil((self.samples-1)/20.0)))
+        pool = None
+        if self.nprocs > 1 and self.chains > 1:
+            self.transit_message("Running %d chains using %d processes" % (self.chains, min(self.nprocs, self.chains)))
+            pool = multiprocessing.Pool(min(self.nprocs, self.chains))
+
+        converged = False
+        try:
+            while nsamples < self.samples and not converged:
+                tasks = [(chain, min(block, self.samples-nsamples), params) for chain in chains]
+                results = pool.map(gumbel_chain, tasks) if pool else list(map(gumbel_chain, tasks))
+                for (c, (chain, phis, ness, Zs, rows)) in enumerate(results):
+                    chains[c] = chain
+                    phi_blocks[c].append(phis)
+                    ness_blocks[c].append(ness)
+                    Z_sum += Zs
+                    if trace:
+                        self.write_trace(trace, c, rows)
+                nsamples += len(phis)
+
+                #Update progress
+                count = sum(chain["count"] for chain in chains)
+                text = "Running Gumbel Method... %5.1f%%" % (100.0*count/(self.chains*(self.samples+self.burnin)))
+                self.progress_update(text, count)
+
+                if self.converge:
+                    phi_sample = numpy.array([numpy.concatenate(blocks) for blocks in phi_blocks])
+                    ness_sample = numpy.array([numpy.concatenate(blocks) for blocks in ness_blocks])
+                    diagnostics = self.diagnostics(phi_sample, ness_sample)
+                    converged = max(diagnostics[0::2]) < RHAT_MAX and min(diagnostics[1::2]) >= ESS_MIN
+
+        except ValueError as e:
+            self.transit_message("Error: %s" % e) 
+            self.transit_message("This is likely to have been caused by poor data (e.g. too sparse).") 
+            self.transit_message("If the density of the dataset is too low, the Gumbel method will not work.") 
+            self.transit_message("Quitting.") 
+            return
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if trace:
+                trace.close()
+
+        if converged:
+            self.transit_message("Chains converged after %d samples per chain" % (nsamples-1))
+
+        phi_sample = numpy.array([numpy.concatenate(blocks) for blocks in phi_blocks])
+        ness_sample = numpy.array([numpy.concatenate(blocks) for blocks in ness_blocks])
+        (rhat_phi, ess_phi, rhat_ess, ess_ess) = self.diagnostics(phi_sample, ness_sample)
+        count = sum(chain["count"] for chain in chains)
+        acctot = sum(chain["acc"] for chain in chains)
+        # Pooled samples: the initial state of the first chain and the draws of all chains
+        phi_pooled = numpy.concatenate([[phi_start]] + list(phi_sample))
+        sample_size = len(phi_pooled)
+
         try:
-            ZBAR = numpy.apply_along_axis(numpy.mean, 1, Z_sample)
+            ZBAR = Z_sum / float(sample_size)
             (ess_t, non_t) = stat_tools.bayesian_ess_thresholds(ZBAR)
         except ValueError:
-            print("ValueError in ZBAR calculation: {} {}".format(Z_sample, self.output.name.encode('utf-8')), file=sys.stderr)
+            print("ValueError in ZBAR calculation: {} {}".format(Z_sum, self.output.name.encode('utf-8')), file=sys.stderr)
             ess_t, non_t = float("inf"), -float("inf")
 
         #Orf    k   n   r   s   zbar
@@ -438,8 +482,12 @@ class GumbelMethod(base.SingleConditionMethod):
         self.output.write("#FDR Corrected thresholds: %f, %f\n" % (ess_t, non_t))
         self.output.write("#MH Acceptance-Rate:\t%2.2f%%\n" % (100.0*acctot/count))
         self.output.write("#Total Iterations Performed:\t%d\n" % count)
-        self.output.write("#Sample Size:\t%d\n" % i)
-        self.output.write("#phi estimate:\t%f\n" % numpy.average(phi_sample))
+        self.output.write("#Sample Size:\t%d\n" % sample_size)
+        self.output.write("#Chains:\t%d\n" % self.chains)
+        self.output.write("#Seed:\t%d\n" % self.seed)
+        self.output.write("#R-hat (phi, essentials):\t%f\t%f\n" % (rhat_phi, rhat_ess))
+        self.output.write("#ESS (phi, essentials):\t%.1f\t%.1f\n" % (ess_phi, ess_ess))
+        self.output.write("#phi estimate:\t%f\n" % numpy.average(phi_pooled))
         self.output.write("#Time: %s\n" % (time.time() - start_time))
         self.output.write("#%s\n" % "\t".join(columns))
         i = 0
@@ -482,51 +530,124 @@ class GumbelMethod(base.SingleConditionMethod):
         -r <string>     :=  How to handle replicates. Sum or Mean. Default: -r Sum
         -iN <float>     :=  Ignore TAs occuring within given percentage (as integer) of the N terminus. Default: -iN 0
         -iC <float>     :=  Ignore TAs occuring within given percentage (as integer) of the C terminus. Default: -iC 0
-        """ % (sys.argv[0])
+        --chains <int>  :=  Number of independent MCMC chains. Z-bar is averaged over the -s samples of the first chain (including
+                            its initial state) and the -s - 1 samples after burn-in of each other chain. Default: --chains 1
+        -j <int>        :=  Number of worker processes used to run the chains in parallel. Default: -j 1
+        --seed <int>    :=  Seed for the random numbers of the chains. Results for a given seed do not depend on -j.
+        --converge      :=  Stop sampling once R-hat < %s and ESS >= %d for both phi and the number of essential genes.
+        --trace <int>   :=  Write every <int>-th sample of each chain (phi, w1 and Z of each gene) to <output>_trace. Default: no trace
+        """ % (sys.argv[0], RHAT_MAX, ESS_MIN)
 
     def good_orf(self, gene):
         return (gene.n >= 3 and gene.t >= 150)
 
-    def ExpectedRuns_cached(self,n,q):
-        if (n,q) not in self.cache_expruns: self.cache_expruns[(n,q)] = tnseq_tools.ExpectedRuns(n,q)
-        return self.cache_expruns[(n,q)]
+    def initial_chains(self, phi_start, w1, Z):
+        """Initial states of the MCMC chains. Chain c draws its random numbers
+        from generators seeded with (seed, c). All but the first chain start
+        from a random value of phi, so that the diagnostics can tell whether the
+        chains reached the same distribution from different starting points.
+
+        Arguments:
+            phi_start (float): Starting value of phi for the first chain.
+            w1 (float): Starting prior probability of essentiality.
+            Z (numpy.array): Initial classification of the genes.
+
+        Returns:
+            list: The state of each chain (see gumbel_chain).
+        """
+        chains = []
+        for c in range(self.chains):
+            rng = numpy.random.RandomState([self.seed, c])
+            phi = phi_start if c == 0 else rng.uniform(0.1, 0.9)
+            gen = random.Random(int(rng.randint(0, 2**31-1)))
+            chains.append({"phi": phi, "w1": w1, "Z": Z, "count": 0, "acc": 0.0, "samples": 1,
+                    "random": gen.getstate(), "numpy": rng.get_state()})
+        return chains
+
+    def diagnostics(self, phi_sample, ness_sample):
+        """Convergence diagnostics of the chains, for phi and for the number of
+        essential genes in each sample.
+
+        Arguments:
+            phi_sample (numpy.array): Samples of phi, as chains x samples.
+            ness_sample (numpy.array): Number of essentials in each sample, as chains x samples.
+
+        Returns:
+            tuple: (R-hat of phi, ESS of phi, R-hat of the number of essentials,
+                ESS of the number of essentials). NaN with fewer than 4 samples
+                per chain.
+        """
+        if phi_sample.shape[1] < 4:
+            return (float("nan"),)*4
+        return (float(stat_tools.split_rhat(phi_sample)), float(stat_tools.effective_sample_size(phi_sample)),
+                float(stat_tools.split_rhat(ness_sample)), float(stat_tools.effective_sample_size(ness_sample)))
+
+    def write_trace(self, trace, c, rows):
+        """Writes samples of a chain to the trace file.
+
+        Arguments:
+            trace (file): Open trace file.
+            c (int): Index of the chain.
+            rows (list): (sample index, phi, w1, Z) of each sample to write.
+        """
+        for (i, phi, w1, Z) in rows:
+            trace.write("%d\t%d\t%f\t%f\t%d\t%s\n" % (c, i, phi, w1, numpy.sum(Z), "\t".join(str(z) for z in Z)))
+
+    @classmethod
+    def gumbel_location(self, p, N):
+        """Location (mu) of the Gumbel distribution of the maximum run of non-insertions
+        of each gene. The exact expected run is used for genes with less than EXACT
+        sites (matching of moments: mean = mu + gamma*beta), for all genes at once.
+
+        Arguments:
+            p (float): Probability of non-insertion.
+            N (numpy.array): Number of sites of each gene.
+
+        Returns:
+            numpy.array: Location of the Gumbel distribution for each gene.
+        """
+        BetaGamma = tnseq_tools.getGamma()/math.log(1/p)
+        mu = numpy.log(N*(1.0-p)) / numpy.log(1/p)
+        small = N < EXACT
+        mu[small] = tnseq_tools.ExpectedRunsArray(N[small], p, exact=EXACT) - BetaGamma
+        return mu
+
+    @classmethod
+    def gumbel_logpdf(self, x, mu, sigma):
+        """Log-density of the Gumbel distribution, as scipy.stats.gumbel_r.logpdf
+        without the overhead of argument checking on every MCMC iteration."""
+        z = (x - mu) / sigma
+        return -z - numpy.exp(-z) - math.log(sigma)
 
     def classify(self, n,r,p):
         if n == 0: return 0
         q = 1-p; B = 1/math.log(1/p); u = math.log(n*q,1/p) 
         BetaGamma = B*tnseq_tools.getGamma()
         if n<EXACT: # estimate more accurately based on expected run len, using exact calc for small genes
-          exprun = self.ExpectedRuns_cached(n,p)
+          exprun = tnseq_tools.ExpectedRuns(n,p)
           u = exprun-BetaGamma # u is mu of Gumbel (mean=mu+gamma*beta); matching of moments
-        pval = 1 - scipy.exp(scipy.stats.gumbel_r.logcdf(r,u,B))
+        pval = 1 - numpy.exp(scipy.stats.gumbel_r.logcdf(r,u,B))
         if pval < 0.05: return(1)
         else: return(0)
 
+    @classmethod
     def F_non(self, p, N, R): # pass in P_nonins as p
-        q = 1.0 - p; 
-        BetaGamma = tnseq_tools.getGamma()/math.log(1/p)
         total = numpy.log(scipy.stats.beta.pdf(p,ALPHA,BETA))
-        mu = numpy.log(N*q) / numpy.log(1/p)
-        for i in range(len(N)): # estimate more accurately based on expected run len, using exact calc for small genes
-          if N[i]<EXACT: mu[i] = self.ExpectedRuns_cached(int(N[i]),p)-BetaGamma
+        mu = self.gumbel_location(p, N)
         sigma = 1/math.log(1/p);
-        #for i in range(len(N)): print('\t'.join([str(x) for x in N[i],R[i],self.ExpectedRuns_cached(int(N[i]),q),mu[i],scipy.stats.gumbel_r.pdf(R[i], mu[i], sigma)]))
-        total += numpy.sum(scipy.stats.gumbel_r.logpdf(R, mu, sigma))
+        total += numpy.sum(self.gumbel_logpdf(R, mu, sigma))
         return(total)
     
-    def sample_Z(self, p, w1, N, R, S, T, mu_s, sigma_s, SIG):
+    @classmethod
+    def sample_Z(self, p, w1, N, R, S, T, mu_s, sigma_s, SIG, rng=numpy.random):
         G = len(N)
-        q = 1.0-p
-        BetaGamma = tnseq_tools.getGamma()/math.log(1/p)
-        mu = numpy.log(N*q) / numpy.log(1/p)
-        for i in range(len(N)): # estimate more accurately based on expected run len, using exact calc for small genes
-          if N[i]<EXACT: mu[i] = self.ExpectedRuns_cached(int(N[i]),p)-BetaGamma
+        mu = self.gumbel_location(p, N)
         sigma = 1.0/math.log(1.0/p);
-        h0 = ((scipy.exp(scipy.stats.gumbel_r.logpdf(R,mu,sigma))) * scipy.stats.norm.pdf(S, mu_s*R, sigma_s)  * (1-w1))
+        h0 = ((numpy.exp(self.gumbel_logpdf(R,mu,sigma))) * scipy.stats.norm.pdf(S, mu_s*R, sigma_s)  * (1-w1))
         h1 = SIG * w1
         h1 += 1e-10; h0 += 1e-10 # to prevent div-by-zero; if neither class is probable, p(z1) should be ~0.5
         p_z1 = h1/(h0+h1)
-        return scipy.stats.binom.rvs(1, p_z1, size=G)
+        return rng.binomial(1, p_z1, size=G)
 
     def sigmoid(self,d,n):
         Kn = 0.1
@@ -551,6 +672,79 @@ class GumbelMethod(base.SingleConditionMethod):
         return f/tot
 
 
+def gumbel_chain(task):
+    """Continues an MCMC chain of the Gumbel method for a number of samples.
+
+    The state of a chain includes the states of its random number generators
+    (a random.Random for phi, a numpy RandomState for Z and w1), so a chain draws
+    the same samples whether it runs in this process or in a worker, and however
+    its samples are split across calls. The global generators are not used.
+
+    Arguments:
+        task (tuple): (chain state, number of samples, parameters dict). The
+            chain state is a dict with the current phi and w1, the last sampled
+            Z, the number of iterations and accepted phi proposals so far, and
+            the number of samples taken and the random number generator states.
+
+    Returns:
+        tuple: (new chain state, phi samples, number of essentials in each sample,
+            sum of the Z samples, trace rows). Every params["trace"]-th sample of
+            the chain is returned as a trace row (sample index, phi, w1, Z).
+    """
+    (chain, nsamples, params) = task
+    (N, R, S, T, SIG) = (params["N"], params["R"], params["S"], params["T"], params["SIG"])
+    N_GOOD = len(N)
+    gen = random.Random()
+    gen.setstate(chain["random"])
+    rng = numpy.random.RandomState()
+    rng.set_state(chain["numpy"])
+
+    phi_sample = numpy.zeros(nsamples)
+    ness_sample = numpy.zeros(nsamples, dtype=int)
+    Z_sum = numpy.zeros(N_GOOD, dtype=int)
+    rows = []
+    phi_old = chain["phi"]
+    w1 = chain["w1"]
+    count = chain["count"]
+    acctot = chain["acc"]
+    # As in the original sampler, phi is updated given the last Z kept as a sample
+    Z_last = chain["Z"]
+    i0 = Z_last == 0
+    i = 0
+    while i < nsamples:
+        # PHI
+        acc = 1.0
+        phi_new  = phi_old + gen.gauss(params["mu_c"], params["sigma_c"])
+        if phi_new > 1 or phi_new <= 0 or (GumbelMethod.F_non(phi_new, N[i0], R[i0]) - GumbelMethod.F_non(phi_old, N[i0], R[i0])) < math.log(gen.uniform(0,1)):
+            phi_new = phi_old
+            acc = 0.0
+
+        # Z
+        Z = GumbelMethod.sample_Z(phi_new, w1, N, R, S, T, params["mu_s"], params["sigma_s"], SIG, rng)
+
+        # w1
+        N_ESS = numpy.sum(Z == 1)
+        w1 = scipy.stats.beta.rvs(N_ESS + params["ALPHA_w"], N_GOOD - N_ESS + params["BETA_w"], random_state=rng)
+
+        count +=1
+        acctot+=acc
+
+        if (count > params["burnin"]) and (count % params["trim"] == 0):
+            phi_sample[i] = phi_new
+            ness_sample[i] = N_ESS
+            Z_sum += Z
+            if params["trace"] and (chain["samples"] + i) % params["trace"] == 0:
+                rows.append((chain["samples"] + i, phi_new, w1, Z))
+            Z_last = Z
+            i0 = Z_last == 0
+            i+=1
+
+        phi_old = phi_new
+
+    chain = {"phi": phi_old, "w1": w1, "Z": Z_last, "count": count, "acc": acctot, "samples": chain["samples"] + nsamples,
+            "random": gen.getstate(), "numpy": rng.get_state()}
+    return (chain, phi_sample, ness_sample, Z_sum, rows)
+
 
 if __name__ == "__main__":
 
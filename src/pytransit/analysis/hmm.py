@@ -186,13 +186,23 @@ class HMMMethod(base.SingleConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0, wxobj=None, lean=False,
+                em=False,
+                em_tol=1e-6,
+                em_iter=50):
 
         base.SingleConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, annotation_path, output_file, replicates=replicates, normalization=normalization, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
+        self.lean = lean
+        self.em = em
+        self.em_tol = em_tol
+        self.em_iter = em_iter
 
         try:
             T = len([1 for line in open(ctrldata[0]).readlines() if not line.startswith("#")])
-            self.maxiterations = T*4 + 1
+            # The memory-lean mode runs the backward recursion twice, also in each
+            # EM iteration, which otherwise runs a forward and a backward pass
+            self.maxiterations = T*(5 if lean else 4) + 1
+            if em: self.maxiterations += (3 if lean else 2)*T*(em_iter+1)
         except:
             self.maxiterations = 100
         self.count = 1
@@ -263,6 +273,10 @@ class HMMMethod(base.SingleConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.0))
         CTerminus = float(kwargs.get("iC", 0.0))
+        lean = kwargs.get("-lean", False)
+        em = kwargs.get("-em", False)
+        em_tol = float(kwargs.get("-em-tol", 1e-6))
+        em_iter = int(kwargs.get("-em-iter", 50))
 
         return self(ctrldata,
                 annotationPath,
@@ -272,7 +286,11 @@ class HMMMethod(base.SingleConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus,
+                lean=lean,
+                em=em,
+                em_tol=em_tol,
+                em_iter=em_iter)
 
     def Run(self):
 
@@ -287,7 +305,7 @@ class HMMMethod(base.SingleConditionMethod):
         # Normalize data
         if self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path, inplace=True)
         
         # Do LOESS
         if self.LOESS: 
@@ -308,18 +326,15 @@ class HMMMethod(base.SingleConditionMethod):
         label = {0:"ES", 1:"GD", 2:"NE",3:"GA"}
 
         reads = O-1
-        reads_nz = sorted(reads[reads !=0 ])
+        reads_nz = numpy.sort(reads[reads !=0 ])
         size = len(reads_nz)
         mean_r = numpy.average(reads_nz[:int(0.95 * size)])
         mu = numpy.array([1/0.99, 0.01 * mean_r + 2,  mean_r, mean_r*5.0])
         #mu = numpy.array([1/0.99, 0.1 * mean_r + 2,  mean_r, mean_r*5.0])
         L = 1.0/mu
-        B = [] # Emission Probability Distributions
-        for i in range(Nstates):
-            B.append(scipy.stats.geom(L[i]).pmf)
 
         pins = self.calculate_pins(O-1)
-        pins_obs = sum([1 for rd in O if rd >=2])/float(len(O))
+        pins_obs = numpy.sum(O >= 2)/float(len(O))
         pnon = 1.0 - pins
         pnon_obs = 1.0 - pins_obs
 
@@ -327,8 +342,9 @@ class HMMMethod(base.SingleConditionMethod):
             if pnon ** r < 0.01: break
 
         A = numpy.zeros((Nstates,Nstates))
-        a = math.log1p(-B[int(Nstates/2)](1)**r)
-        b = r*math.log(B[int(Nstates/2)](1)) + math.log(1.0/3) # change to Nstates-1?
+        p_one = scipy.stats.geom.pmf(1, L[int(Nstates/2)]) # Probability of a single read in the non-essential state
+        a = math.log1p(-p_one**r)
+        b = r*math.log(p_one) + math.log(1.0/3) # change to Nstates-1?
         for i in range(Nstates):
             A[i] = [b]*Nstates
             A[i][i] = a
@@ -338,29 +354,43 @@ class HMMMethod(base.SingleConditionMethod):
 
 
         self.progress_range(self.maxiterations)
-        
 
-        ###############
-        ### VITERBI ###
-        (Q_opt, delta, Q) = self.viterbi(A, B, PI, O)
-        ###############
+        T = len(O)
+        # Segments of ~sqrt(T) sites in the memory-lean mode: only the back-pointers
+        # (one byte per state and site) and one checkpoint per segment are kept for
+        # the whole genome.
+        segment = int(math.ceil(math.sqrt(T))) if self.lean else None
+
+        if self.em:
+            self.transit_message("Estimating parameters with Baum-Welch (tolerance: %g, max. iterations: %d)" % (self.em_tol, self.em_iter))
+            (A, L, PI, em_loglik) = self.baum_welch(A, L, O, PI, self.em_tol, self.em_iter, segment)
+            mu = 1.0/L
+
+        if self.lean:
+            self.transit_message("Decoding in segments of %d sites" % segment)
+            Q_opt = self.viterbi_lean(A, L, O, PI, segment)
+            posteriors = self.posterior_segments(A, L, O, PI, segment)
+        else:
+            B = self.emission_log_probabilities(L, O) # Log-emission probabilities of each state at each site
 
-        ##################
-        ### ALPHA PASS ###
-        (log_Prob_Obs, alpha, C) = self.forward_procedure(numpy.exp(A), B, PI, O)
-        ##################
+            ###############
+            ### VITERBI ###
+            (Q_opt, delta, Q) = self.viterbi(A, B, PI)
+            ###############
 
-        #################
-        ### BETA PASS ###
-        beta = self.backward_procedure(numpy.exp(A), B, PI, O, C)
-        #################
+            ##################
+            ### ALPHA PASS ###
+            (log_Prob_Obs, alpha) = self.forward_procedure(A, B, PI)
+            ##################
 
-        T = len(O); total=0; state2count = dict.fromkeys(range(Nstates),0)
-        for t in range(T):
-            state = Q_opt[t]
-            state2count[state] +=1
-            total+=1
- 
+            #################
+            ### BETA PASS ###
+            beta = self.backward_procedure(A, B)
+            #################
+
+            posteriors = [(0, self.posterior_probabilities(alpha, beta))]
+
+        total = T; state2count = numpy.bincount(Q_opt, minlength=Nstates)
             
        
         self.output.write("#HMM - Sites\n")
@@ -383,6 +413,9 @@ class HMMMethod(base.SingleConditionMethod):
         self.output.write("# pins (obs):\t%f\n" % pins_obs)
         self.output.write("# pins (est):\t%f\n" % pins)
         self.output.write("# Run length (r):\t%d\n" % r)
+        if self.em:
+            self.output.write("# Baum-Welch iterations:\t%d\n" % (len(em_loglik)-1))
+            self.output.write("# Log-likelihood:\t%s\n" % "\t".join(["%1.4f" % ll for ll in em_loglik]))
         self.output.write("# State means:\n")
         self.output.write("#    %s\n" % "   ".join(["%s: %8.4f" % (label[i], mu[i]) for i in range(Nstates)]))
         self.output.write("# Self-Transition Prob:\n")
@@ -393,17 +426,18 @@ class HMMMethod(base.SingleConditionMethod):
         self.output.write("#    %s\n" % "   ".join(["%s: %2.2f%%" % (label[i], state2count[i]*100.0/total) for i in range(Nstates)]))
          
 
-        states = [int(Q_opt[t]) for t in range(T)]
-        last_orf = ""
-        for t in range(T):
-            s_lab = label.get(states[t], "Unknown State")
-            gamma_t = (alpha[:,t] * beta[:,t])/numpy.sum(alpha[:,t] * beta[:,t])
-            genes_at_site = hash.get(position[t], [""])
-            genestr = ""
-            if not (len(genes_at_site) == 1 and not genes_at_site[0]):
-                genestr = ",".join(["%s_(%s)" % (g,rv2info.get(g, "-")[0]) for g in genes_at_site])
+        # Posteriors are written as they are computed (one segment at a time in the memory-lean mode)
+        for (start, gamma) in posteriors:
+            for i in range(gamma.shape[1]):
+                t = start + i
+                s_lab = label.get(int(Q_opt[t]), "Unknown State")
+                gamma_t = gamma[:,i]
+                genes_at_site = hash.get(position[t], [""])
+                genestr = ""
+                if not (len(genes_at_site) == 1 and not genes_at_site[0]):
+                    genestr = ",".join(["%s_(%s)" % (g,rv2info.get(g, "-")[0]) for g in genes_at_site])
 
-            self.output.write("%s\t%s\t%s\t%s\t%s\n" % (int(position[t]), int(O[t])-1, "\t".join(["%-9.2e" % g for g in gamma_t]), s_lab, genestr))
+                self.output.write("%s\t%s\t%s\t%s\t%s\n" % (int(position[t]), int(O[t])-1, "\t".join(["%-9.2e" % g for g in gamma_t]), s_lab, genestr))
 
         self.output.close()
 
@@ -418,7 +452,7 @@ class HMMMethod(base.SingleConditionMethod):
 
         tempObs = numpy.zeros((1,len(O)))
         tempObs[0,:] = O - 1
-        self.post_process_genes(tempObs, position, states, genes_path)
+        self.post_process_genes(tempObs, position, Q_opt, genes_path)
 
 
         self.transit_message("Adding File: %s" % (genes_path))
@@ -437,168 +471,476 @@ class HMMMethod(base.SingleConditionMethod):
             -l              :=  Perform LOESS Correction; Helps remove possible genomic position bias. Default: Off.
             -iN <float>     :=  Ignore TAs occuring within given percentage (as integer) of the N terminus. Default: -iN 0
             -iC <float>     :=  Ignore TAs occuring within given percentage (as integer) of the C terminus. Default: -iC 0
+            --lean          :=  Memory-lean mode for large datasets (e.g. nucleotide-resolution Tn5 data): decodes the genome in segments
+                                and streams the per-site output instead of keeping the full forward/backward matrices. Default: Off.
+            --em            :=  Estimate the emission and transition probabilities with Baum-Welch (EM), starting from
+                                the default estimates. Default: Off.
+            --em-tol <float>:=  Stop EM when the log-likelihood improves by less than this fraction. Default: --em-tol 1e-6
+            --em-iter <int> :=  Maximum number of EM iterations. Default: --em-iter 50
         """ % (sys.argv[0])
 
 
 
-    def forward_procedure(self, A, B, PI, O):
-        T = len(O)
-        N = len(B)
-        alpha = numpy.zeros((N,  T))
-        C = numpy.zeros(T)
+    def emission_log_probabilities(self, L, O):
+        """Computes the log-probability of every observation under the emission
+        distribution of every state, in a single vectorized call.
 
-        alpha[:,0] = PI * [B[i](O[0]) for i in range(N)]
+        Arguments:
+            L (numpy.array): Parameters of the (shifted) geometric emission distribution of each state.
+            O (numpy.array): Observations (read-counts + 1) at each site.
 
-        C[0] = 1.0/numpy.sum(alpha[:,0])
-        alpha[:,0] = C[0] * alpha[:,0]
+        Returns:
+            numpy.array: (states x T) array of log-emission probabilities.
+        """
+        return scipy.stats.geom.logpmf(O[numpy.newaxis,:], L[:,numpy.newaxis])
 
-        for t in range(1, T):
-            #B[i](O[:,t])  =>  numpy.prod(B[i](O[:,t]))
-            #b_o = numpy.array([numpy.prod(B[i](O[:,t])) for i in range(N)])
-            b_o = [B[i](O[t]) for i in range(N)]
-        
-            alpha[:,t] = numpy.dot(alpha[:,t-1], A) * b_o
-            
-            C[t] = numpy.nan_to_num(1.0/numpy.sum(alpha[:,t]))
-            alpha[:,t] = numpy.nan_to_num(alpha[:,t] * C[t])
-
-            if numpy.sum(alpha[:,t]) == 0:
-                alpha[:,t] = 0.0000000000001
-           
-            text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
-            #print(t, O[:,t], alpha[:,t])
 
-        log_Prob_Obs = - (numpy.sum(numpy.log(C)))
-        return(( log_Prob_Obs, alpha, C ))
 
-    def backward_procedure(self, A, B, PI, O, C=numpy.array([])):
+    def forward_procedure(self, A, B, PI, init=None):
+        """Forward pass of the HMM.
 
-        N = len(B)
-        T = len(O)
-        beta = numpy.zeros((N,T))
+        The emissions are shifted to a maximum of 1 at each site, and the forward
+        probabilities are rescaled to sum to 1 at each site. The (log) shifts and
+        scaling factors are accumulated to obtain the log-likelihood.
 
-        beta[:,T-1] = 1.0
-        if C.any(): beta[:,T-1] = beta[:,T-1] * C[T-1]
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            B (numpy.array): (N x T) log-emission probabilities, see emission_log_probabilities.
+            PI (numpy.array): Initial state distribution.
+            init (numpy.array): Forward probabilities at the site preceding the
+                first one of B, when running over a segment of the genome.
 
-        for t in range(T-2, -1, -1):
-            #B[i](O[:,t])  =>  numpy.prod(B[i](O[:,t]))
-            #b_o = numpy.array([numpy.prod(B[i](O[:,t])) for i in range(N)])
-            b_o = [B[i](O[t]) for i in range(N)]
+        Returns:
+            tuple: (log_Prob_Obs, alpha), with alpha the (N x T) array of the log
+            forward probabilities, normalized at each site.
+        """
+        (N,T) = B.shape
+        A = numpy.exp(A)
+        shift = B.max(0)
+        shift[numpy.isinf(shift)] = 0.0
+        E = numpy.exp(B - shift)
+        alpha = numpy.zeros((N, T))
+        C = numpy.zeros(T)
+        dot = numpy.dot
 
-            beta[:,t] = numpy.nan_to_num(numpy.dot(A, (b_o * beta[:,t+1] ) ))
+        if init is None:
+            a = PI * E[:,0]
+        else:
+            a = dot(init, A) * E[:,0]
+        for t in range(T):
+            if t > 0:
+                a = dot(a, A) * E[:,t]
+            c = a.sum()
+            if c > 0:
+                a /= c
+            else:
+                a = numpy.ones(N)/N
+            alpha[:,t] = a
+            C[t] = c
 
-            if sum(beta[:,t]) == 0:
-                beta[:,t] = 0.0000000000001
+            if self.count%1000==0:
+                text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
+                self.progress_update(text, self.count)
+            self.count+=1
 
-            if C.any():
-                beta[:,t] = beta[:,t] * C[t]
+        with numpy.errstate(divide="ignore"):
+            log_Prob_Obs = numpy.sum(numpy.log(C) + shift)
+            alpha = numpy.log(alpha)
+        return(( log_Prob_Obs, alpha ))
+
+    def backward_procedure(self, A, B, init=None):
+        """Backward pass of the HMM, shifting and rescaling like forward_procedure.
+
+        The backward probability at site t is computed from column t of B. As in
+        the original Tn-HMM implementation, the decoding passes the emissions of
+        the sites themselves; Baum-Welch passes the emissions of the next sites
+        (see expected_counts_segments).
+
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            B (numpy.array): (N x T) log-emission probabilities, see emission_log_probabilities.
+            init (numpy.array): Backward probabilities at the site following the
+                last one of B, when running over a segment of the genome.
+
+        Returns:
+            numpy.array: (N x T) array of the log backward probabilities, normalized at each site.
+        """
+        (N,T) = B.shape
+        A = numpy.exp(A)
+        shift = B.max(0)
+        shift[numpy.isinf(shift)] = 0.0
+        E = numpy.exp(B - shift)
+        beta = numpy.zeros((N, T))
+        dot = numpy.dot
+
+        b = numpy.ones(N)/N
+        if init is None:
+            beta[:,T-1] = b
+            last = T-2
+        else:
+            b = init
+            last = T-1
+        for t in range(last, -1, -1):
+            b = dot(A, E[:,t] * b)
+            c = b.sum()
+            if c > 0:
+                b /= c
+            else:
+                b = numpy.ones(N)/N
+            beta[:,t] = b
 
-            text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
+            if self.count%1000==0:
+                text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
+                self.progress_update(text, self.count)
             self.count+=1
 
-        return(beta)
+        with numpy.errstate(divide="ignore"):
+            return(numpy.log(beta))
+
+    def posterior_probabilities(self, alpha, beta):
+        """Posterior probability of each state at each site.
+
+        Arguments:
+            alpha (numpy.array): (N x T) log forward probabilities, see forward_procedure.
+            beta (numpy.array): (N x T) log backward probabilities, see backward_procedure.
+
+        Returns:
+            numpy.array: (N x T) array of the posterior probabilities (gamma).
+        """
+        gamma = alpha + beta
+        gamma = numpy.exp(gamma - gamma.max(0))
+        return(gamma / gamma.sum(0))
+
+    def baum_welch(self, A, L, O, PI, tol=1e-6, maxiter=50, size=None):
+        """Estimates the parameters of the HMM with the Baum-Welch (EM) algorithm.
+
+        Arguments:
+            A (numpy.array): (N x N) initial log-transition probabilities.
+            L (numpy.array): Initial parameters of the geometric emission distribution of each
+                state. The estimates are capped at 0.99, the default of the essential state.
+            O (numpy.array): Observations (read-counts + 1) at each site.
+            PI (numpy.array): Initial state distribution.
+            tol (float): Stops when the log-likelihood improves by less than this fraction.
+            maxiter (int): Maximum number of iterations.
+            size (int): Number of sites per segment of the E-step (see expected_counts_segments).
+                Default: the whole genome in one segment.
+
+        Returns:
+            tuple: (A, L, PI, loglik), the estimated parameters and the log-likelihood
+            of the observations before the first and after each iteration.
+        """
+        if size is None:
+            size = len(O)
+        (log_Prob_Obs, gamma0, weights, gammaO, xi) = self.expected_counts_segments(A, L, O, PI, size)
+        loglik = [log_Prob_Obs]
+        self.transit_message("EM initial log-likelihood: %1.4f" % log_Prob_Obs)
+        for it in range(1, maxiter+1):
+            start_time = time.time()
+
+            # M-step
+            PI = gamma0
+            with numpy.errstate(divide="ignore"):
+                A = numpy.log(xi / xi.sum(1)[:,numpy.newaxis])
+            update = weights > 0
+            L = L.copy()
+            L[update] = weights[update] / gammaO[update]
+            # Keep every state from excluding insertions (p=1), as the essential state would
+            L = numpy.minimum(L, 0.99)
+
+            (log_Prob_Obs, gamma0, weights, gammaO, xi) = self.expected_counts_segments(A, L, O, PI, size)
+            loglik.append(log_Prob_Obs)
+            self.transit_message("EM iteration %d: log-likelihood = %1.4f (%1.2fs)" % (it, log_Prob_Obs, time.time() - start_time))
+            if log_Prob_Obs - loglik[-2] < tol * abs(loglik[-2]):
+                break
+
+        return((A, L, PI, loglik))
+
+    def expected_counts_segments(self, A, L, O, PI, size):
+        """E-step of Baum-Welch over consecutive segments of the genome, with the
+        checkpointing of posterior_segments: only the sums over the sites of the
+        expected counts are accumulated, so that O(T/size + size) probabilities are kept.
+
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            L (numpy.array): Parameters of the geometric emission distribution of each state.
+            O (numpy.array): Observations (read-counts + 1) at each site.
+            PI (numpy.array): Initial state distribution.
+            size (int): Number of sites per segment.
+
+        Returns:
+            tuple: (log_Prob_Obs, gamma0, weights, gammaO, xi): the log-likelihood of the
+            observations, the posterior probabilities at the first site, the sums over the
+            sites of the posterior probabilities and of the posterior probabilities times the
+            observations, and the (N x N) expected numbers of transitions.
+        """
+        (N, T) = (len(L), len(O))
+        starts = list(range(0, T, size))
+
+        def backward(start, b):
+            # The backward probabilities of Baum-Welch use the emission at the next site,
+            # which is the first one of the next segment at the end of a segment (and a
+            # log-emission of 0 after the last site)
+            B_next = self.emission_log_probabilities(L, O[start+1:start+size+1])
+            if start + size >= T:
+                B_next = numpy.hstack([B_next, numpy.zeros((N, 1))])
+            return self.backward_procedure(A, B_next, b)
+
+        checkpoints = {}
+        b = numpy.ones(N)/N
+        for start in reversed(starts):
+            beta = backward(start, b)
+            b = numpy.exp(beta[:,0])
+            checkpoints[start] = b
+
+        (log_Prob_Obs, weights, gammaO, xi) = (0.0, numpy.zeros(N), numpy.zeros(N), numpy.zeros((N, N)))
+        (a, alpha_last) = (None, None)
+        for start in starts:
+            B = self.emission_log_probabilities(L, O[start:start+size])
+            (log_Prob, alpha) = self.forward_procedure(A, B, PI, a)
+            beta = backward(start, checkpoints.pop(start+size, numpy.ones(N)/N))
+            (gamma, xi_segment) = self.expected_counts(A, B, alpha, beta, alpha_last)
+            if a is None:
+                gamma0 = gamma[:,0]
+            alpha_last = alpha[:,-1]
+            a = numpy.exp(alpha_last)
+            log_Prob_Obs += log_Prob
+            weights += gamma.sum(1)
+            gammaO += numpy.dot(gamma, O[start:start+size])
+            xi += xi_segment
+        return((log_Prob_Obs, gamma0, weights, gammaO, xi))
+
+    def expected_counts(self, A, B, alpha, beta, init=None):
+        """E-step of Baum-Welch: expected state occupancy at each site and expected
+        number of transitions between states, accumulated over all sites at once.
+
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            B (numpy.array): (N x T) log-emission probabilities.
+            alpha (numpy.array): (N x T) log forward probabilities, see forward_procedure.
+            beta (numpy.array): (N x T) log backward probabilities from the emissions of the next
+                sites, see backward_procedure and expected_counts_segments.
+            init (numpy.array): Log forward probabilities at the site preceding the first
+                one of B, when running over a segment of the genome. The transitions from
+                that site are then included in xi.
+
+        Returns:
+            tuple: (gamma, xi), with gamma the (N x T) posterior probabilities and
+            xi the (N x N) expected numbers of transitions.
+        """
+        gamma = self.posterior_probabilities(alpha, beta)
+        if init is not None:
+            N = len(init)
+            (alpha, B, beta) = (numpy.hstack([init[:,numpy.newaxis], alpha]),
+                    numpy.hstack([numpy.zeros((N, 1)), B]), numpy.hstack([numpy.zeros((N, 1)), beta]))
+        # Each column is scaled independently, which cancels out in the normalization
+        P = numpy.exp(alpha[:,:-1] - alpha[:,:-1].max(0))
+        X = B[:,1:] + beta[:,1:]
+        X = numpy.exp(X - X.max(0))
+        trans = numpy.exp(A)
+        norm = numpy.sum(P * numpy.dot(trans, X), 0)
+        xi = trans * numpy.dot(P / norm, X.T)
+        return((gamma, xi))
+
+    def posterior_segments(self, A, L, O, PI, size):
+        """Memory-lean (checkpointed) forward-backward.
+
+        A first backward pass only keeps the backward probabilities at the start
+        of each segment. The forward pass then recomputes the backward
+        probabilities of one segment at a time from the checkpoint of the next
+        segment, so that only O(T/size + size) probabilities are kept.
+
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            L (numpy.array): Parameters of the geometric emission distribution of each state.
+            O (numpy.array): Observations (read-counts + 1) at each site.
+            PI (numpy.array): Initial state distribution.
+            size (int): Number of sites per segment.
+
+        Returns:
+            generator: (start, gamma) for consecutive segments, in order, with gamma
+            the (N x size) posterior probabilities of the sites of the segment.
+        """
+        starts = list(range(0, len(O), size))
+        checkpoints = {}
+        b = None
+        for start in reversed(starts):
+            beta = self.backward_procedure(A, self.emission_log_probabilities(L, O[start:start+size]), b)
+            b = numpy.exp(beta[:,0])
+            checkpoints[start] = b
+
+        a = None
+        for start in starts:
+            B = self.emission_log_probabilities(L, O[start:start+size])
+            (log_Prob_Obs, alpha) = self.forward_procedure(A, B, PI, a)
+            a = numpy.exp(alpha[:,-1])
+            beta = self.backward_procedure(A, B, checkpoints.pop(start+size, None))
+            yield (start, self.posterior_probabilities(alpha, beta))
+
+
+
+    def viterbi(self, A, B, PI):
+        """Most likely sequence of states, computed in log space.
+
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            B (numpy.array): (N x T) log-emission probabilities, see emission_log_probabilities.
+            PI (numpy.array): Initial state distribution.
+
+        Returns:
+            tuple: (Q_opt, delta, Q), with Q_opt the array of most likely states,
+            delta the (N x T) log-probabilities of the best paths ending in each
+            state and Q the (N x T) back-pointers.
+        """
+        (N,T) = B.shape
+        delta = numpy.zeros((N, T))
+        Q = numpy.zeros((N, T), dtype=numpy.uint8)
+
+        with numpy.errstate(divide="ignore"):
+            delta[:,0] = numpy.log(PI) + B[:,0]
+        self.viterbi_recursion(A, B[:,1:], delta[:,0], Q[:,1:], delta[:,1:])
+        Q_opt = self.viterbi_backtrack(Q, numpy.argmax(delta[:,T-1]))
+        return((Q_opt, delta, Q))
 
+    def viterbi_lean(self, A, L, O, PI, size):
+        """Memory-lean Viterbi decoding: the emissions are computed one segment at
+        a time, and only the back-pointers are kept for all sites.
 
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            L (numpy.array): Parameters of the geometric emission distribution of each state.
+            O (numpy.array): Observations (read-counts + 1) at each site.
+            PI (numpy.array): Initial state distribution.
+            size (int): Number of sites per segment.
 
-    def viterbi(self, A, B, PI, O):
-        N=len(B)
+        Returns:
+            numpy.array: Most likely state at each site.
+        """
         T = len(O)
-        delta = numpy.zeros((N, T))
-
-        b_o = [B[i](O[0]) for i in range(N)]
-        delta[:,0] = numpy.log(PI) + numpy.log(b_o)
+        Q = numpy.zeros((len(L), T), dtype=numpy.uint8)
+        d = None
+        for start in range(0, T, size):
+            B = self.emission_log_probabilities(L, O[start:start+size])
+            if d is None:
+                with numpy.errstate(divide="ignore"):
+                    d = numpy.log(PI) + B[:,0]
+                d = self.viterbi_recursion(A, B[:,1:], d, Q[:,1:size])
+            else:
+                d = self.viterbi_recursion(A, B, d, Q[:,start:start+size])
+        return(self.viterbi_backtrack(Q, numpy.argmax(d)))
+
+    def viterbi_recursion(self, A, B, d, Q, delta=None):
+        """Runs the Viterbi recursion over the sites of B.
+
+        Arguments:
+            A (numpy.array): (N x N) log-transition probabilities.
+            B (numpy.array): (N x T) log-emission probabilities.
+            d (numpy.array): Log-probabilities of the best paths ending in each state at the preceding site.
+            Q (numpy.array): (N x T) array where the back-pointers are stored.
+            delta (numpy.array): Optional (N x T) array where the log-probabilities of the best paths are stored.
+
+        Returns:
+            numpy.array: Log-probabilities of the best paths ending in each state at the last site.
+        """
+        states = numpy.arange(len(d))
+        for t in range(B.shape[1]):
+            nus = d + A
+            q = nus.argmax(1)
+            d = nus[states, q] + B[:,t]
+            Q[:,t] = q
+            if delta is not None:
+                delta[:,t] = d
+            if self.count%1000==0:
+                text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
+                self.progress_update(text, self.count)
+            self.count+=1
+        return(d)
 
-        Q = numpy.zeros((N, T), dtype=int)
+    def viterbi_backtrack(self, Q, last):
+        """Follows the back-pointers from the given state at the last site.
 
-        numpy.seterr(divide='ignore')
-        for t in range(1, T):
-            b_o = [B[i](O[t]) for i in range(N)]
-            #nus = delta[:, t-1] + numpy.log(A)
-            nus = delta[:, t-1] + A
-            delta[:,t] = nus.max(1) + numpy.log(b_o)
-            Q[:,t] = nus.argmax(1)
-            text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
+        Arguments:
+            Q (numpy.array): (N x T) back-pointers, see viterbi_recursion.
+            last (int): State at the last site.
 
-        Q_opt = [int(numpy.argmax(delta[:,T-1]))]
+        Returns:
+            numpy.array: Most likely state at each site.
+        """
+        T = Q.shape[1]
+        Q_opt = numpy.zeros(T, dtype=Q.dtype)
+        Q_opt[T-1] = last
         for t in range(T-2, -1, -1):
-            Q_opt.insert(0, Q[Q_opt[0],t+1])
-
-            text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
+            Q_opt[t] = Q[Q_opt[t+1],t+1]
 
-        numpy.seterr(divide='warn')
+        self.count += T-1
         text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
         self.progress_update(text, self.count)
-
-        return((Q_opt, delta, Q))
+        return(Q_opt)
 
 
     def calculate_pins(self, reads):
-        non_ess_reads = []
-        temp = []
-        for rd in reads:
-
-            if rd >=1:
-                if len(temp) < 10: non_ess_reads.extend(temp)
-                non_ess_reads.append(rd)
-                temp = []
-            else:
-                temp.append(rd)
+        """Estimates the probability of insertion in non-essential regions, i.e.
+        ignoring runs of 10 or more sites without insertions (and trailing sites).
 
-        return(sum([1 for rd in non_ess_reads if rd >= 1])/float(len(non_ess_reads)) )
+        Arguments:
+            reads (numpy.array): Read-counts at each site.
 
+        Returns:
+            float: Fraction of sites with insertions, outside long runs of non-insertions.
+        """
+        ins = numpy.flatnonzero(reads >= 1)
+        # Number of non-insertion sites preceding each insertion
+        gaps = numpy.diff(ins, prepend=-1) - 1
+        return(len(ins)/float(len(ins) + numpy.sum(gaps[gaps < 10])))
 
 
-    def post_process_genes(self, data, position, states, output_path):
 
+    def post_process_genes(self, data, position, states, output_path):
+        """Writes the gene-level output: number of sites in each state, saturation,
+        mean of the non-zero read-counts and state call for every gene.
+
+        Arguments:
+            data (numpy.array): (K x T) read-counts.
+            position (numpy.array): Coordinates of the sites.
+            states (numpy.array): Most likely state at each site.
+            output_path (str): Path of the output file.
+        """
         output = open(output_path, "w")
-        pos2state = dict([(position[t],states[t]) for t in range(len(states))])
-        theta = numpy.mean(data > 0)
-        G = tnseq_tools.Genes(self.ctrldata, self.annotation_path, data=data, position=position, ignoreCodon=False, nterm=self.NTerminus, cterm=self.CTerminus)
+        (orfs, site, gene) = tnseq_tools.gene_site_index(self.annotation_path, position, nterm=self.NTerminus, cterm=self.CTerminus)
+        orf2info = tnseq_tools.get_gene_info(self.annotation_path)
+        G = len(orfs)
 
         num2label = {0:"ES", 1:"GD", 2:"NE", 3:"GA"}
+        Nstates = len(num2label)
         output.write("#HMM - Genes\n")        
 
-        lines,counts = [],{}
-        for gene in G:
-            
-            reads_nz = [c for c in gene.reads.flatten() if c > 0]
-            avg_read_nz = 0
-            if len(reads_nz) > 0:
-                avg_read_nz = numpy.average(reads_nz)
-
-            # State
-            genestates = [pos2state[p] for p in gene.position]
-            statedist = {}
-            for st in genestates:
-                if st not in statedist: statedist[st] = 0
-                statedist[st] +=1
-
-            # State counts
-            n0 = statedist.get(0, 0); n1 = statedist.get(1, 0);
-            n2 = statedist.get(2, 0); n3 = statedist.get(3, 0);
+        # Counts below one read are ignored, as in tnseq_tools.Genes
+        data = numpy.where(data >= 1, data, 0)
+        nz = (data > 0)
+        n = numpy.bincount(gene, minlength=G)
+        k = numpy.bincount(gene, weights=numpy.any(nz, 0)[site], minlength=G)
+        sum_nz = numpy.bincount(gene, weights=data.sum(0)[site], minlength=G)
+        count_nz = numpy.bincount(gene, weights=nz.sum(0)[site], minlength=G)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            theta = numpy.where(n > 0, k / n, 0.0)
+            avg_read_nz = numpy.where(count_nz > 0, sum_nz / count_nz, 0.0)
+
+        # State counts
+        statedist = numpy.bincount(gene*Nstates + numpy.asarray(states)[site], minlength=G*Nstates).reshape(G, Nstates)
+        # Most frequent state, with ties going to the last state
+        call = Nstates - 1 - numpy.argmax(statedist[:,::-1], 1)
 
-
-            if gene.n > 0:
+        lines,counts = [],{}
+        for g in range(G):
+            orf = orfs[g]
+            name,desc = orf2info.get(orf, ["", "", 0, 0, "+"])[:2]
+            (n0, n1, n2, n3) = statedist[g]
+            if n[g] > 0:
                 # this was intended to call genes ES if have sufficiently long run, but n0 (#ES) not even consecutive
-                #E = tnseq_tools.ExpectedRuns(gene.n,   1.0 - theta)
-                #V = tnseq_tools.VarR(gene.n,   1.0 - theta)
-                if n0 == gene.n: S = "ES"
-                #elif n0 >= int(E+(3*math.sqrt(V))): S = "ES"
-                else:
-                    temp = max([(statedist.get(s, 0), s) for s in [0, 1, 2, 3]])[1]
-                    S = num2label[temp]
+                if n0 == n[g]: S = "ES"
+                else: S = num2label[call[g]]
             else:
-                E = 0.0
-                V = 0.0
                 S = "N/A"
-            lines.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%1.4f\t%1.2f\t%s\n" % (gene.orf, gene.name, gene.desc, gene.n, n0, n1, n2, n3, gene.theta(), avg_read_nz, S))
+            lines.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%1.4f\t%1.2f\t%s\n" % (orf, name, desc, n[g], n0, n1, n2, n3, theta[g], avg_read_nz[g], S))
             if S not in counts: counts[S] = 0
             counts[S] += 1
 
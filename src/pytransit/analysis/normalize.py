@@ -76,7 +76,9 @@ class NormalizeMethod(base.SingleConditionMethod):
     Norm
 
     """
-    def __init__(self,infile,outfile,normalization):
+    def __init__(self,infile,outfile,normalization,stream=False,chunksize=100000):
+                self.stream = stream
+                self.chunksize = chunksize
                 ctrldata=[infile]
                 annotation_path=""
                 output_file=outfile
@@ -105,8 +107,12 @@ class NormalizeMethod(base.SingleConditionMethod):
             self.outfile = args[1] # if no arg give, could print to screen
         self.normalization = kwargs.get("n", "TTR") # check if it is a legal method name
         self.combined_wig = isCombinedWig
+        stream = kwargs.get("-stream", False)
+        chunksize = int(kwargs.get("-chunk_size", 100000))
+        if stream and not isCombinedWig:
+            raise base.InvalidArgumentException("--stream is only supported for combined wig files (-c)")
 
-        return self(self.infile,self.outfile,self.normalization)
+        return self(self.infile,self.outfile,self.normalization,stream=stream,chunksize=chunksize)
 
     def Run(self):
 
@@ -121,9 +127,15 @@ class NormalizeMethod(base.SingleConditionMethod):
         for line in open(infile):
           if line.startswith("variableStep"): line2 = line.rstrip(); break
 
+        if self.combined_wig==True and self.stream:
+            self.write_streaming(infile, outputPath)
+            self.finish()
+            self.transit_message("Finished Normalization")
+            return
+
         if self.combined_wig==True: (sites,data,files) = tnseq_tools.read_combined_wig(self.ctrldata[0])
         else: (data, sites) = tnseq_tools.get_data(self.ctrldata)
-        (data,factors) = norm_tools.normalize_data(data,self.normalization)
+        (data,factors) = norm_tools.normalize_data(data,self.normalization, inplace=True)
 
         print("writing",outputPath)
         file = open(outputPath,"w")
@@ -140,6 +152,24 @@ class NormalizeMethod(base.SingleConditionMethod):
         self.finish()
         self.transit_message("Finished Normalization")
 
+    def write_streaming(self, infile, outputPath):
+        """Normalizes a combined wig without loading it into memory: a first pass
+        accumulates per-dataset count histograms to get the factors, and a
+        second pass scales and writes the sites one block at a time."""
+        files = tnseq_tools.read_combined_wig_filenames(infile)
+        self.transit_message("Computing %s factors (streaming, %d sites per block)" % (self.normalization, self.chunksize))
+        chunks = (data for (sites, data) in tnseq_tools.read_combined_wig_chunks(infile, self.chunksize))
+        factors = norm_tools.streaming_factors(chunks, self.normalization)
+
+        print("writing",outputPath)
+        file = open(outputPath,"w")
+        file.write("# %s normalization of %s\n" % (self.normalization,infile))
+        for f in files: file.write("#File: %s\n" % f)
+        for (sites, data) in tnseq_tools.read_combined_wig_chunks(infile, self.chunksize):
+            data *= factors
+            for i in range(len(sites)): file.write('\t'.join([str(sites[i])]+["%0.1f" % x for x in list(data[...,i])])+"\n")
+        file.close()
+
     @classmethod
     def usage_string(self):
         return """
@@ -151,6 +181,10 @@ python3 %s normalize -c <input combined_wig> <output.wig> [-n TTR|betageom]
 
         Optional Arguments:
         -n <string>     :=  Normalization method. Default: -n TTR
+        --stream        :=  For combined wig files (-c), normalize in two passes over the file, one block of
+                            sites at a time, instead of loading the whole matrix into memory.
+                            Supported for -n TTR, nzmean, totreads and nonorm.
+        --chunk_size <int> := Number of sites per block in streaming mode. Default: --chunk_size 100000
         """ % (sys.argv[0], sys.argv[0])
 
 
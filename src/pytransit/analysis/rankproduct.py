@@ -108,6 +108,8 @@ class RankProductGUI(base.AnalysisGUI):
 
 ########## CLASS #######################
 
+# Maximum number of null rank products generated at a time
+PERMUTATION_BATCH = 1000000
 class RankProductMethod(base.DualConditionMethod):
     """   
     rankproduct
@@ -248,7 +250,7 @@ class RankProductMethod(base.DualConditionMethod):
         if self.normalization != "none":
             self.transit_message("Normalizing using: %s" % self.normalization)
 
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata+self.expdata, self.annotation_path)           
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata+self.expdata, self.annotation_path, inplace=True)           
          
 
         Gctrl= tnseq_tools.Genes(self.ctrldata + self.expdata, self.annotation_path, ignoreCodon=self.ignoreCodon, nterm=self.NTerminus, cterm=self.CTerminus, data=data[:Kctrl,:], position=position)
@@ -282,11 +284,8 @@ class RankProductMethod(base.DualConditionMethod):
         obsRP = numpy.power(numpy.prod(rank,0), 1.0/Kctrl)
 
 
-        permutations = numpy.zeros((self.samples, Ngenes))
-        tempranks = scipy.array([numpy.arange(1,Ngenes+1) for rep in range(Kctrl)])
-        for s in range(self.samples):
-            rankperm = numpy.array([numpy.random.permutation(tr) for tr in tempranks])
-            permutations[s] = numpy.power(numpy.prod(rankperm,0), 1.0/Kctrl)
+        self.transit_message("Sampling null rank products")
+        null_counts = self.null_counts(obsRP, Kctrl)
 
         rankRP = numpy.argsort(obsRP) + 1
 
@@ -302,7 +301,7 @@ class RankProductMethod(base.DualConditionMethod):
             meanctrl = numpy.mean(Gctrl[i].reads)
             meanexp = numpy.mean(Gexp[i].reads)
             log2fc = numpy.log2((meanexp+0.0001)/(meanctrl+0.0001))
-            countbetter = numpy.sum(permutations <= obsRP[i])
+            countbetter = null_counts[i]
             
             pval = countbetter/float(self.samples*Ngenes)
             e_val = countbetter/float(self.samples)
@@ -348,6 +347,41 @@ class RankProductMethod(base.DualConditionMethod):
         self.transit_message("Finished rankproduct Method") 
 
 
+    def null_counts(self, obsRP, K):
+        """Counts the null rank products that are smaller or equal to each observed rank product.
+
+        The null rank products come from random permutations of the ranks of
+        the genes in each of the K replicates. They are generated in batches of
+        at most PERMUTATION_BATCH values, and each batch is added to a
+        histogram over the sorted observed rank products
+        (numpy.searchsorted), so the samples x genes matrix of permutations is
+        never kept in memory.
+
+        Arguments:
+            obsRP (numpy.array): Observed rank product of each gene.
+            K (int): Number of replicates whose ranks are multiplied.
+
+        Returns:
+            numpy.array: Number of null rank products <= obsRP, for each gene.
+        """
+        Ngenes = len(obsRP)
+        order = numpy.argsort(obsRP)
+        sortedRP = obsRP[order]
+        # hist[j]: null rank products above sortedRP[j-1] and <= sortedRP[j]
+        hist = numpy.zeros(Ngenes+1, dtype=int)
+        tempranks = numpy.array([numpy.arange(1,Ngenes+1) for rep in range(K)])
+        batch = max(1, PERMUTATION_BATCH // max(Ngenes, 1))
+        for first in range(0, self.samples, batch):
+            permutations = numpy.zeros((min(batch, self.samples - first), Ngenes))
+            for s in range(len(permutations)):
+                rankperm = numpy.array([numpy.random.permutation(tr) for tr in tempranks])
+                permutations[s] = numpy.power(numpy.prod(rankperm,0), 1.0/K)
+            hist += numpy.bincount(numpy.searchsorted(sortedRP, permutations.ravel(), side="left"), minlength=Ngenes+1)
+        counts = numpy.zeros(Ngenes, dtype=int)
+        counts[order] = numpy.cumsum(hist)[:Ngenes]
+        return counts
+
+
     @classmethod
     def usage_string(self):
         return """python3 %s rankproduct <comma-separated .wig control files> <comma-separated .wig experimental files> <annotation .prot_table or GFF3> <output file> [Optional Arguments]
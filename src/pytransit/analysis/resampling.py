@@ -23,6 +23,7 @@ import random
 import numpy
 import scipy.stats
 import datetime
+import multiprocessing
 
 from pytransit.analysis import base
 import pytransit
@@ -216,7 +217,8 @@ class ResamplingMethod(base.DualConditionMethod):
                 CTerminus=0.0,
                 ctrl_lib_str="",
                 exp_lib_str="",
-                wxobj=None, Z = False, diffStrains = False, annotation_path_exp = "", combinedWigParams = None):
+                wxobj=None, Z = False, diffStrains = False, annotation_path_exp = "", combinedWigParams = None,
+                nprocs=1, seed=None, sequential=False, alpha=0.05, resume=False):
 
         base.DualConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, expdata, annotation_path, output_file, normalization=normalization, replicates=replicates, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
@@ -231,6 +233,11 @@ class ResamplingMethod(base.DualConditionMethod):
         self.diffStrains = diffStrains
         self.annotation_path_exp = annotation_path_exp if diffStrains else annotation_path
         self.combinedWigParams = combinedWigParams
+        self.nprocs = max(1, int(nprocs))
+        self.seed = seed
+        self.sequential = sequential
+        self.alpha = alpha
+        self.resume = resume
 
     @classmethod
     def fromGUI(self, wxobj):
@@ -354,11 +361,11 @@ class ResamplingMethod(base.DualConditionMethod):
         output_file = open(output_path, "w")
 
         # check for unrecognized flags
-        flags = "-c -s -n -h -a -ez -PC -l -iN -iC --ctrl_lib --exp_lib -Z".split()
+        flags = "-c -s -n -h -a -ez -PC -l -iN -iC --ctrl_lib --exp_lib -Z -j --seed --sequential --alpha --resume".split()
         for arg in rawargs:
           if arg[0]=='-' and arg not in flags:
             self.transit_error("flag unrecognized: %s" % arg)
-            print(ZinbMethod.usage_string())
+            print(self.usage_string())
             sys.exit(0)
 
         normalization = kwargs.get("n", "TTR")
@@ -379,6 +386,11 @@ class ResamplingMethod(base.DualConditionMethod):
         CTerminus = float(kwargs.get("iC", 0.00))
         ctrl_lib_str = kwargs.get("-ctrl_lib", "")
         exp_lib_str = kwargs.get("-exp_lib", "")
+        nprocs = int(kwargs.get("j", 1))
+        seed = int(kwargs["-seed"]) if "-seed" in kwargs else None
+        sequential = kwargs.get("-sequential", False)
+        alpha = float(kwargs.get("-alpha", 0.05))
+        resume = kwargs.get("-resume", False)
 
         return self(ctrldata,
                 expdata,
@@ -396,14 +408,15 @@ class ResamplingMethod(base.DualConditionMethod):
                 NTerminus,
                 CTerminus,
                 ctrl_lib_str,
-                exp_lib_str, Z = Z, diffStrains = diffStrains, annotation_path_exp = annotationPathExp, combinedWigParams = combinedWigParams)
+                exp_lib_str, Z = Z, diffStrains = diffStrains, annotation_path_exp = annotationPathExp, combinedWigParams = combinedWigParams,
+                nprocs = nprocs, seed = seed, sequential = sequential, alpha = alpha, resume = resume)
 
     def preprocess_data(self, position, data):
         (K,N) = data.shape
 
         if self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata+self.expdata, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata+self.expdata, self.annotation_path, inplace=True)
 
         if self.LOESS:
             self.transit_message("Performing LOESS Correction")
@@ -516,6 +529,10 @@ class ResamplingMethod(base.DualConditionMethod):
         (data, qval) = self.run_resampling(G_ctrl, G_exp, doLibraryResampling, histPath)
         self.write_output(data, qval, start_time)
 
+        if self.doHistogram:
+            self.transit_message("Rendering histograms to %s" % histPath)
+            render_histograms(histPath, nprocs=self.nprocs)
+
         self.finish()
         self.transit_message("Finished resampling Method")
 
@@ -530,7 +547,7 @@ class ResamplingMethod(base.DualConditionMethod):
             self.output.write("#GUI with: norm=%s, samples=%s, pseudocounts=%1.2f, adaptive=%s, histogram=%s, includeZeros=%s, output=%s\n" % (self.normalization, self.samples, self.pseudocount, self.adaptive, self.doHistogram, self.includeZeros, self.output.name.encode('utf-8')))
         else:
             self.output.write("#Console: python3 %s\n" % " ".join(sys.argv))
-        self.output.write("#Parameters: samples=%s, norm=%s, histograms=%s, adaptive=%s, excludeZeros=%s, pseudocounts=%s, LOESS=%s, trim_Nterm=%s, trim_Cterm=%s\n" % (self.samples,self.normalization, self.doHistogram, self.adaptive,not self.includeZeros,self.pseudocount,self.LOESS,self.NTerminus,self.CTerminus))
+        self.output.write("#Parameters: samples=%s, norm=%s, histograms=%s, adaptive=%s, excludeZeros=%s, pseudocounts=%s, LOESS=%s, trim_Nterm=%s, trim_Cterm=%s, seed=%s, sequential=%s, alpha=%s\n" % (self.samples,self.normalization, self.doHistogram, self.adaptive,not self.includeZeros,self.pseudocount,self.LOESS,self.NTerminus,self.CTerminus,self.seed,self.sequential,self.alpha))
         self.output.write("#Control Data: %s\n" % (",".join(self.ctrldata).encode('utf-8')))
         self.output.write("#Experimental Data: %s\n" % (",".join(self.expdata).encode('utf-8')))
         self.output.write("#Annotation path: %s %s\n" % (self.annotation_path.encode('utf-8'), self.annotation_path_exp.encode('utf-8') if self.diffStrains else ''))
@@ -538,30 +555,42 @@ class ResamplingMethod(base.DualConditionMethod):
         #Z = True # include Z-score column in resampling output?
         global columns # consider redefining columns above (for GUI)
         if self.Z==True: columns = ["Orf","Name","Desc","Sites","Mean Ctrl","Mean Exp","log2FC", "Sum Ctrl", "Sum Exp", "Delta Mean","p-value","Z-score","Adj. p-value"]
-        self.output.write("#%s\n" % "\t".join(columns))
+        header = list(columns)
+        if self.sequential: header.insert(header.index("p-value"), "Permutations")
+        self.output.write("#%s\n" % "\t".join(header))
 
         for i,row in enumerate(data):
-            (orf, name, desc, n, mean1, mean2, sum1, sum2, test_obs, log2FC, pval_2tail) = row
+            (orf, name, desc, n, mean1, mean2, sum1, sum2, test_obs, log2FC, nperm, pval_2tail) = row
+            delta = "%1.1f" % test_obs
+            if self.sequential: delta += "\t%d" % nperm
             if self.Z==True:
               p = pval_2tail/2 # convert from 2-sided back to 1-sided
               if p==0: p = 1e-5 # or 1 level deeper the num of iterations of resampling, which is 1e-4=1/10000, by default
               if p==1: p = 1-1e-5
               z = scipy.stats.norm.ppf(p)
               if log2FC>0: z *= -1
-              self.output.write("%s\t%s\t%s\t%d\t%1.1f\t%1.1f\t%1.2f\t%1.1f\t%1.2f\t%1.1f\t%1.5f\t%0.2f\t%1.5f\n" % (orf, name, desc, n, mean1, mean2, log2FC, sum1, sum2, test_obs, pval_2tail, z, qval[i]))
-            else: self.output.write("%s\t%s\t%s\t%d\t%1.1f\t%1.1f\t%1.2f\t%1.1f\t%1.2f\t%1.1f\t%1.5f\t%1.5f\n" % (orf, name, desc, n, mean1, mean2, log2FC, sum1, sum2, test_obs, pval_2tail, qval[i]))
+              self.output.write("%s\t%s\t%s\t%d\t%1.1f\t%1.1f\t%1.2f\t%1.1f\t%1.2f\t%s\t%1.5f\t%0.2f\t%1.5f\n" % (orf, name, desc, n, mean1, mean2, log2FC, sum1, sum2, delta, pval_2tail, z, qval[i]))
+            else: self.output.write("%s\t%s\t%s\t%d\t%1.1f\t%1.1f\t%1.2f\t%1.1f\t%1.2f\t%s\t%1.5f\t%1.5f\n" % (orf, name, desc, n, mean1, mean2, log2FC, sum1, sum2, delta, pval_2tail, qval[i]))
         self.output.close()
 
         self.transit_message("Adding File: %s" % (self.output.name))
         self.add_file(filetype="Resampling")
 
     def run_resampling(self, G_ctrl, G_exp = None, doLibraryResampling = False, histPath = ""):
-        data = []
         N = len(G_ctrl)
-        count = 0
         self.progress_range(N)
 
-        for gene in G_ctrl:
+        if self.seed is None and self.resume:
+            # Reuse the seed of the interrupted run, so resumed genes get the same permutations
+            saved = transit_tools.ResultCheckpoint.load_parameters(self.output.name)
+            if saved: self.seed = saved.get("seed")
+        if self.seed is None:
+            self.seed = int(numpy.random.randint(0, 2**31-1))
+
+        # Validate all genes and collect the flattened counts before resampling,
+        # so the genes can be farmed out to worker processes.
+        genes = []
+        for i,gene in enumerate(G_ctrl):
             if gene.orf not in G_exp:
                 if self.diffStrains:
                     continue
@@ -571,7 +600,6 @@ class ResamplingMethod(base.DualConditionMethod):
                     return ([], [])
 
             gene_exp = G_exp[gene.orf]
-            count+=1
 
             if not self.diffStrains and gene.n != gene_exp.n:
                 self.transit_error("Error: No. of TA sites in Exp and Ctrl data are different")
@@ -579,7 +607,7 @@ class ResamplingMethod(base.DualConditionMethod):
                 return ([], [])
 
             if (gene.k == 0 and gene_exp.k == 0) or gene.n == 0 or gene_exp.n == 0:
-                (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist, data1, data2) = (0, 0, 0, 0, 1.00, 1.00, 1.00, [], [0], [0])
+                (data1, data2) = (None, None)
             else:
                 if not self.includeZeros:
                     ii_ctrl = numpy.sum(gene.reads,0) > 0
@@ -591,39 +619,61 @@ class ResamplingMethod(base.DualConditionMethod):
                 #data1 = gene.reads[:,ii_ctrl].flatten() + self.pseudocount # we used to have an option to add pseudocounts to each observation, like this
                 data1 = gene.reads[:,ii_ctrl].flatten() 
                 data2 = gene_exp.reads[:,ii_exp].flatten()
+            genes.append((gene, i, data1, data2))
 
-                if doLibraryResampling:
-                    (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  stat_tools.resampling(data1, data2, S=self.samples, testFunc=stat_tools.F_mean_diff_dict, permFunc=stat_tools.F_shuffle_dict_libraries, adaptive=self.adaptive, lib_str1=self.ctrl_lib_str, lib_str2=self.exp_lib_str,PC=self.pseudocount)
-                else:
-                    (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  stat_tools.resampling(data1, data2, S=self.samples, testFunc=stat_tools.F_mean_diff_flat, permFunc=stat_tools.F_shuffle_flat, adaptive=self.adaptive, lib_str1=self.ctrl_lib_str, lib_str2=self.exp_lib_str,PC=self.pseudocount)
-
-
-            if self.doHistogram:
-                import matplotlib.pyplot as plt
-                if testlist:
-                    n, bins, patches = plt.hist(testlist, density=1, facecolor='c', alpha=0.75, bins=100)
-                else:
-                    n, bins, patches = plt.hist([0,0], density=1, facecolor='c', alpha=0.75, bins=100)
-                plt.xlabel('Delta Mean')
-                plt.ylabel('Probability')
-                plt.title('%s - Histogram of Delta Mean' % gene.orf)
-                plt.axvline(test_obs, color='r', linestyle='dashed', linewidth=3)
-                plt.grid(True)
-                genePath = os.path.join(histPath, gene.orf +".png")
-                if not os.path.exists(histPath):
-                    os.makedirs(histPath)
-                plt.savefig(genePath)
-                plt.clf()
-
-
-            sum1 = numpy.sum(data1)
-            sum2 = numpy.sum(data2)
-            data.append([gene.orf, gene.name, gene.desc, gene.n, mean1, mean2, sum1, sum2, test_obs, log2FC, pval_2tail])
-
-            # Update progress
-            text = "Running Resampling Method... %5.1f%%" % (100.0*count/N)
-            self.progress_update(text, count)
+        params = {"samples": self.samples, "adaptive": self.adaptive, "pseudocount": self.pseudocount,
+                "ctrl_lib_str": self.ctrl_lib_str, "exp_lib_str": self.exp_lib_str,
+                "doLibraryResampling": doLibraryResampling, "doHistogram": self.doHistogram, "seed": self.seed,
+                "sequential": self.sequential, "alpha": self.alpha}
+        try:
+            checkpoint = transit_tools.ResultCheckpoint(self.output.name, self.checkpoint_parameters(), resume=self.resume)
+        except ValueError as e:
+            self.transit_error(str(e))
+            return ([], [])
+        if len(checkpoint):
+            self.transit_message("Resuming: %d genes already done" % len(checkpoint))
+        count = len(checkpoint)
+        pending = [x for x in genes if x[1] not in checkpoint]
+        histograms = None
+        if self.doHistogram:
+            histograms = HistogramStore(histPath, append=len(checkpoint) > 0)
+        tasks = ((i, data1, data2, params) for (gene, i, data1, data2) in pending)
+
+        pool = None
+        if self.nprocs > 1 and len(pending) > 1:
+            self.transit_message("Resampling genes using %d processes" % self.nprocs)
+            pool = multiprocessing.Pool(self.nprocs)
+            results = pool.imap(resample_gene, tasks, chunksize=max(1, min(64, len(pending) // (4*self.nprocs))))
+        else:
+            results = map(resample_gene, tasks)
 
+        try:
+            for ((gene, i, data1, data2), result) in zip(pending, results):
+                count+=1
+                (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, hist, nperm) = result
+                if data1 is None:
+                    (data1, data2) = ([0], [0])
+
+                # Only the binned statistics are kept; the images are drawn after the run
+                if histograms:
+                    histograms.add(gene.orf, test_obs, *hist)
+
+                sum1 = numpy.sum(data1)
+                sum2 = numpy.sum(data2)
+                checkpoint.add(i, [gene.orf, gene.name, gene.desc, gene.n, mean1, mean2, sum1, sum2, test_obs, log2FC, nperm, pval_2tail])
+
+                # Update progress
+                text = "Running Resampling Method... %5.1f%%" % (100.0*count/N)
+                self.progress_update(text, count)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if histograms:
+                histograms.close()
+
+        data = [checkpoint[i] for (gene, i, data1, data2) in genes]
+        checkpoint.close()
 
         #
         self.transit_message("") # Printing empty line to flush stdout
@@ -633,6 +683,15 @@ class ResamplingMethod(base.DualConditionMethod):
 
         return (data, qval)
 
+    def checkpoint_parameters(self):
+        """Returns the parameters that must match to resume an interrupted run."""
+        return {"method": short_name, "ctrldata": self.ctrldata, "expdata": self.expdata,
+                "annotation": [self.annotation_path, self.annotation_path_exp], "combinedWigParams": self.combinedWigParams,
+                "normalization": self.normalization, "samples": self.samples, "adaptive": self.adaptive,
+                "includeZeros": self.includeZeros, "pseudocount": self.pseudocount, "LOESS": self.LOESS,
+                "NTerminus": self.NTerminus, "CTerminus": self.CTerminus, "ctrl_lib_str": self.ctrl_lib_str,
+                "exp_lib_str": self.exp_lib_str, "seed": self.seed, "sequential": self.sequential, "alpha": self.alpha}
+
     @classmethod
     def usage_string(self):
         return """
@@ -662,9 +721,150 @@ class ResamplingMethod(base.DualConditionMethod):
         --exp_lib       :=  String of letters representing library of experimental files in order
                             e.g. 'ABAB'. Default empty. Letters used must also be used in --ctrl_lib
                             If non-empty, resampling will limit permutations to within-libraries.
+        --sequential    :=  Stop resampling each gene as soon as its p-value is known to be above --alpha
+                            (Besag-Clifford sequential p-values). Significant genes still use all samples.
+                            Adds a column with the number of permutations used per gene. Default: Turned Off.
+        --alpha <float> :=  Significance level for --sequential. Default: --alpha 0.05
+        -j <int>        :=  Number of worker processes used to resample genes in parallel. Default: -j 1
+        --seed <int>    :=  Seed for the permutations. Results for a given seed do not depend on -j.
+                            Default: drawn at random (and reported in the output header).
+        --resume        :=  Resume an interrupted run with the same arguments, skipping the genes
+                            already saved in <output file>.checkpoint.
 
         """ % (sys.argv[0], sys.argv[0])
 
+def resample_gene(task):
+    """Runs the resampling test for a single gene.
+
+    The permutations are drawn from a RandomState seeded with (seed, gene index),
+    so the result for a gene depends only on the master seed and not on the
+    number of processes or the order in which genes are processed.
+
+    Arguments:
+        task (tuple): (gene index, ctrl counts, exp counts, parameters dict). The
+            counts are None for genes that are not tested.
+
+    Returns:
+        tuple: (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail, pval_2tail, hist, nperm).
+            hist is the histogram of the permutation statistics as (counts, lo, hi)
+            (see histogram_counts) if histograms were requested, and None otherwise.
+            nperm is the number of permutations performed.
+    """
+    (i, data1, data2, params) = task
+    if data1 is None:
+        hist = histogram_counts([]) if params["doHistogram"] else None
+        return (0, 0, 0, 0, 1.00, 1.00, 1.00, hist, 0)
+
+    rng = numpy.random.RandomState([params["seed"], i])
+    if params["doLibraryResampling"]:
+        testFunc, permFunc = stat_tools.F_mean_diff_dict, stat_tools.F_shuffle_dict_libraries
+    else:
+        testFunc, permFunc = stat_tools.F_mean_diff_flat, stat_tools.F_shuffle_flat
+    result = stat_tools.resampling(data1, data2, S=params["samples"], testFunc=testFunc, permFunc=permFunc,
+            adaptive=params["adaptive"], lib_str1=params["ctrl_lib_str"], lib_str2=params["exp_lib_str"],
+            PC=params["pseudocount"], rng=rng, sequential=params["sequential"], alpha=params["alpha"])
+    hist = histogram_counts(result[-1]) if params["doHistogram"] else None
+    return result[:-1] + (hist, len(result[-1]))
+
+
+def histogram_counts(test_list, bins=100):
+    """Bins the permutation statistics of a gene into equal-width bins.
+
+    Returns:
+        tuple: (counts, lo, hi) where counts has one entry per bin and the bins
+            evenly divide [lo, hi]. An empty list is binned like [0, 0].
+    """
+    if len(test_list) == 0:
+        test_list = [0, 0]
+    (counts, edges) = numpy.histogram(test_list, bins=bins)
+    return (counts, edges[0], edges[-1])
+
+
+class HistogramStore:
+    """Compact binary store of the per-gene permutation histograms.
+
+    Each gene is one fixed-size record (observed statistic, bin range and 100
+    bin counts) appended to "histograms.dat" in the histogram folder, with the
+    ORF ids in "histograms.orfs". The images are rendered from the store with
+    render_histograms, after the statistical run.
+    """
+
+    dtype = numpy.dtype([("test_obs", "<f8"), ("lo", "<f8"), ("hi", "<f8"), ("counts", "<i4", (100,))])
+
+    def __init__(self, histPath, append=False):
+        if not os.path.isdir(histPath):
+            os.makedirs(histPath)
+        mode = "ab" if append else "wb"
+        self.data_file = open(os.path.join(histPath, "histograms.dat"), mode)
+        self.orf_file = open(os.path.join(histPath, "histograms.orfs"), mode[0])
+
+    def add(self, orf, test_obs, counts, lo, hi):
+        record = numpy.zeros(1, dtype=HistogramStore.dtype)
+        record["test_obs"] = test_obs
+        record["lo"] = lo
+        record["hi"] = hi
+        record["counts"] = counts
+        self.data_file.write(record.tobytes())
+        self.data_file.flush()
+        self.orf_file.write(orf + "\n")
+        self.orf_file.flush()
+
+    def close(self):
+        self.data_file.close()
+        self.orf_file.close()
+
+    @staticmethod
+    def read(histPath):
+        """Returns a dictionary mapping ORF ids to their histogram records."""
+        records = numpy.fromfile(os.path.join(histPath, "histograms.dat"), dtype=HistogramStore.dtype)
+        orfs = [line.rstrip("\n") for line in open(os.path.join(histPath, "histograms.orfs"))]
+        # Later records replace earlier ones (e.g. genes recomputed after --resume)
+        return dict(zip(orfs[:len(records)], records))
+
+
+def render_histogram(task):
+    """Draws the histogram of one gene from its stored record and saves it as a .png file."""
+    (orf, record, genePath) = task
+    # Drawn on an Agg canvas, without pyplot, so it is safe in worker processes and next to the GUI
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    edges = numpy.linspace(record["lo"], record["hi"], len(record["counts"])+1)
+    ax.hist(edges[:-1], bins=edges, weights=record["counts"], density=1, facecolor='c', alpha=0.75)
+    ax.set_xlabel('Delta Mean')
+    ax.set_ylabel('Probability')
+    ax.set_title('%s - Histogram of Delta Mean' % orf)
+    ax.axvline(record["test_obs"], color='r', linestyle='dashed', linewidth=3)
+    ax.grid(True)
+    fig.savefig(genePath)
+
+
+def render_histograms(histPath, orfs=None, nprocs=1):
+    """Renders the .png histograms of the genes in the histogram store.
+
+    Arguments:
+        histPath (str): Histogram folder of a resampling run.
+        orfs (list): ORF ids to render. Default: all genes in the store.
+        nprocs (int): Number of processes used to draw the images.
+    """
+    records = HistogramStore.read(histPath)
+    if orfs is None:
+        orfs = list(records)
+    tasks = [(orf, records[orf], os.path.join(histPath, orf + ".png")) for orf in orfs if orf in records]
+    if nprocs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            pool.map(render_histogram, tasks, chunksize=max(1, len(tasks) // (4*nprocs)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            render_histogram(task)
+
+
 if __name__ == "__main__":
 
     (args, kwargs) = transit_tools.cleanargs(sys.argv)
@@ -264,8 +264,7 @@ class Tn5GapsMethod(base.SingleConditionMethod):
 
         # Get the runs
         self.transit_message("Getting non-insertion runs in genome")
-        run_arr = tnseq_tools.runs_w_info(counts)
-        pos_hash = transit_tools.get_pos_hash(self.annotation_path)
+        (run_start, run_end, run_length) = tnseq_tools.run_intervals(counts)
 
         # Finally, calculate the results
         self.transit_message("Running Tn5 gaps method")
@@ -273,38 +272,38 @@ class Tn5GapsMethod(base.SingleConditionMethod):
         for gene in genes_obj.genes:
             results_per_gene[gene.orf] = [gene.orf, gene.name, gene.desc, gene.k, gene.n, gene.r, 0, 0, 1]
 
-        N = len(run_arr)
-        count = 0
-        accum = 0
+        N = len(run_length)
+        accum = numpy.sum(run_length)
         self.progress_range(N)
-        for run in run_arr:
-            accum += run['length']
-            count += 1
-            genes = tnseq_tools.get_genes_in_range(pos_hash, run['start'], run['end'])
-            for gene_orf in genes:
-                start,end = gene.start,gene.end
-                a,b = self.NTerminus,self.CTerminus
-                if gene.strand=="-": a,b = b,a
-                start = start+int((end-start)*(a/100.))
-                end = end-int((end-start)*(b/100.))
-
-                gene = genes_obj[gene_orf]
-                inter_sz = self.intersect_size([run['start'], run['end']], [start,end]) + 1
-                percent_overlap = self.calc_overlap([run['start'], run['end']], [start,end])
-                run_len = run['length']
-                B = 1.0/math.log(1.0/pnon)
-                u = math.log(num_sites*pins, 1.0/pnon)
-                pval = 1.0 - tnseq_tools.GumbelCDF(run['length'], u, B)
-
-                curr_val = results_per_gene[gene.orf]
-                curr_inter_sz = curr_val[6]
-                curr_len = curr_val[7]
-                if inter_sz > curr_inter_sz:
-                    results_per_gene[gene.orf] = [gene.orf, gene.name, gene.desc, gene.k, gene.n, gene.r, inter_sz, run_len, pval]
-
-            # Update Progress
-            text = "Running Tn5Gaps method... %1.1f%%" % (100.0*count/N)
-            self.progress_update(text, count)
+
+        B = 1.0/math.log(1.0/pnon)
+        u = math.log(num_sites*pins, 1.0/pnon)
+        run_pval = 1.0 - tnseq_tools.GumbelCDF(run_length, u, B)
+
+        # Genes overlapping each run, over their full annotated coordinates
+        gene_start = numpy.array([gene.start for gene in genes_obj.genes], dtype=int)
+        gene_end = numpy.array([gene.end for gene in genes_obj.genes], dtype=int)
+        (run_idx, gene_idx) = tnseq_tools.get_run_gene_overlaps(run_start, run_end, gene_start, gene_end)
+
+        # The size of the overlap is measured on the genes trimmed at their termini
+        a = numpy.array([self.CTerminus if gene.strand == "-" else self.NTerminus for gene in genes_obj.genes])
+        b = numpy.array([self.NTerminus if gene.strand == "-" else self.CTerminus for gene in genes_obj.genes])
+        trim_start = gene_start + ((gene_end-gene_start)*(a/100.)).astype(int)
+        trim_end = gene_end - ((gene_end-trim_start)*(b/100.)).astype(int)
+        inter_sz = self.intersect_size([run_start[run_idx], run_end[run_idx]], [trim_start[gene_idx], trim_end[gene_idx]]) + 1
+
+        # Each gene keeps the run with the largest overlap (the first one, in case of ties)
+        order = numpy.lexsort((run_idx, -inter_sz, gene_idx))
+        (genes_hit, first) = numpy.unique(gene_idx[order], return_index=True)
+        for (g, i) in zip(genes_hit, order[first]):
+            gene = genes_obj.genes[g]
+            if inter_sz[i] > results_per_gene[gene.orf][6]:
+                r = run_idx[i]
+                results_per_gene[gene.orf] = [gene.orf, gene.name, gene.desc, gene.k, gene.n, gene.r, inter_sz[i], run_length[r], run_pval[r]]
+
+        # Update Progress
+        text = "Running Tn5Gaps method... %1.1f%%" % 100.0
+        self.progress_update(text, N)
 
         data = list(results_per_gene.values())
         exp_run_len = float(accum)/N
@@ -373,16 +372,11 @@ class Tn5GapsMethod(base.SingleConditionMethod):
 
 
     def intersect_size(self, intv1, intv2):
-        first = intv1 if intv1[0] < intv2[0] else intv2
-        second = intv1 if first == intv2 else intv2
-
-        if first[1] < second[0]:
-            return 0
-
-        right_ovr = min(first[1], second[1])
-        left_ovr = max(first[0], second[0])
-
-        return right_ovr - left_ovr
+        """Size of the intersection of two intervals (end - start, 0 if they do
+        not overlap). The bounds can also be numpy arrays of intervals."""
+        right_ovr = numpy.minimum(intv1[1], intv2[1])
+        left_ovr = numpy.maximum(intv1[0], intv2[0])
+        return numpy.where(right_ovr < left_ovr, 0, right_ovr - left_ovr)
 
 
     def calc_overlap(self, run_interv, gene_interv):
@@ -166,11 +166,12 @@ class UTestMethod(base.DualConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0, wxobj=None, resume=False):
 
         base.DualConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, expdata, annotation_path, output_file, normalization=normalization, replicates=replicates, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
         self.includeZeros = includeZeros
+        self.resume = resume
 
 
 
@@ -247,6 +248,7 @@ class UTestMethod(base.DualConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.00))
         CTerminus = float(kwargs.get("iC", 0.00))
+        resume = kwargs.get("-resume", False)
 
         return self(ctrldata,
                 expdata,
@@ -258,7 +260,7 @@ class UTestMethod(base.DualConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus, resume=resume)
 
 
 
@@ -280,7 +282,7 @@ class UTestMethod(base.DualConditionMethod):
 
         if self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata+self.expdata, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata+self.expdata, self.annotation_path, inplace=True)
 
         if self.LOESS:
             self.transit_message("Performing LOESS Correction")
@@ -291,55 +293,50 @@ class UTestMethod(base.DualConditionMethod):
         G = tnseq_tools.Genes(self.ctrldata + self.expdata, self.annotation_path, ignoreCodon=self.ignoreCodon, nterm=self.NTerminus, cterm=self.CTerminus, data=data, position=position)
 
 
+        try:
+            checkpoint = transit_tools.ResultCheckpoint(self.output.name, self.checkpoint_parameters(), resume=self.resume)
+        except ValueError as e:
+            self.transit_error(str(e))
+            return
+        if len(checkpoint):
+            self.transit_message("Resuming: %d genes already done" % len(checkpoint))
+
         #u-test
-        data = []
         N = len(G)
-        count = 0
         self.progress_range(N)
-        for gene in G:
+        todo = [i for i in range(N) if i not in checkpoint and G[i].k > 0 and G[i].n > 0]
+
+        # Pool the sites of all the genes, labelled by their position in todo
+        gene_of_site = numpy.repeat(numpy.arange(len(todo)), [G[i].n for i in todo]).astype(int)
+        reads = numpy.concatenate([G[i].reads for i in todo] + [numpy.zeros((K,0))], axis=1)
+        if not self.includeZeros:
+            ii = numpy.sum(reads,0) > 0
+            (reads, gene_of_site) = (reads[:,ii], gene_of_site[ii])
+
+        data1 = reads[:Kctrl].flatten()
+        data2 = reads[Kctrl:].flatten()
+        seg1 = numpy.tile(gene_of_site, Kctrl)
+        seg2 = numpy.tile(gene_of_site, Kexp)
+        (u_stat, pval_2tail) = stat_tools.mannwhitneyu_segments(data1, data2, seg1, seg2, len(todo))
+
+        n1 = numpy.bincount(seg1, minlength=len(todo))
+        n2 = numpy.bincount(seg2, minlength=len(todo))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            mean1 = numpy.where(n1 > 0, numpy.bincount(seg1, weights=data1, minlength=len(todo))/n1, 0)
+            mean2 = numpy.where(n2 > 0, numpy.bincount(seg2, weights=data2, minlength=len(todo))/n2, 0)
+            # Only adjust log2FC if one of the means is zero
+            log2FC = numpy.where((mean1 > 0) & (mean2 > 0), numpy.log2(mean2/mean1), numpy.log2((mean2+1.0)/(mean1+1.0)))
+        log2FC[~numpy.isfinite(log2FC)] = 0.0
+
+        #["Orf","Name","Desc","Sites","Mean Ctrl","Mean Exp","log2FC", "U-Statistic","p-value","Adj. p-value"]
+        results = dict(zip(todo, zip(mean1, mean2, log2FC, u_stat, pval_2tail)))
+        count = 0
+        for i,gene in enumerate(G):
             count+=1
-            if gene.k == 0 or gene.n == 0:
-                (test_obs, mean1, mean2, log2FC, u_stat, pval_2tail) = (0, 0, 0, 0, 0.0, 1.00)
-            else:
-
-                if not self.includeZeros:
-                    ii = numpy.sum(gene.reads,0) > 0
-                else:
-                    ii = numpy.ones(gene.n) == 1
-
-
-                data1 = gene.reads[:Kctrl,ii].flatten()
-                data2 = gene.reads[Kctrl:,ii].flatten()
-                try:
-                    u_stat, pval_2tail = scipy.stats.mannwhitneyu(data1, data2,
-                        alternative="two-sided")
-                except ValueError as e:
-                    u_stat, pval_2tail = 0.0, 1.00
-
-                n1 = len(data1)
-                n2 = len(data2)
-
-                mean1 = 0
-                if n1 > 0:
-                    mean1 = numpy.mean(data1)
-                mean2 = 0
-                if n2 > 0:
-                    mean2 = numpy.mean(data2)
-
-                try:
-                    # Only adjust log2FC if one of the means is zero
-                    if mean1 > 0 and mean2 > 0:
-                        log2FC = math.log((mean2)/(mean1),2)
-                    else:
-                        log2FC = math.log((mean2+1.0)/(mean1+1.0),2)
-                except:
-                    log2FC = 0.0
-
-
-            #["Orf","Name","Desc","Sites","Mean Ctrl","Mean Exp","log2FC", "U-Statistic","p-value","Adj. p-value"]
-
-
-            data.append([gene.orf, gene.name, gene.desc, gene.n, mean1, mean2, log2FC, u_stat, pval_2tail])
+            if i in checkpoint:
+                continue
+            (mean1, mean2, log2FC, u_stat, pval_2tail) = results.get(i, (0, 0, 0, 0.0, 1.00))
+            checkpoint.add(i, [gene.orf, gene.name, gene.desc, gene.n, mean1, mean2, log2FC, u_stat, pval_2tail])
 
             # Update Progress
             text = "Running Mann-Whitney U-test Method... %1.1f%%" % (100.0*count/N)
@@ -349,6 +346,7 @@ class UTestMethod(base.DualConditionMethod):
         #
         self.transit_message("") # Printing empty line to flush stdout
         self.transit_message("Performing Benjamini-Hochberg Correction")
+        data = [checkpoint[i] for i in range(N)]
         data.sort()
         qval = stat_tools.BH_fdr_correction([row[-1] for row in data])
 
@@ -372,12 +370,19 @@ class UTestMethod(base.DualConditionMethod):
             (orf, name, desc, n, mean1, mean2, log2FC, u_stat, pval_2tail) = row
             self.output.write("%s\t%s\t%s\t%d\t%1.1f\t%1.1f\t%1.2f\t%1.2f\t%1.5f\t%1.5f\n" % (orf, name, desc, n, mean1, mean2, log2FC, u_stat, pval_2tail, qval[i]))
         self.output.close()
+        checkpoint.close()
 
         self.transit_message("Adding File: %s" % (self.output.name))
         self.add_file(filetype="utest")
         self.finish()
         self.transit_message("Finished Mann-Whitney U-test Method")
 
+    def checkpoint_parameters(self):
+        """Returns the parameters that must match to resume an interrupted run."""
+        return {"method": short_name, "ctrldata": self.ctrldata, "expdata": self.expdata,
+                "annotation": self.annotation_path, "normalization": self.normalization,
+                "includeZeros": self.includeZeros, "LOESS": self.LOESS,
+                "NTerminus": self.NTerminus, "CTerminus": self.CTerminus}
 
     @classmethod
     def usage_string(self):
@@ -389,6 +394,8 @@ class UTestMethod(base.DualConditionMethod):
         -l              :=  Perform LOESS Correction; Helps remove possible genomic position bias. Default: Turned Off.
         -iN <float>     :=  Ignore TAs occuring at given fraction (as integer) of the N terminus. Default: -iN 0
         -iC <float>     :=  Ignore TAs occuring at given fraction (as integer) of the C terminus. Default: -iC 0
+        --resume        :=  Resume an interrupted run with the same arguments, skipping the genes
+                            already saved in <output file>.checkpoint.
         """ % (sys.argv[0])
 
 
@@ -1,10 +1,14 @@
 import scipy
+import scipy.linalg
+import scipy.stats
 import numpy
 import heapq
+import itertools
 import statsmodels.stats.multitest
 
 import time
 import sys
+import multiprocessing
 import collections
 import functools
 
@@ -23,6 +27,7 @@ import pytransit
 import pytransit.transit_tools as transit_tools
 import pytransit.tnseq_tools as tnseq_tools
 import pytransit.norm_tools as norm_tools
+import pytransit.stat_tools as stat_tools
 
 ############# GUI ELEMENTS ##################
 
@@ -48,7 +53,7 @@ class ZinbMethod(base.MultiConditionMethod):
     """
     Zinb
     """
-    def __init__(self, combined_wig, metadata, annotation, normalization, output_file, ignored_conditions=[], included_conditions=[], winz=False, nterm=5.0, cterm=5.0, condition="Condition", covars=[], interactions = [], PC=1):
+    def __init__(self, combined_wig, metadata, annotation, normalization, output_file, ignored_conditions=[], included_conditions=[], winz=False, nterm=5.0, cterm=5.0, condition="Condition", covars=[], interactions = [], PC=1, resume=False, engine="native", nprocs=1):
         base.MultiConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, combined_wig, metadata, annotation, output_file,
                 normalization=normalization, ignored_conditions=ignored_conditions, included_conditions=included_conditions, nterm=nterm, cterm=cterm)
         self.winz = winz
@@ -56,19 +61,26 @@ class ZinbMethod(base.MultiConditionMethod):
         self.interactions = interactions
         self.condition = condition
         self.PC = PC
+        self.resume = resume
+        self.engine = engine
+        self.nprocs = max(1, int(nprocs))
 
     @classmethod
     def transit_error(self,msg): print("error: %s" % msg) # for some reason, transit_error() in base class or transit_tools doesn't work right; needs @classmethod
 
     @classmethod
     def fromargs(self, rawargs):
-        if not hasR:
-            print("Error: R and rpy2 (~= 3.0) required to run ZINB analysis.")
+        (args, kwargs) = transit_tools.cleanargs(rawargs)
+
+        engine = kwargs.get("-engine", "native")
+        if engine not in ["native", "R"]:
+            self.transit_error("--engine must be native or R")
+            sys.exit(0)
+        if engine == "R" and not hasR:
+            print("Error: R and rpy2 (~= 3.0) required to run ZINB analysis with --engine R.")
             print("After installing R, you can install rpy2 using the command \"pip install 'rpy2~=3.0'\"")
             sys.exit(0)
 
-        (args, kwargs) = transit_tools.cleanargs(rawargs)
-
         if (kwargs.get('-help', False) or kwargs.get('h', False)):
             print(ZinbMethod.usage_string())
             sys.exit(0)
@@ -95,16 +107,18 @@ class ZinbMethod(base.MultiConditionMethod):
         winz = True if "w" in kwargs else False
         ignored_conditions = list(filter(None, kwargs.get("-ignore-conditions", "").split(",")))
         included_conditions = list(filter(None, kwargs.get("-include-conditions", "").split(",")))
+        resume = kwargs.get("-resume", False)
+        nprocs = int(kwargs.get("j", 1))
 
         # check for unrecognized flags
-        flags = "-n --ignore-conditions --include-conditions -iN -iC -PC --condition --covars --interactions --gene".split()
+        flags = "-n --ignore-conditions --include-conditions -iN -iC -PC --condition --covars --interactions --gene --resume --engine -j".split()
         for arg in rawargs:
           if arg[0]=='-' and arg not in flags:
             self.transit_error("flag unrecognized: %s" % arg)
             print(ZinbMethod.usage_string())
             sys.exit(0)
 
-        return self(combined_wig, metadata, annotation, normalization, output_file, ignored_conditions, included_conditions, winz, NTerminus, CTerminus, condition, covars, interactions, PC)
+        return self(combined_wig, metadata, annotation, normalization, output_file, ignored_conditions, included_conditions, winz, NTerminus, CTerminus, condition, covars, interactions, PC, resume, engine, nprocs)
 
     def wigs_to_conditions(self, conditionsByFile, filenamesInCombWig):
         """
@@ -150,44 +164,19 @@ class ZinbMethod(base.MultiConditionMethod):
               if f not in interactionsMap[0]: print(f)
             sys.exit(0)
 
-    def stats_for_gene(self, siteIndexes, groupWigIndexMap, data):
-        """
-            Returns a dictionary of {Group: {Mean, NzMean, NzPerc}}
-            ([SiteIndex], [Condition], [WigData]) -> [{Condition: Number}]
-            SiteIndex :: Number
-            WigData :: [Number]
-            Group :: String (combination of '<interaction>_<condition>')
-        """
-        nonzero = lambda xs: xs[numpy.nonzero(xs)]
-        nzperc = lambda xs: numpy.count_nonzero(xs)/float(xs.size)
-
-        means = {}
-        nz_means = {}
-        nz_percs = {}
-
-        for (group, wigIndexes) in groupWigIndexMap.items():
-            if (len(siteIndexes) == 0): # If no TA sites, write 0
-                means[group] = 0
-                nz_means[group] = 0
-                nz_percs[group] = 0
-            else:
-                arr = data[wigIndexes][:, siteIndexes]
-                means[group] = numpy.mean(arr) if len(arr) > 0 else 0
-                nonzero_arr = nonzero(arr)
-                nz_means[group] = numpy.mean(nonzero_arr) if len(nonzero_arr) > 0 else 0
-                nz_percs[group] = nzperc(arr)
-
-        return {'mean': means, 'nz_mean': nz_means, 'nz_perc': nz_percs}
-
     def stats_by_rv(self, data, RvSiteindexesMap, genes, conditions, interactions):
         """
-            Returns Dictionary of Stats by condition for each Rv
-            ([[Wigdata]], {Rv: SiteIndex}, [Gene], [Condition], [Interaction]) -> {Rv: {Condition: Number}}
+            Returns the mean, non-zero mean and non-zero fraction of the counts of each gene in each
+            group of wigs, as arrays of genes x groups (0 for genes without TA sites), and the names
+            of the groups (combinations of '<condition><SEPARATOR><interaction>').
+            ([[Wigdata]], {Rv: SiteIndex}, [Gene], [Condition], [Interaction]) -> Tuple({Stat: [[Number]]}, [Group])
             Wigdata :: [Number]
             SiteIndex :: Number
             Gene :: {start, end, rv, gene, strand}
             Condition :: String
             Interaction :: String
+            Stat :: 'mean' | 'nz_mean' | 'nz_perc'
+            Group :: String
         """
 
         ## Group wigfiles by (interaction, condition) pair
@@ -202,14 +191,24 @@ class ZinbMethod(base.MultiConditionMethod):
                 groupName = conditionForWig
                 groupWigIndexMap[groupName].append(i)
 
-        statsByRv = {}
-        for gene in genes:
-            Rv = gene["rv"]
-            statsByRv[Rv] = self.stats_for_gene(RvSiteindexesMap[Rv], groupWigIndexMap, data)
-
         ## TODO :: Any ordering to follow?
-        statGroupNames = groupWigIndexMap.keys()
-        return statsByRv, statGroupNames
+        statGroupNames = list(groupWigIndexMap.keys())
+
+        (siteindexes, nsites) = self.gene_segments(genes, RvSiteindexesMap)
+        X = numpy.asarray(data)[:, siteindexes]
+        shape = (len(genes), len(statGroupNames))
+        stats = {'mean': numpy.zeros(shape), 'nz_mean': numpy.zeros(shape), 'nz_perc': numpy.zeros(shape)}
+        nonempty = nsites > 0
+        for (j, group) in enumerate(statGroupNames):
+            wigIndexes = groupWigIndexMap[group]
+            size = len(wigIndexes) * nsites[nonempty]
+            sums = self.reduce_by_gene(numpy.add, numpy.sum(X[wigIndexes], 0), nsites)[nonempty]
+            nonzeros = self.reduce_by_gene(numpy.add, numpy.count_nonzero(X[wigIndexes], 0), nsites)[nonempty]
+            stats['mean'][nonempty, j] = sums / size
+            stats['nz_mean'][nonempty, j] = numpy.where(nonzeros > 0, sums / numpy.maximum(nonzeros, 1), 0)
+            stats['nz_perc'][nonempty, j] = nonzeros / size
+
+        return stats, statGroupNames
 
     def global_stats_for_rep(self, data):
         """
@@ -341,6 +340,116 @@ class ZinbMethod(base.MultiConditionMethod):
 
         return globalenv['zinb_signif']
 
+    def model_terms(self, full):
+        """
+            Returns the terms of the full model (1+cond*<interactions>+<covars>) or of the
+            null model (1[+cond+<interactions>]+<covars>), as in the R formulas of run_zinb.
+            Each term is a tuple of the variables multiplied in it.
+            Bool -> [(String)]
+        """
+        if full:
+            factors = ["cond"] + self.interactions
+            terms = [t for k in range(1, len(factors)+1) for t in itertools.combinations(factors, k)]
+        elif len(self.interactions) > 0:
+            terms = [("cond",)] + [(I,) for I in self.interactions]
+        else:
+            terms = []
+        return terms + [(C,) for C in self.covars]
+
+    def design_matrix(self, terms, variables):
+        """
+            Returns the design matrix of a model with an intercept and the given terms, and
+            the names of its columns. As model.matrix in R, numeric variables are used as is
+            and the other variables as factors with treatment contrasts (first level in
+            sorted order as reference). Linearly dependent columns are dropped.
+            ([(String)], {String: [Value]}) -> Tuple([[Number]], [String])
+            Value :: String
+        """
+        n = len(variables["cond"])
+        columns = [("(Intercept)", numpy.ones(n))]
+        for term in terms:
+            product = [("", numpy.ones(n))]
+            for var in term:
+                values = variables[var]
+                if self.is_number(values[0]):
+                    factor = [(var, numpy.array(values, dtype=float))]
+                else:
+                    values = numpy.asarray(values)
+                    factor = [(var + level, (values == level).astype(float)) for level in sorted(set(values))[1:]]
+                product = [(name1 + (":" if name1 else "") + name2, col1*col2) for (name1, col1) in product for (name2, col2) in factor]
+            columns += product
+        X = numpy.column_stack([col for (name, col) in columns])
+        (R, P) = scipy.linalg.qr(X, mode="r", pivoting=True)
+        rank = numpy.sum(numpy.abs(numpy.diag(R)) > 1e-7*numpy.abs(R[0,0]))
+        keep = numpy.sort(P[:rank])
+        return (X[:,keep], [columns[j][0] for j in keep])
+
+    def zinb_signif(self, cnt, variables, NZmean, logitZperc, DEBUG=False):
+        """
+            Native version of the R function zinb_signif (see def_r_zinb_signif). Tests whether
+            the condition (and its interactions) improves the fit of the counts of a gene, with
+            a likelihood-ratio test between zero-inflated negative binomial models (as
+            pscl::zeroinfl), or negative binomial models (as MASS::glm.nb) if the gene has no
+            zeros. The full model is warm-started from the fit of the null model.
+            ([Number], {String: [Value]}, [Number], [Number], Bool) -> Tuple(Number, String)
+            Value :: String
+        """
+        cnt = numpy.asarray(cnt)
+        cond = numpy.asarray(variables["cond"])
+        groups = sorted(set(cond))
+
+        # filter out genes that have low saturation across all conditions
+        NZpercs = [numpy.mean(cnt[cond == c] > 0) for c in groups]
+        if max(NZpercs) < 0.15:
+            return (1, "low saturation (<15%) across all conditions (pan-growth-defect) - not analyzed")
+
+        # to avoid model failing due to singular condition, add fake counts of 1 to all conds if any cond is all 0s
+        if min(numpy.sum(cnt[cond == c]) for c in groups) == 0:
+            first = [numpy.flatnonzero(cond == c)[0] for c in groups]
+            cnt = numpy.append(cnt, numpy.ones(len(first), dtype=cnt.dtype))
+            variables = dict((var, numpy.append(numpy.asarray(values), numpy.asarray(values)[first])) for (var, values) in variables.items())
+            NZmean = numpy.append(NZmean, numpy.asarray(NZmean)[first])
+            logitZperc = numpy.append(logitZperc, numpy.asarray(logitZperc)[first])
+
+        zeroinfl = numpy.min(cnt) == 0
+        try:
+            (X0, names0) = self.design_matrix(self.model_terms(False), variables)
+            (X1, names1) = self.design_matrix(self.model_terms(True), variables)
+            if zeroinfl:
+                (offset, offset_infl) = (numpy.log(NZmean), logitZperc)
+                (params0, ll0, _, ok0, msg0) = stat_tools.zinb_fit(cnt, X0, X0, offset, offset_infl)
+                (b0, g0) = (dict(zip(names0, params0[:len(names0)])), dict(zip(names0, params0[len(names0):-1])))
+                start = numpy.array([b0.get(name, 0.0) for name in names1] + [g0.get(name, 0.0) for name in names1] + [params0[-1]])
+                (params1, ll1, H1, ok1, msg1) = stat_tools.zinb_fit(cnt, X1, X1, offset, offset_infl, start=start, hessian=True)
+                (df0, df1) = (2*len(names0)+1, 2*len(names1)+1)
+                # covariance of the coefficients, as in zeroinfl; the pseudo-inverse keeps fits
+                # with diverging coefficients (e.g. no zero-inflation in a condition) usable
+                cov1 = numpy.linalg.pinv(-H1)
+            else:
+                (params0, ll0, _, ok0, msg0) = stat_tools.zinb_fit(cnt, X0)
+                b0 = dict(zip(names0, params0[:-1]))
+                start = numpy.array([b0.get(name, 0.0) for name in names1] + [params0[-1]])
+                (params1, ll1, _, ok1, msg1) = stat_tools.zinb_fit(cnt, X1, start=start)
+                (df0, df1) = (len(names0)+1, len(names1)+1)
+        except (numpy.linalg.LinAlgError, ValueError) as e:
+            return (1, "Model Error. %s" % e)
+
+        if DEBUG:
+            print("Model 1:")
+            print(list(zip(names1, params1)), "log(theta) = %s" % params1[-1], "logLik = %s" % ll1)
+            print("Model 0:")
+            print(list(zip(names0, params0)), "log(theta) = %s" % params0[-1], "logLik = %s" % ll0)
+            print("delta_log_likelihood=%f" % (ll1-ll0))
+
+        if not (ok0 and ok1):
+            return (1, "Model Error. %s" % (msg1 if ok0 else msg0))
+        if not (numpy.isfinite(ll0) and numpy.isfinite(ll1)):
+            return (1, "Model Error. non-finite log-likelihood")
+        if zeroinfl and not numpy.all(numpy.diag(cov1)[:len(names1)] >= 0):
+            return (1, "Has Coefs, but Pvals are NAs (model failure)") # rare failure mode - has coefs, but pvals are NA
+        pval = scipy.stats.chi2.sf(2*(ll1-ll0), df1-df0)
+        return (pval, "-")
+
     def winsorize(self, data):
         unique_counts = numpy.unique(numpy.concatenate(data))
         if (len(unique_counts) < 2):
@@ -358,10 +467,88 @@ class ZinbMethod(base.MultiConditionMethod):
         except ValueError:
             return False
 
-    def run_zinb(self, data, genes, NZMeanByRep, LogZPercByRep, RvSiteindexesMap, conditions, covariates, interactions):
+    def model_formulas(self):
+        """
+            Returns the R formulas of the full and null ZINB models and of the full and null
+            NB models, in this order.
+            () -> Tuple(String, String, String, String)
+        """
+        comp1a = "1+cond"
+        comp1b = "1+cond"
+
+        # include cond in mod0 only if testing interactions
+        comp0a = "1" if len(self.interactions)==0 else "1+cond"
+        comp0b = "1" if len(self.interactions)==0 else "1+cond"
+        for I in self.interactions: comp1a += "*"+I; comp1b += "*"+I; comp0a += "+"+I; comp0b += "+"+I
+        for C in self.covars: comp1a += "+"+C; comp1b += "+"+C; comp0a += "+"+C; comp0b += "+"+C
+        zinbMod1 = "cnt~%s+offset(log(NZmean))|%s+offset(logitZperc)" % (comp1a,comp1b)
+        zinbMod0 = "cnt~%s+offset(log(NZmean))|%s+offset(logitZperc)" % (comp0a,comp0b)
+
+        nbMod1 = "cnt~%s" % (comp1a)
+        nbMod0 = "cnt~%s" % (comp0a)
+        return (zinbMod1, zinbMod0, nbMod1, nbMod0)
+
+    def zinb_gene(self, Rv, siteIndexes, data, NZMeanByRep, LogZPercByRep, conditions, covariates, interactions, r_zinb_signif=None, debug=False):
+        """
+            Runs Zinb for one gene across conditions and returns its p-value and status.
+            r_zinb_signif is the R function made by def_r_zinb_signif, for the R engine.
+            (Rv, [SiteIndex], [[Wigdata]], [Number], [Number], [Condition], [Covar], [Interaction], RFunction, Bool) -> Tuple(Number, Status)
+            Wigdata :: [Number]
+            SiteIndex: Integer
+            Condition :: String
+            Covar :: String
+            Interaction :: String
+            Status :: String
         """
-            Runs Zinb for each gene across conditions and returns p and q values
-            ([[Wigdata]], [Gene], [Number], [Number], {Rv: [SiteIndex]}, [Condition], [Covar], [Interaction]) -> Tuple([Number], [Number], [Status])
+        if (len(siteIndexes) <= 1):
+            return (1, "TA sites <= 1, not analyzed")
+
+        # For winsorization
+        # norm_data = self.winsorize((map(
+        #     lambda wigData: wigData[siteIndexes], data))) if self.winz else list(map(lambda wigData: wigData[siteIndexes], data))
+        norm_data = list(map(lambda wigData: wigData[siteIndexes], data))
+        ([ readCounts,
+           condition,
+           covarsData,
+           interactionsData,
+           NZmean,
+           logitZPerc]) = self.melt_data(
+                   norm_data,
+                   conditions, covariates, interactions, NZMeanByRep, LogZPercByRep)
+        if (numpy.sum(readCounts) == 0):
+            (pval, msg) = (1, "pan-essential (no counts in all conditions) - not analyzed")
+        elif self.engine == "native":
+            variables = {'cond': condition}
+            variables.update(zip(self.covars, covarsData))
+            variables.update(zip(self.interactions, interactionsData))
+            pval, msg = self.zinb_signif(readCounts, variables, NZmean, logitZPerc, debug)
+        else:
+            (zinbMod1, zinbMod0, nbMod1, nbMod0) = self.model_formulas()
+            toRFloatOrStrVec = lambda xs: FloatVector([float(x) for x in xs]) if self.is_number(xs[0]) else StrVector(xs)
+            df_args = {
+                'cnt': IntVector(readCounts),
+                'cond': toRFloatOrStrVec(condition),
+                'NZmean': FloatVector(NZmean),
+                'logitZperc': FloatVector(logitZPerc)
+                }
+            ## Add columns for covariates and interactions if they exist.
+            df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(covarsData[t_ic[0]])), enumerate(self.covars))))
+            df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(interactionsData[t_ic[0]])), enumerate(self.interactions))))
+
+            melted = DataFrame(df_args)
+            # r_args = [IntVector(readCounts), StrVector(condition), melted, map(lambda x: StrVector(x), covars), FloatVector(NZmean), FloatVector(logitZPerc)] + [True]
+            pval, msg = r_zinb_signif(melted, zinbMod1, zinbMod0, nbMod1, nbMod0, debug)
+        if debug:
+            self.transit_message("Pval for Gene {0}: {1}, status: {2}".format(Rv, float(pval), msg))
+        return (float(pval), str(msg))
+
+    def run_zinb(self, data, genes, NZMeanByRep, LogZPercByRep, RvSiteindexesMap, conditions, covariates, interactions, checkpoint):
+        """
+            Runs Zinb for each gene across conditions and returns p and q values.
+            The p-value and status of each gene are saved in the checkpoint, and genes already in it are skipped.
+            With more than one process (-j), the genes are tested by a pool of workers, which receive the
+            data once; the results are collected in the order of the genes.
+            ([[Wigdata]], [Gene], [Number], [Number], {Rv: [SiteIndex]}, [Condition], [Covar], [Interaction], ResultCheckpoint) -> Tuple([Number], [Number], [Status])
             Wigdata :: [Number]
             Gene :: {start, end, rv, gene, strand}
             SiteIndex: Integer
@@ -371,98 +558,63 @@ class ZinbMethod(base.MultiConditionMethod):
             Status :: String
         """
 
-        count = 0
         self.progress_range(len(genes))
-        pvals,Rvs, status = [],[], []
-        r_zinb_signif = self.def_r_zinb_signif()
         if (self.winz):
             self.transit_message("Winsorizing and running analysis...")
 
         self.transit_message("Condition: %s" % self.condition)
 
-        comp1a = "1+cond"
-        comp1b = "1+cond"
+        params = {"method": self, "data": data, "NZMeanByRep": NZMeanByRep, "LogZPercByRep": LogZPercByRep,
+                "RvSiteindexesMap": RvSiteindexesMap, "conditions": conditions, "covariates": covariates,
+                "interactions": interactions, "debug": DEBUG}
 
-        # include cond in mod0 only if testing interactions
-        comp0a = "1" if len(self.interactions)==0 else "1+cond"
-        comp0b = "1" if len(self.interactions)==0 else "1+cond"
-        for I in self.interactions: comp1a += "*"+I; comp1b += "*"+I; comp0a += "+"+I; comp0b += "+"+I
-        for C in self.covars: comp1a += "+"+C; comp1b += "+"+C; comp0a += "+"+C; comp0b += "+"+C
-        zinbMod1 = "cnt~%s+offset(log(NZmean))|%s+offset(logitZperc)" % (comp1a,comp1b)
-        zinbMod0 = "cnt~%s+offset(log(NZmean))|%s+offset(logitZperc)" % (comp0a,comp0b)
+        ## Single gene case for debugging
+        if (GENE):
+            Rv = None
+            if GENE in RvSiteindexesMap:
+                Rv = GENE
+            else:
+                for g in genes:
+                    if (g['gene'] == GENE):
+                        Rv = g["rv"]
+                        break
+            if not Rv:
+                self.transit_error("Cannot find gene: {0}".format(GENE))
+                sys.exit(0)
+            params["debug"] = True
+            zinb_worker_init(params)
+            zinb_gene(Rv)
+            self.transit_message("Ran for single gene. Exiting...")
+            sys.exit(0)
 
-        nbMod1 = "cnt~%s" % (comp1a)
-        nbMod0 = "cnt~%s" % (comp0a)
-        toRFloatOrStrVec = lambda xs: FloatVector([float(x) for x in xs]) if self.is_number(xs[0]) else StrVector(xs)
+        count = len(checkpoint)
+        pending = [i for i in range(len(genes)) if i not in checkpoint]
+        pool = None
+        if self.nprocs > 1 and len(pending) > 1:
+            self.transit_message("Running ZINB on genes using %d processes" % self.nprocs)
+            # Each worker of the R engine starts its own R session
+            context = multiprocessing.get_context("spawn" if self.engine == "R" else None)
+            pool = context.Pool(self.nprocs, initializer=zinb_worker_init, initargs=(params,))
+            results = pool.imap(zinb_gene, [genes[i]["rv"] for i in pending], chunksize=max(1, min(16, len(pending) // (4*self.nprocs))))
+        else:
+            zinb_worker_init(params)
+            results = map(zinb_gene, [genes[i]["rv"] for i in pending])
 
-        for gene in genes:
-            count += 1
-            Rv = gene["rv"]
-            ## Single gene case for debugging
-            if (GENE):
-                Rv = None
-                if GENE in RvSiteindexesMap:
-                    Rv = GENE
-                else:
-                    for g in genes:
-                        if (g['gene'] == GENE):
-                            Rv = g["rv"]
-                            break
-                if not Rv:
-                    self.transit_error("Cannot find gene: {0}".format(GENE))
-                    sys.exit(0)
-
-            if (DEBUG):
-               self.transit_message("======================================================================")
-               self.transit_message(gene["rv"]+" "+gene["gene"])
-
-            if (len(RvSiteindexesMap[Rv]) <= 1):
-                status.append("TA sites <= 1, not analyzed")
-                pvals.append(1)
-            else:
-                # For winsorization
-                # norm_data = self.winsorize((map(
-                #     lambda wigData: wigData[RvSiteindexesMap[Rv]], data))) if self.winz else list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data))
-                norm_data = list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data))
-                ([ readCounts,
-                   condition,
-                   covarsData,
-                   interactionsData,
-                   NZmean,
-                   logitZPerc]) = self.melt_data(
-                           norm_data,
-                           conditions, covariates, interactions, NZMeanByRep, LogZPercByRep)
-                if (numpy.sum(readCounts) == 0):
-                    status.append("pan-essential (no counts in all conditions) - not analyzed")
-                    pvals.append(1)
-                else:
-                    df_args = {
-                        'cnt': IntVector(readCounts),
-                        'cond': toRFloatOrStrVec(condition),
-                        'NZmean': FloatVector(NZmean),
-                        'logitZperc': FloatVector(logitZPerc)
-                        }
-                    ## Add columns for covariates and interactions if they exist.
-                    df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(covarsData[t_ic[0]])), enumerate(self.covars))))
-                    df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(interactionsData[t_ic[0]])), enumerate(self.interactions))))
-
-                    melted = DataFrame(df_args)
-                    # r_args = [IntVector(readCounts), StrVector(condition), melted, map(lambda x: StrVector(x), covars), FloatVector(NZmean), FloatVector(logitZPerc)] + [True]
-                    debugFlag = True if DEBUG or GENE else False
-                    pval, msg = r_zinb_signif(melted, zinbMod1, zinbMod0, nbMod1, nbMod0, debugFlag)
-                    status.append(msg)
-                    pvals.append(float(pval))
-                if (DEBUG or GENE):
-                    self.transit_message("Pval for Gene {0}: {1}, status: {2}".format(Rv, pvals[-1], status[-1]))
-                if (GENE):
-                    self.transit_message("Ran for single gene. Exiting...")
-                    sys.exit(0)
-            Rvs.append(Rv)
-            # Update progress
-            text = "Running ZINB Method... %5.1f%%" % (100.0*count/len(genes))
-            self.progress_update(text, count)
-
-        pvals = numpy.array(pvals)
+        try:
+            for (i, (pval, msg)) in zip(pending, results):
+                count += 1
+                checkpoint.add(i, [pval, msg])
+                # Update progress
+                text = "Running ZINB Method... %5.1f%%" % (100.0*count/len(genes))
+                self.progress_update(text, count)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        Rvs = [gene["rv"] for gene in genes]
+        pvals = numpy.array([checkpoint[i][0] for i in range(len(genes))], dtype=float)
+        status = [checkpoint[i][1] for i in range(len(genes))]
         mask = numpy.isfinite(pvals)
         qvals = numpy.full(pvals.shape, numpy.nan)
         qvals[mask] = statsmodels.stats.multitest.fdrcorrection(pvals)[1] # BH, alpha=0.05
@@ -503,20 +655,21 @@ class ZinbMethod(base.MultiConditionMethod):
     def Run(self):
         self.transit_message("Starting ZINB analysis")
         start_time = time.time()
-        packnames = ("MASS", "pscl")
-        r_packages_needed = [x for x in packnames if not rpackages.isinstalled(x)]
-        if (len(r_packages_needed) > 0):
-            self.transit_error(
-                    "Error: Following R packages are required: %(0)s. From R console, You can install them using install.packages(c(%(0)s))"
-                    % ({'0': '"{0}"'.format('", "'.join(r_packages_needed))}))
-            sys.exit(1)
+        if self.engine == "R":
+            packnames = ("MASS", "pscl")
+            r_packages_needed = [x for x in packnames if not rpackages.isinstalled(x)]
+            if (len(r_packages_needed) > 0):
+                self.transit_error(
+                        "Error: Following R packages are required: %(0)s. From R console, You can install them using install.packages(c(%(0)s))"
+                        % ({'0': '"{0}"'.format('", "'.join(r_packages_needed))}))
+                sys.exit(1)
 
 
         self.transit_message("Getting Data")
         (sites, data, filenamesInCombWig) = tnseq_tools.read_combined_wig(self.combined_wig)
 
         self.transit_message("Normalizing using: %s" % self.normalization)
-        (data, factors) = norm_tools.normalize_data(data, self.normalization)
+        (data, factors) = norm_tools.normalize_data(data, self.normalization, inplace=True)
 
         condition_name = self.condition
         # if a covar is not found, this crashes; check for it?
@@ -572,8 +725,16 @@ class ZinbMethod(base.MultiConditionMethod):
         statsByRv, statGroupNames = self.stats_by_rv(data, RvSiteindexesMap, genes, conditions, interactions)
         LogZPercByRep, NZMeanByRep = self.global_stats_for_rep(data)
 
+        try:
+            checkpoint = transit_tools.ResultCheckpoint(self.output, self.checkpoint_parameters(), resume=self.resume)
+        except ValueError as e:
+            self.transit_error(str(e))
+            sys.exit(1)
+        if len(checkpoint):
+            self.transit_message("Resuming: %d genes already done" % len(checkpoint))
+
         self.transit_message("Running ZINB")
-        pvals, qvals, run_status = self.run_zinb(data, genes, NZMeanByRep, LogZPercByRep, RvSiteindexesMap, conditions, covariates, interactions)
+        pvals, qvals, run_status = self.run_zinb(data, genes, NZMeanByRep, LogZPercByRep, RvSiteindexesMap, conditions, covariates, interactions, checkpoint)
 
         def orderStats(x, y):
             ic1 = x.split(SEPARATOR)
@@ -611,25 +772,36 @@ class ZinbMethod(base.MultiConditionMethod):
         file.write("#Console: python3 %s\n" % " ".join(sys.argv))
         file.write("#parameters: normalization=%s, trimming=%s/%s%% (N/C), pseudocounts=%s\n" % (self.normalization,self.NTerminus,self.CTerminus,self.PC))
         file.write('#'+'\t'.join(head)+EOL)
-        for gene in genes:
+        groupColumns = [statGroupNames.index(group) for group in orderedStatGroupNames]
+        for (g, gene) in enumerate(genes):
             Rv = gene["rv"]
-            means = [statsByRv[Rv]['mean'][group] for group in orderedStatGroupNames]
+            means = statsByRv['mean'][g, groupColumns]
             PC = self.PC
             if len(means)==2: LFCs = [numpy.math.log((means[1]+PC)/(means[0]+PC),2)]
             else: 
               m = numpy.mean(means)
               LFCs = [numpy.math.log((x+PC)/(m+PC),2) for x in means]
             vals = ([Rv, gene["gene"], str(len(RvSiteindexesMap[Rv]))] +
-                    ["%0.1f" % statsByRv[Rv]['mean'][group] for group in orderedStatGroupNames] +
+                    ["%0.1f" % x for x in means] +
                     ["%0.3f" % x for x in LFCs]+
-                    ["%0.1f" % statsByRv[Rv]['nz_mean'][group] for group in orderedStatGroupNames] +
-                    ["%0.2f" % statsByRv[Rv]['nz_perc'][group] for group in orderedStatGroupNames] +
+                    ["%0.1f" % x for x in statsByRv['nz_mean'][g, groupColumns]] +
+                    ["%0.2f" % x for x in statsByRv['nz_perc'][g, groupColumns]] +
                     ["%f" % x for x in [pvals[Rv], qvals[Rv]]]) + [run_status[Rv]]
             file.write('\t'.join(vals)+EOL)
         file.close()
+        checkpoint.close()
         self.transit_message("Finished Zinb analysis")
         self.transit_message("Time: %0.1fs\n" % (time.time() - start_time))
 
+    def checkpoint_parameters(self):
+        """Returns the parameters that must match to resume an interrupted run."""
+        return {"method": short_name, "combined_wig": self.combined_wig, "metadata": self.metadata,
+                "annotation": self.annotation_path, "normalization": self.normalization,
+                "ignored_conditions": self.ignored_conditions, "included_conditions": self.included_conditions,
+                "winz": self.winz, "NTerminus": self.NTerminus, "CTerminus": self.CTerminus,
+                "condition": self.condition, "covars": self.covars, "interactions": self.interactions,
+                "engine": self.engine}
+
     @classmethod
     def usage_string(self):
         return """python3 %s zinb <combined wig file> <samples_metadata file> <annotation .prot_table> <output file> [Optional Arguments]
@@ -645,9 +817,46 @@ class ZinbMethod(base.MultiConditionMethod):
         --covars <covar1,covar2...>     :=  Comma separated list of covariates (in metadata file) to include, for the analysis.
         --interactions <covar1,covar2...>     :=  Comma separated list of covariates to include, that interact with the condition for the analysis. Must be factors
         --gene <RV number or Gene name> := Run method for one gene and print model output.
+        --resume        :=  Resume an interrupted run with the same arguments, skipping the genes
+                            already saved in <output file>.checkpoint.
+        --engine <native|R> :=  Fit the models in Python (native), or in R with pscl/MASS (requires R and rpy2). Default: --engine native
+        -j <int>        :=  Number of worker processes used to test genes in parallel. Default: -j 1
 
         """ % (sys.argv[0])
 
+# Data of the genes tested by this process, set by zinb_worker_init
+ZINB_WORKER = {}
+
+def zinb_worker_init(params):
+    """Sets the data used by zinb_gene in this process, and defines the R
+    function zinb_signif in its R session for the R engine.
+
+    Arguments:
+        params (dict): The ZinbMethod ("method"), the normalized data, the
+            statistics of the replicates, the site indexes of the genes and the
+            conditions, covariates and interactions of the replicates, as passed
+            to ZinbMethod.run_zinb, and the debug flag.
+    """
+    ZINB_WORKER.clear()
+    ZINB_WORKER.update(params)
+    if params["method"].engine == "R":
+        ZINB_WORKER["r_zinb_signif"] = params["method"].def_r_zinb_signif()
+
+
+def zinb_gene(Rv):
+    """Runs ZINB for one gene with the data set by zinb_worker_init.
+
+    Arguments:
+        Rv (str): Id of the gene.
+
+    Returns:
+        tuple: (p-value, status) of the gene.
+    """
+    w = ZINB_WORKER
+    return w["method"].zinb_gene(Rv, w["RvSiteindexesMap"][Rv], w["data"], w["NZMeanByRep"], w["LogZPercByRep"],
+            w["conditions"], w["covariates"], w["interactions"], w.get("r_zinb_signif"), w["debug"])
+
+
 if __name__ == "__main__":
     main()
 
@@ -154,7 +154,7 @@ class MeanCountsMethod(base.SingleConditionMethod):
         self.transit_message("Getting Data")
         (fulldata, position) = tnseq_tools.get_data(self.ctrldata)
         (fulldata, factors) = norm_tools.normalize_data(fulldata, self.normalization, 
-            self.ctrldata, self.annotation_path)
+            self.ctrldata, self.annotation_path, inplace=True)
         position = position.astype(int)
 
         hash = transit_tools.get_pos_hash(self.annotation_path)
@@ -5,21 +5,52 @@ import scipy.optimize
 import warnings
 
 class NormMethod:
+    """Base class for normalization methods.
+
+    Ownership of the data: by default, normalize() leaves its input untouched
+    and returns a new array. With inplace=True, methods that only rescale
+    each dataset (nonorm, nzmean, totreads, TTR, emphist, zinfnb) multiply
+    the rows of a floating point input in place and return that same array,
+    so the caller must not expect the raw counts to be preserved. Methods that
+    transform the distribution of counts (quantile, betageom, aBGC) always
+    return a new array and ignore inplace.
+    """
     name = "undefined"
     @staticmethod
     def normalize():
         raise NotImplemented
 
+
+def scale_rows(data, factors, inplace=False):
+    """Multiplies each dataset (row) of the data by its normalization factor.
+
+    Arguments:
+        data (numpy array): (K,N) numpy array defining read-counts at N sites
+            for K datasets.
+        factors (numpy array): (K,1) numpy array with the normalization factors.
+        inplace (bool): If True and data is a floating point array, the rows are
+            scaled in place and data itself is returned. Integer arrays
+            cannot hold the scaled counts, so a new array is returned for them.
+
+    Returns:
+        numpy array: Array with the scaled data.
+    """
+    if inplace and isinstance(data, numpy.ndarray) and numpy.issubdtype(data.dtype, numpy.floating):
+        data *= factors
+        return data
+    return factors * data
+
 class NZMeanNorm(NormMethod):
     name = "nzmean"
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath=""):
+    def normalize(data, wigList=[], annotationPath="", inplace=False):
         """Returns the normalization factors for the data, using the NZMean method.
 
         Arguments:
             data (numpy array): (K,N) numpy array defining read-counts at N sites
                 for K datasets.
+            inplace (bool): Scale the rows of data in place (see :class:`NormMethod`).
 
         Returns:
             numpy array: Array with the normalization factors for the nzmean method.
@@ -47,7 +78,7 @@ class NZMeanNorm(NormMethod):
         grand_mean = grand_total/float(K)
         factors = numpy.zeros((K,1))
         factors[:,0] = grand_mean/mean_hits
-        data = factors * data
+        data = scale_rows(data, factors, inplace)
         return (data, factors)
 
 
@@ -56,13 +87,14 @@ class TotReadsNorm(NormMethod):
     name = "totreads"
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath=""):
+    def normalize(data, wigList=[], annotationPath="", inplace=False):
         """Returns the normalization factors for the data, using the total reads
         method.
 
         Arguments:
             data (numpy array): (K,N) numpy array defining read-counts at N sites
                 for K datasets.
+            inplace (bool): Scale the rows of data in place (see :class:`NormMethod`).
 
         Returns:
             numpy array: Array with the normalization factors for the totreads method.
@@ -90,7 +122,7 @@ class TotReadsNorm(NormMethod):
         grand_mean = grand_total/float(K)
         factors = numpy.zeros((K,1))
         factors[:,0] = grand_mean/mean_hits
-        data = factors * data
+        data = scale_rows(data, factors, inplace)
         return (data, factors)
 
 
@@ -155,7 +187,7 @@ class TTRNorm(NormMethod):
 
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath="", thetaEst=empirical_theta, muEst=trimmed_empirical_mu, target=100.0):
+    def normalize(data, wigList=[], annotationPath="", thetaEst=empirical_theta, muEst=trimmed_empirical_mu, target=100.0, inplace=False):
         """Returns the normalization factors for the data, using the TTR method.
 
 
@@ -166,6 +198,7 @@ class TTRNorm(NormMethod):
                 of counts as input.
             muEst (function): Function used to estimate mean count. Should take a list
                 of counts as input.
+            inplace (bool): Scale the rows of data in place (see :class:`NormMethod`).
 
         Returns:
             numpy array: Array with the normalization factors for the TTR method.
@@ -190,7 +223,7 @@ class TTRNorm(NormMethod):
         factors = numpy.zeros((K,1))
         for j in range(K):
             factors[j] = float(target)/(thetaEst(data[j]) * muEst(data[j]))
-        data = factors * data
+        data = scale_rows(data, factors, inplace)
         return (data, factors)
 
 
@@ -208,12 +241,13 @@ class EmpHistNorm(NormMethod):
         return negLL
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath=""):
+    def normalize(data, wigList=[], annotationPath="", inplace=False):
         """Returns the normalized data, using the empirical hist method.
 
         Arguments:
             wigList (list): List of paths to wig formatted datasets.
             annotationPath (str): Path to annotation in .prot_table or GFF3 format.
+            inplace (bool): Scale the rows of data in place (see :class:`NormMethod`).
 
         Returns:
             numpy array: Array with the normalization factors for the emphist method.
@@ -263,7 +297,7 @@ class EmpHistNorm(NormMethod):
             else:
                 factors[j,0] = 1.0/numpy.exp(abs(peakLogFC))
 
-        data = factors * data
+        data = scale_rows(data, factors, inplace)
         return (data, factors)
 
 
@@ -282,7 +316,7 @@ class AdaptiveBGCNorm(NormMethod):
             return x
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath="", doTotReads = True, bgsamples = 200000):
+    def normalize(data, wigList=[], annotationPath="", doTotReads = True, bgsamples = 200000, inplace=False):
         """Returns the normalized data using the aBGC method.
 
 
@@ -357,7 +391,7 @@ class AdaptiveBGCNorm(NormMethod):
                 norm_data[j,i] = cleaninfgeom(scipy.stats.geom.ppf(ecdf(BGsample, data[j,i]), best_rho), best_rho)
 
         if doTotReads:
-            (norm_data, factors) = TTRNorm.normalize(norm_data)
+            (norm_data, factors) = TTRNorm.normalize(norm_data, inplace=True)
         return (norm_data, bgc_factors)
 
 
@@ -366,7 +400,7 @@ class ZeroInflatedNBNorm(NormMethod):
     name = "zinfb"
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath=""):
+    def normalize(data, wigList=[], annotationPath="", inplace=False):
         """Returns the normalization factors for the data using the zero-inflated
         negative binomial method.
 
@@ -374,6 +408,7 @@ class ZeroInflatedNBNorm(NormMethod):
         Arguments:
             data (numpy array): (K,N) numpy array defining read-counts at N sites
                 for K datasets.
+            inplace (bool): Scale the rows of data in place (see :class:`NormMethod`).
 
         Returns:
             numpy array: Array with the normalization factors for the zinfnb method.
@@ -404,7 +439,7 @@ class ZeroInflatedNBNorm(NormMethod):
             pi, n, p = results.x
             mu = n*(1-p)/p
             factors[j,0] = 1.0/mu
-        data = factors * data
+        data = scale_rows(data, factors, inplace)
         return (data, factors)
 
 
@@ -412,7 +447,7 @@ class QuantileNorm(NormMethod):
     name = "quantile"
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath=""):
+    def normalize(data, wigList=[], annotationPath="", inplace=False):
         """Performs Quantile Normalization as described by Bolstad et al. 2003
 
         Arguments:
@@ -472,7 +507,7 @@ class BetaGeomNorm(NormMethod):
             return x
 
     @staticmethod
-    def normalize(data, wigList=[], annotationPath="", doTTR = True, bgsamples=200000):
+    def normalize(data, wigList=[], annotationPath="", doTTR = True, bgsamples=200000, inplace=False):
         """Returns normalized data according to the BGC method.
 
         Arguments:
@@ -529,14 +564,14 @@ class BetaGeomNorm(NormMethod):
                 norm_data[j,i] = cleaninfgeom(scipy.stats.geom.ppf(ecdf(BGsample, data[j,i]), 1.0/grand_mean), 1.0/grand_mean)
 
         if doTTR:
-            (norm_data, factors) = TTRNorm.normalize(norm_data)
+            (norm_data, factors) = TTRNorm.normalize(norm_data, inplace=True)
         return (norm_data, bgc_factors)
 
 
 class NoNorm(NormMethod):
     name = "nonorm"
     @staticmethod
-    def normalize(data, wigList=[], annotationPath=""):
+    def normalize(data, wigList=[], annotationPath="", inplace=False):
         return (data, numpy.ones(1))
 
 
@@ -553,7 +588,7 @@ methods["emphist"] = EmpHistNorm
 
 
 #########################
-def normalize_data(data, method="nonorm", wigList=[], annotationPath=""):
+def normalize_data(data, method="nonorm", wigList=[], annotationPath="", inplace=False):
     """Normalizes the numpy array by the given normalization method.
 
     Arguments:
@@ -562,6 +597,9 @@ def normalize_data(data, method="nonorm", wigList=[], annotationPath=""):
         method (str): Name of the desired normalization method.
         wigList (list): List of paths for the desired wig-formatted datasets.
         annotationPath (str): Path to the prot_table annotation file.
+        inplace (bool): If True, methods that rescale each dataset reuse the
+            buffer of data (if it is a float array) instead of allocating a
+            normalized copy; data must then be treated as consumed.
 
     Returns:
         numpy array: Array with the normalized data.
@@ -584,14 +622,17 @@ def normalize_data(data, method="nonorm", wigList=[], annotationPath=""):
 
     .. note:: Some normalization methods require the wigList and annotationPath arguments.
 
+    .. note:: With inplace=True the returned array may be the same object as
+        data (see :class:`NormMethod` for which methods do this).
+
     """
     factors = []
     if method in methods:
-        return methods[method].normalize(data, wigList, annotationPath)
+        return methods[method].normalize(data, wigList, annotationPath, inplace=inplace)
     else:
         warnstr = "Normalization method '%s' is unknown. Read-counts were not normalized." % (method)
         warnings.warn(warnstr)
-    return methods["nonorm"].normalize(data, wigList, annotationPath)
+    return methods["nonorm"].normalize(data, wigList, annotationPath, inplace=inplace)
 
 
 def empirical_theta(X):
@@ -651,6 +692,116 @@ def trimmed_empirical_mu(X, t=0.05):
 
     return scipy.stats.trim_mean(X[X > 0], t)
 
+#
+
+def update_count_histogram(hist, X):
+    """Adds the non-zero read-counts in X to a histogram of counts.
+
+    Read-counts take few distinct values (they are integers in raw wig files),
+    so a (values, counts) histogram summarizes an arbitrarily long dataset
+    in bounded memory, while still allowing exact calculation of statistics
+    that depend on the sorted data, like the trimmed mean used by TTR.
+
+    Arguments:
+        hist (tuple): Tuple of (values, counts) numpy arrays, or None to start a new histogram.
+        X (numpy array): (N) numpy array defining read-counts at N sites.
+
+    Returns:
+        tuple: Updated (values, counts) histogram of the non-zero read-counts.
+
+    .. seealso:: :class:`trimmed_mean_from_histogram` :class:`streaming_factors`
+    """
+    values, counts = numpy.unique(X[X > 0], return_counts=True)
+    if hist is not None:
+        values, inverse = numpy.unique(numpy.concatenate([hist[0], values]), return_inverse=True)
+        counts = numpy.bincount(inverse, weights=numpy.concatenate([hist[1], counts])).astype(numpy.int64)
+    return (values, counts)
+
+
+def trimmed_mean_from_histogram(values, counts, t=0.05):
+    """Estimates the trimmed mean of the data summarized by a histogram.
+
+    Gives the same result as scipy.stats.trim_mean on the expanded data, i.e.
+    int(t*n) values are cut from each end of the sorted data.
+
+    Arguments:
+        values (numpy array): Sorted distinct values of the data.
+        counts (numpy array): Number of occurrences of each value.
+        t (float): Float specifying fraction of start and end to trim.
+
+    Returns:
+        float: (Trimmed) Mean of the data.
+
+    .. seealso:: :class:`update_count_histogram`
+    """
+    n = int(numpy.sum(counts))
+    lowercut = int(t * n)
+    uppercut = n - lowercut
+    if lowercut >= uppercut:
+        raise ValueError("Proportion too big.")
+    end = numpy.cumsum(counts)
+    start = end - counts
+    kept = numpy.clip(numpy.minimum(end, uppercut) - numpy.maximum(start, lowercut), 0, None)
+    return numpy.sum(values * kept)/float(uppercut - lowercut)
+
+
+def streaming_factors(chunks, method="TTR", target=100.0):
+    """Returns the normalization factors computed in one bounded-memory pass over
+    blocks of sites, without holding the full (K,N) matrix.
+
+    Only the methods whose factors depend on per-dataset summaries of the
+    counts can be computed this way ("TTR", "nzmean", "totreads" and "nonorm").
+
+    Arguments:
+        chunks (iterable): Iterable of (K,n) numpy arrays with read-counts at
+            consecutive blocks of sites, e.g. from tnseq_tools.read_combined_wig_chunks.
+        method (str): Name of the desired normalization method.
+        target (float): Target mean for the TTR method.
+
+    Returns:
+        numpy array: (K,1) array with the normalization factors.
+
+    :Example:
+        >>> import pytransit.norm_tools as norm_tools
+        >>> import pytransit.tnseq_tools as tnseq_tools
+        >>> chunks = (data for (sites, data) in tnseq_tools.read_combined_wig_chunks("transit/data/cholesterol_glycerol_combined.dat"))
+        >>> factors = norm_tools.streaming_factors(chunks, "TTR")
+
+    .. seealso:: :class:`normalize_data` :class:`update_count_histogram`
+    """
+    if method not in streaming_methods:
+        raise ValueError("Normalization method '%s' cannot be computed in streaming mode (use one of: %s)." % (method, ", ".join(streaming_methods)))
+
+    hists = None
+    N = 0
+    for data in chunks:
+        if hists is None: hists = [None] * len(data)
+        for j in range(len(data)):
+            hists[j] = update_count_histogram(hists[j], data[j])
+        N += data.shape[1]
+
+    K = len(hists) if hists else 0
+    if method == "nonorm":
+        return numpy.ones((K,1))
+
+    factors = numpy.zeros((K,1))
+    TAs_hit = numpy.array([numpy.sum(c) for (v,c) in hists], dtype=float)
+    total_hits = numpy.array([numpy.sum(v*c) for (v,c) in hists], dtype=float)
+    if method == "TTR":
+        for j,(values, counts) in enumerate(hists):
+            theta = TAs_hit[j]/N
+            mu = trimmed_mean_from_histogram(values, counts)
+            factors[j] = float(target)/(theta * mu)
+    elif method == "nzmean":
+        mean_hits = total_hits/TAs_hit
+        factors[:,0] = numpy.mean(mean_hits)/mean_hits
+    elif method == "totreads":
+        mean_hits = total_hits/float(N)
+        factors[:,0] = numpy.mean(mean_hits)/mean_hits
+    return factors
+
+streaming_methods = ["nonorm", "TTR", "nzmean", "totreads"]
+
 
 def Fzinfnb(params, args):
     """Objective function for the zero-inflated NB method."""
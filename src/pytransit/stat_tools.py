@@ -2,6 +2,8 @@ import math
 import numpy
 import sys
 import scipy.stats
+import scipy.special
+import scipy.optimize
 
 
 
@@ -349,23 +351,20 @@ def phi_coefficient(X,Y):
 #
 
 def BH_fdr_correction(X):
-    """Adjusts p-values using the Benjamini Hochberg procedure"""
-    n = len(X)
-    qvalues = numpy.zeros(n)
-    pvalues = numpy.array(X)
-    pvalues.sort()
-    pvalues = pvalues[::-1]
-    
-    for i in range(n):
-        rank = n - i
-        qvalues[i] = n/float(rank) * pvalues[i]
- 
-    for i in range(0, n-1):
-        if qvalues[i] < qvalues[i+1]:
-            qvalues[i+1] = qvalues[i]
-        
-    p2qval = dict([(p,q) for (p,q) in zip(pvalues,qvalues)])
-    return numpy.array([p2qval[p] for p in X])
+    """Adjusts p-values using the Benjamini Hochberg procedure. Only the finite
+    p-values are adjusted (and counted); the others are left as NaN."""
+    pvalues = numpy.array(X, dtype=float)
+    result = numpy.full(len(pvalues), numpy.nan)
+    mask = numpy.isfinite(pvalues)
+    n = numpy.sum(mask)
+    if n == 0: return result
+    psorted = numpy.sort(pvalues[mask])
+    rank = numpy.arange(1, n+1)
+    # Running minimum from the largest p-value down
+    qvalues = numpy.minimum.accumulate((n/rank.astype(float) * psorted)[::-1])[::-1]
+    # Tied p-values get the same adjusted value (that of the lowest rank among them)
+    result[mask] = qvalues[numpy.searchsorted(psorted, pvalues[mask], side="left")]
+    return result
 
 #
 
@@ -413,6 +412,243 @@ def bayesian_ess_thresholds(Z_raw, ALPHA=0.05):
 
 #
 
+def split_chains(samples):
+    """Splits each MCMC chain into its first and second halves, dropping the
+    middle sample of odd-length chains (samples is chains x iterations x ...)."""
+    samples = numpy.asarray(samples, dtype=float)
+    half = samples.shape[1] // 2
+    return numpy.concatenate([samples[:,:half], samples[:,samples.shape[1]-half:]], axis=0)
+
+#
+
+def split_rhat(samples):
+    """Potential scale reduction factor (R-hat) of MCMC samples, computed on
+    split chains so that it also detects non-stationarity within a chain
+    (Gelman et al., Bayesian Data Analysis, 3rd ed.).
+
+    Arguments:
+        samples (numpy.array): Samples as chains x iterations, optionally with
+            trailing dimensions for several parameters at once.
+
+    Returns:
+        float or numpy.array: R-hat of each parameter. Values close to 1 indicate
+            that the chains have mixed. NaN for parameters constant in all chains.
+    """
+    X = split_chains(samples)
+    n = X.shape[1]
+    W = numpy.mean(numpy.var(X, axis=1, ddof=1), axis=0)
+    B_n = numpy.var(numpy.mean(X, axis=1), axis=0, ddof=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.sqrt(((n-1.0)/n*W + B_n) / W)
+
+#
+
+def effective_sample_size(samples):
+    """Effective sample size of MCMC samples, from the autocorrelations of the
+    split chains combined across chains and truncated at Geyer's initial
+    monotone positive sequence (Gelman et al., Bayesian Data Analysis, 3rd ed.).
+
+    Arguments:
+        samples (numpy.array): Samples as chains x iterations, optionally with
+            trailing dimensions for several parameters at once.
+
+    Returns:
+        float or numpy.array: Effective sample size of each parameter. NaN for
+            parameters constant in all chains.
+    """
+    X = split_chains(samples)
+    (m, n) = X.shape[:2]
+    means = numpy.mean(X, axis=1)
+    # Autocovariances of every chain at all lags, through the FFT
+    F = numpy.fft.rfft(X - means[:,numpy.newaxis], n=2*n, axis=1)
+    acov = numpy.fft.irfft(F*numpy.conj(F), n=2*n, axis=1)[:,:n] / n
+    W = numpy.mean(acov[:,0], axis=0) * n/(n-1.0)
+    var_plus = (n-1.0)/n*W + numpy.var(means, axis=0, ddof=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        rho = 1.0 - (W - numpy.mean(acov, axis=0)) / var_plus
+        # Sums of adjacent pairs of autocorrelations, kept up to the first
+        # negative pair and made monotone decreasing
+        P = rho[:2*(n//2):2] + rho[1:2*(n//2):2]
+        P = numpy.minimum.accumulate(numpy.where(numpy.cumprod(P > 0, axis=0) > 0, P, 0.0), axis=0)
+        tau = -1.0 + 2.0*numpy.sum(P, axis=0)
+        return numpy.where(var_plus > 0, m*n / tau, numpy.nan)
+
+#
+
+def mannwhitneyu_segments(x, y, xseg, yseg, nseg):
+    """Two-sided Mann-Whitney U-tests of many pairs of samples at once.
+
+    The samples of test s are x[xseg == s] and y[yseg == s]. All the values are
+    ranked with a single sort by (test, value), and U and its tie-corrected
+    normal approximation (with continuity correction) are computed for all the
+    tests together. As in scipy.stats.mannwhitneyu (method="auto"), tests with
+    a sample of at most 8 values and no ties use the exact distribution of U
+    instead; these are done one at a time with scipy.
+
+    Arguments:
+        x (numpy.array): Values of the first samples.
+        y (numpy.array): Values of the second samples.
+        xseg (numpy.array): Test (0 to nseg-1) of each value of x.
+        yseg (numpy.array): Test (0 to nseg-1) of each value of y.
+        nseg (int): Number of tests.
+
+    Returns:
+        tuple: (U, pval) numpy arrays with the U statistic of the first sample
+            and the two-sided p-value of each test. NaN for tests with an empty
+            sample.
+    """
+    values = numpy.concatenate([x, y]).astype(float)
+    seg = numpy.concatenate([xseg, yseg]).astype(int)
+    isx = numpy.arange(len(values)) < len(x)
+    n1 = numpy.bincount(xseg, minlength=nseg).astype(float)
+    n2 = numpy.bincount(yseg, minlength=nseg).astype(float)
+    n = n1 + n2
+
+    order = numpy.lexsort((values, seg))
+    (values, seg, isx) = (values[order], seg[order], isx[order])
+    segstart = numpy.searchsorted(seg, numpy.arange(nseg+1))
+
+    # Groups of tied values within a test, and their average rank in the test
+    new = numpy.ones(len(values), dtype=bool)
+    new[1:] = (seg[1:] != seg[:-1]) | (values[1:] != values[:-1])
+    first = numpy.flatnonzero(new)
+    t = numpy.diff(numpy.append(first, len(values))).astype(float)
+    ranks = numpy.repeat(first - segstart[seg[first]] + (t+1)/2.0, t.astype(int))
+
+    R1 = numpy.bincount(seg[isx], weights=ranks[isx], minlength=nseg)
+    U1 = R1 - n1*(n1+1)/2
+    U = numpy.maximum(U1, n1*n2 - U1)
+    tie_term = numpy.bincount(seg[first], weights=t**3 - t, minlength=nseg)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        s = numpy.sqrt(n1*n2/12 * ((n + 1) - tie_term/(n*(n-1))))
+        z = (U - n1*n2/2 - 0.5) / s
+    pval = numpy.clip(2*scipy.special.ndtr(-z), 0.0, 1.0)
+
+    ties = numpy.bincount(seg[first], weights=t > 1, minlength=nseg) > 0
+    empty = (n1 == 0) | (n2 == 0)
+    for i in numpy.flatnonzero(((n1 <= 8) | (n2 <= 8)) & ~ties & ~empty):
+        (a, b) = (segstart[i], segstart[i+1])
+        pval[i] = scipy.stats.mannwhitneyu(values[a:b][isx[a:b]], values[a:b][~isx[a:b]], alternative="two-sided")[1]
+    U1[empty] = numpy.nan
+    pval[empty] = numpy.nan
+    return (U1, pval)
+
+#
+
+def zinb_loglik(params, y, X, Z=None, offset=0.0, offset_infl=0.0):
+    """Log-likelihood of a negative binomial regression, optionally zero-inflated,
+    and its gradient.
+
+    The counts have mean mu = exp(X*beta + offset) and dispersion theta
+    (variance mu + mu^2/theta). With Z, each count is also a structural zero
+    with probability pi = logistic(Z*gamma + offset_infl), as in pscl::zeroinfl.
+
+    Arguments:
+        params (numpy.array): beta, then gamma (only with Z), then log(theta).
+        y (numpy.array): Counts.
+        X (numpy.array): Design matrix of the counts (observations x coefficients).
+        Z (numpy.array): Design matrix of the zero-inflation, or None for a
+            negative binomial regression.
+        offset (numpy.array): Offset of the log mean of the counts.
+        offset_infl (numpy.array): Offset of the logit of the zero-inflation.
+
+    Returns:
+        tuple: (loglik, gradient) of the log-likelihood with respect to params.
+    """
+    p = X.shape[1]
+    q = Z.shape[1] if Z is not None else 0
+    beta = params[:p]
+    theta = numpy.exp(params[-1])
+    log_mu = numpy.dot(X, beta) + offset
+    mu = numpy.exp(log_mu)
+    # log(theta/(theta+mu)) and log(mu/(theta+mu))
+    log_p0 = -numpy.logaddexp(0.0, log_mu - params[-1])
+    log_p1 = -numpy.logaddexp(0.0, params[-1] - log_mu)
+    ratio = numpy.exp(log_p1)    # mu/(theta+mu)
+    loglik_nb = (scipy.special.gammaln(y+theta) - scipy.special.gammaln(theta) - scipy.special.gammaln(y+1)
+                 + theta*log_p0 + y*log_p1)
+    dnb_deta = theta*(y - mu)/(theta + mu)
+    dnb_dlogtheta = theta*(scipy.special.digamma(y+theta) - scipy.special.digamma(theta) + log_p0 + 1 - (y+theta)/(theta+mu))
+
+    if Z is None:
+        loglik = numpy.sum(loglik_nb)
+        grad = numpy.concatenate([numpy.dot(dnb_deta, X), [numpy.sum(dnb_dlogtheta)]])
+        return (loglik, grad)
+
+    eta_infl = numpy.dot(Z, params[p:p+q]) + offset_infl
+    log_pi = -numpy.logaddexp(0.0, -eta_infl)
+    log_1mpi = -numpy.logaddexp(0.0, eta_infl)
+    pi = numpy.exp(log_pi)
+    zero = (y == 0)
+    # Zeros are structural (with posterior probability w) or from the negative binomial
+    log_f0 = theta*log_p0
+    loglik_zero = numpy.logaddexp(log_pi, log_1mpi + log_f0)
+    w = numpy.exp(log_pi - loglik_zero)
+    loglik = numpy.sum(numpy.where(zero, loglik_zero, log_1mpi + loglik_nb))
+    deta = numpy.where(zero, (1-w)*(-theta*ratio), dnb_deta)
+    deta_infl = numpy.where(zero, w - pi, -pi)
+    dlogtheta = numpy.where(zero, (1-w)*theta*(log_p0 + ratio), dnb_dlogtheta)
+    grad = numpy.concatenate([numpy.dot(deta, X), numpy.dot(deta_infl, Z), [numpy.sum(dlogtheta)]])
+    return (loglik, grad)
+
+#
+
+def zinb_fit(y, X, Z=None, offset=0.0, offset_infl=0.0, start=None, hessian=False):
+    """Maximum likelihood fit of a negative binomial regression, optionally
+    zero-inflated (see zinb_loglik), with BFGS on the analytic gradient.
+
+    Arguments:
+        y (numpy.array): Counts.
+        X (numpy.array): Design matrix of the counts.
+        Z (numpy.array): Design matrix of the zero-inflation, or None.
+        offset (numpy.array): Offset of the log mean of the counts.
+        offset_infl (numpy.array): Offset of the logit of the zero-inflation.
+        start (numpy.array): Initial params, e.g. from the fit of a nested model.
+            Defaults to intercepts matching the mean of the non-zero counts and the
+            fraction of zeros, and theta = 1.
+        hessian (bool): Whether to also return the Hessian of the log-likelihood
+            at the optimum, by finite differences of the gradient (as optim in R).
+
+    Returns:
+        tuple: (params, loglik, H, converged, message), with H None unless hessian is
+        True, whether the optimizer converged and its message.
+    """
+    y = numpy.asarray(y, dtype=float)
+    q = Z.shape[1] if Z is not None else 0
+    if start is None:
+        start = numpy.zeros(X.shape[1] + q + 1)
+        nonzero = y[y > 0]
+        start[0] = numpy.log(numpy.mean(nonzero) if len(nonzero) else 0.5) - numpy.mean(offset)
+        if Z is not None:
+            zeros = numpy.clip(numpy.mean(y == 0), 0.01, 0.99)
+            start[X.shape[1]] = numpy.log(zeros/(1-zeros)) - numpy.mean(offset_infl)
+
+    def negloglik(params):
+        (loglik, grad) = zinb_loglik(params, y, X, Z, offset, offset_infl)
+        return (-loglik, -grad)
+
+    with numpy.errstate(over="ignore", under="ignore"):
+        result = scipy.optimize.minimize(negloglik, start, jac=True, method="BFGS", options={"gtol": 1e-6, "maxiter": 10000})
+        params = result.x
+        loglik = zinb_loglik(params, y, X, Z, offset, offset_infl)[0]
+        H = None
+        if hessian:
+            h = 1e-3
+            H = numpy.zeros((len(params), len(params)))
+            for i in range(len(params)):
+                step = numpy.zeros(len(params))
+                step[i] = h
+                H[:,i] = (zinb_loglik(params + step, y, X, Z, offset, offset_infl)[1] -
+                          zinb_loglik(params - step, y, X, Z, offset, offset_infl)[1]) / (2*h)
+            H = (H + H.T) / 2
+    # BFGS often stops on a loss of precision in the line search at the optimum, with a
+    # gradient just above gtol; as with the relative tolerance of optim in R, this is a
+    # converged fit. Reaching maxiter or a non-finite log-likelihood is not.
+    converged = result.success or (result.status == 2 and numpy.all(numpy.abs(result.jac) <= 1e-4))
+    return (params, loglik, H, converged, result.message)
+
+#
+
 def tricube(X):
     #TODO: Write docstring
     result = numpy.zeros(len(X))
@@ -500,29 +736,178 @@ def F_sum_diff_dict(*args, **kwargs):
 
 def F_shuffle_flat(*args, **kwargs):
     X = args[0]
-    return numpy.random.permutation(X)
+    rng = kwargs.get("rng", numpy.random)
+    return rng.permutation(X)
 
 #
 
 def F_shuffle_dict_libraries(*args, **kwargs):
     D = args[0]
+    rng = kwargs.get("rng", numpy.random)
     E = {}
     for L in D:
         #print("L", L)
         n1 = len(D[L][0])
         combined = numpy.append(D[L][0], D[L][1])
         #print("combined", combined)
-        perm = numpy.random.permutation(combined)
+        perm = rng.permutation(combined)
         #print("perm", perm)
         #print("perm[:n1]", perm[:n1])
-        E[L] = numpy.array([perm[:n1], perm[n1:]])
+        E[L] = (perm[:n1], perm[n1:])
         #print("D[L]", D[L])
     return E
 
 #
 
+def permutation_block_sizes(S, adaptive=False, blocksize=1024):
+    """Splits S permutations into blocks, with block boundaries at the
+    checkpoints of adaptive resampling (1%, 10% and 100% of S)."""
+    stops = set(range(blocksize, S, blocksize))
+    stops.add(S)
+    if adaptive:
+        stops.update([int(round(S*0.01)), int(round(S*0.1))])
+    stops = sorted(x for x in stops if 0 < x <= S)
+    sizes = numpy.diff([0] + stops)
+    return [int(b) for b in sizes]
+
+#
+
+def sequential_stopping_count(S, alpha=0.05):
+    """Returns the number of extreme permutations, h, after which a permutation
+    test with S samples can stop (Besag and Clifford, 1991).
+
+    With h = floor(alpha*S) + 1, a gene that has seen h permutations as or more
+    extreme than the observed statistic would have a p-value above alpha with
+    all S permutations, so the significance call at level alpha is the same as
+    for the fixed-S test. Once stopped after L permutations, the p-value h/L has
+    a relative standard error of about 1/sqrt(h).
+    """
+    return int(math.floor(alpha*S)) + 1
+
+#
+
+def sequential_block_sizes(S, h, blocksize=1024):
+    """Splits S permutations into geometrically growing blocks for sequential
+    stopping: h, 2h, 4h, ... permutations, each at most blocksize. A gene can
+    not stop before h permutations, and growing the blocks keeps the work
+    wasted past the stopping point below the work already done."""
+    sizes = []
+    total = 0
+    B = max(1, min(h, blocksize))
+    while total < S:
+        B = min(B, blocksize, S - total)
+        sizes.append(B)
+        total += B
+        if total >= h:
+            B = 2*B
+    return sizes
+
+#
+
+def batched_permutation_test(data1, data2, test_obs, S=10000, statistic="mean",
+            adaptive=False, blocksize=None, rng=None, h=None, lib_str1="", lib_str2=""):
+    """Counts the permutations of the pooled data that are as or more extreme than
+    the observed statistic, drawing many permutations at once.
+
+    Each block of permutations is drawn as a (B, n1+n2) matrix of random keys;
+    the n1 smallest keys of every row select the observations that go to the
+    first group (a uniformly random split), so the group sums of all B
+    permutations are obtained with one gather and one row-sum, and the tails
+    are counted with vectorized comparisons.
+
+    With library strings, the pooled data are laid out library by library (see
+    get_lib_data_array) and each library segment is split separately, with its
+    own block of keys, so observations are only exchanged within libraries.
+
+    Args:
+        data1: Numpy array with the first set of observations.
+        data2: Numpy array with the second set of observations.
+        test_obs: Observed value of the test statistic.
+        S: Number of permutations.
+        statistic: "mean" for the difference in means (F_mean_diff_flat) or
+                "sum" for the difference in sums (F_sum_diff_flat).
+        adaptive: Cuts-off resampling early, with the same checkpoints as resampling().
+        blocksize: Number of permutations drawn per block. Memory use is about
+                16*blocksize*(n1+n2) bytes. Default: enough permutations to draw
+                about a million keys per block.
+        rng: numpy RandomState used to draw the permutations. Default: the
+                global numpy.random state.
+        h: Stops right after the h-th permutation whose statistic is as or more
+                extreme (two-tailed) than test_obs. See sequential_stopping_count.
+                Replaces the checkpoints of adaptive. Default: None (no stopping).
+        lib_str1: String of letters with the library of each dataset in data1.
+        lib_str2: String of letters with the library of each dataset in data2.
+
+    Returns:
+        Tuple with count_ltail, count_utail, count_2tail, the number of
+        permutations performed, and the list of sampled statistics.
+    """
+    n1 = len(data1)
+    n2 = len(data2)
+    n = n1 + n2
+    if lib_str1:
+        nTAs = n1//len(lib_str1)
+        (perm, segments) = get_lib_data_array(data1, lib_str1, data2, lib_str2, nTAs)
+    else:
+        perm = numpy.concatenate([data1, data2]).astype(float)
+        segments = [(0, n1, n2)]
+    total = numpy.sum(perm)
+    if rng is None:
+        rng = numpy.random
+    if not blocksize:
+        blocksize = max(1, min(S, 2**20 // n))
+
+    count_ltail = 0
+    count_utail = 0
+    count_2tail = 0
+    test_list = []
+    s_performed = 0
+    if h:
+        sizes = sequential_block_sizes(S, h, blocksize)
+    else:
+        sizes = permutation_block_sizes(S, adaptive, blocksize)
+    for B in sizes:
+        sum1 = numpy.zeros(B)
+        for (start, m1, m2) in segments:
+            if m2 == 0:
+                sum1 += numpy.sum(perm[start:start+m1])
+            elif m1 > 0:
+                keys = rng.random_sample((B, m1+m2))
+                index = numpy.argpartition(keys, m1-1, axis=1)[:, :m1]
+                sum1 += numpy.sum(perm[start:start+m1+m2][index], axis=1)
+        if statistic == "sum":
+            test_sample = (total - sum1) - sum1
+        else:
+            test_sample = (total - sum1)/n2 - sum1/n1
+
+        if h:
+            # Keep the permutations up to (and including) the h-th extreme one
+            extreme = numpy.cumsum(numpy.abs(test_sample) >= abs(test_obs))
+            if count_2tail + extreme[-1] >= h:
+                B = int(numpy.searchsorted(extreme, h - count_2tail)) + 1
+                test_sample = test_sample[:B]
+
+        count_ltail += int(numpy.sum(test_sample <= test_obs))
+        count_utail += int(numpy.sum(test_sample >= test_obs))
+        count_2tail += int(numpy.sum(numpy.abs(test_sample) >= abs(test_obs)))
+        test_list.extend(test_sample.tolist())
+
+        s_performed += B
+        if h:
+            if count_2tail >= h:
+                break
+        elif adaptive:
+            if s_performed == round(S*0.01) or s_performed == round(S*0.1) or s_performed == round(S*1):
+                    if count_2tail >= round(S*0.01*0.10):
+                        break
+
+    return (count_ltail, count_utail, count_2tail, s_performed, test_list)
+
+#
+
 def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
-            permFunc=F_shuffle_flat, adaptive=False, lib_str1="", lib_str2="",PC=1):
+            permFunc=F_shuffle_flat, adaptive=False, lib_str1="", lib_str2="",PC=1, blocksize=None, rng=None,
+            sequential=False, alpha=0.05):
     """Does a permutation test on two sets of data.
 
     Performs the resampling / permutation test given two sets of data using a
@@ -540,6 +925,18 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
                 one argument, the combined set of data. Default is random
                 shuffle.
         adaptive: Cuts-off resampling early depending on significance.
+        blocksize: Number of permutations drawn at once when the default
+                (flat mean or sum difference, random shuffle) test is used.
+                See batched_permutation_test.
+        rng: numpy RandomState used for the permutations (also passed to
+                permFunc as the keyword argument 'rng'). Default: the global
+                numpy.random state.
+        sequential: Stops resampling as soon as the two-tailed p-value is known
+                to be above alpha (Besag-Clifford sequential p-value). Genes that
+                are significant at level alpha still use all S permutations, and
+                the significance call is the same as with the fixed-S test.
+                Takes precedence over adaptive.
+        alpha: Significance level used by sequential.
 
     Returns:
         Tuple with described values
@@ -550,7 +947,8 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
             - pval_ltail -- Lower tail p-value.
             - pval_utail -- Upper tail p-value.
             - pval_2tail -- Two-tailed p-value.
-            - test_sample -- List of samples of the test statistic.
+            - test_sample -- List of samples of the test statistic, one per
+              permutation performed.
     
     :Example:
         >>> import pytransit.stat_tools as stat_tools
@@ -630,6 +1028,25 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
 
 
 
+    h = sequential_stopping_count(S, alpha) if sequential else None
+
+    # The default tests (difference of means or sums, shuffling freely or within
+    # libraries) are computed with the vectorized kernel; custom functions use
+    # the loop below.
+    if lib_str1:
+        batched = permFunc == F_shuffle_dict_libraries and testFunc in (F_mean_diff_dict, F_sum_diff_dict)
+    else:
+        batched = permFunc == F_shuffle_flat and testFunc in (F_mean_diff_flat, F_sum_diff_flat)
+    if batched:
+        statistic = "sum" if testFunc in (F_sum_diff_flat, F_sum_diff_dict) else "mean"
+        (count_ltail, count_utail, count_2tail, s_performed, test_list) = batched_permutation_test(data1, data2,
+                test_obs, S=S, statistic=statistic, adaptive=adaptive, blocksize=blocksize, rng=rng, h=h,
+                lib_str1=lib_str1, lib_str2=lib_str2)
+        pval_ltail = count_ltail/float(s_performed)
+        pval_utail = count_utail/float(s_performed)
+        pval_2tail = count_2tail/float(s_performed)
+        return (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, test_list)
+
     count_ltail = 0
     count_utail = 0
     count_2tail = 0
@@ -637,7 +1054,7 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
     s_performed = 0
     for s in range(S):
         if len(perm) >0:
-            perm = permFunc(perm)
+            perm = permFunc(perm, rng=rng) if rng is not None else permFunc(perm)
             if not lib_str1:
                 test_sample = testFunc(perm[:n1], perm[n1:])
             else:
@@ -651,7 +1068,10 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
         if abs(test_sample) >= abs(test_obs): count_2tail+=1
 
         s_performed+=1
-        if adaptive:
+        if h:
+            if count_2tail >= h:
+                break
+        elif adaptive:
             if s_performed == round(S*0.01) or s_performed == round(S*0.1) or s_performed == round(S*1):
                     if count_2tail >= round(S*0.01*0.10):
                         break
@@ -717,7 +1137,8 @@ def combine_lib_dicts(L1, L2):
     KEYS = L1.keys()
     DATA = {}
     for K in KEYS:
-        DATA[K] = numpy.array([L1[K], L2[K]])
+        # Libraries can have different numbers of datasets in each condition
+        DATA[K] = (L1[K], L2[K])
     return DATA
 
 #
@@ -732,6 +1153,34 @@ def get_lib_data_dict(data1, ctrl_lib_str, data2, exp_lib_str, nTAs):
     data_dict = combine_lib_dicts(lib1_data_dict, lib2_data_dict)
     return data_dict
 
+#
+
+def get_lib_data_array(data1, ctrl_lib_str, data2, exp_lib_str, nTAs):
+    """Lays out two sets of observations library by library in one flat array.
+
+    For each library (in sorted order) the array holds the observations of data1
+    from that library followed by those of data2, so that a permutation within
+    libraries only needs to shuffle each segment.
+
+    Returns:
+        tuple: (data, segments), where segments is a list of (start, n1, n2)
+            for each library: the offset of the segment in data and the number
+            of observations from data1 and data2.
+    """
+    lib1_index_dict = parse_lib_index(len(data1), ctrl_lib_str, nTAs)
+    lib2_index_dict = parse_lib_index(len(data2), exp_lib_str, nTAs)
+
+    parts = []
+    segments = []
+    start = 0
+    for L in sorted(lib1_index_dict):
+        X1 = data1[lib1_index_dict[L]]
+        X2 = data2[lib2_index_dict[L]]
+        parts.extend([X1, X2])
+        segments.append((start, len(X1), len(X2)))
+        start += len(X1) + len(X2)
+    return (numpy.concatenate(parts).astype(float), segments)
+
 
 #TEST-CASES
 
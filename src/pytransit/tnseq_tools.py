@@ -33,6 +33,49 @@ def rv_siteindexes_map(genes, TASiteindexMap, nterm=0.0, cterm=0.0):
         RvSiteindexesMap[gene["rv"]] = siteindexes
     return RvSiteindexesMap
 
+def gene_site_index(annotation, position, nterm=0.0, cterm=0.0):
+    """Maps the sites to the genes of the annotation, as flat arrays of (site, gene)
+    pairs, without building Gene objects. Sites are assigned to genes as in the
+    Genes class (keeping start/stop codons), so that per-gene statistics can be
+    computed with segment reductions (e.g. numpy.bincount over the gene index).
+
+    Arguments:
+        annotation (str): Path to annotation in .prot_table or GFF3 format.
+        position (numpy.array): Sorted coordinates of the sites.
+        nterm (float): Percentage of the N-terminus to ignore.
+        cterm (float): Percentage of the C-terminus to ignore.
+
+    Returns:
+        tuple: (orfs, site, gene), with orfs the list of gene ids in the order of
+        the annotation, and site and gene the arrays with the index of the site
+        and of the gene of every pair, sorted by gene and then by site.
+    """
+    isProt = os.path.splitext(annotation)[1].lower() not in [".gff", ".gff3"]
+    orf2info = get_gene_info(annotation)
+    orfs = []
+    for line in open(annotation):
+        if line.startswith("#"): continue
+        tmp = line.split("\t")
+        if isProt:
+            orfs.append(tmp[8].strip())
+        else:
+            features = dict([tuple(f.split("=",1)) for f in filter(lambda x: "=" in x, tmp[8].split(";"))])
+            orfs.append(features["ID"])
+
+    position = numpy.asarray(position)
+    start = numpy.array([orf2info.get(orf, ["", "", 0, 0, "+"])[2] for orf in orfs], dtype=int)
+    end = numpy.array([orf2info.get(orf, ["", "", 0, 0, "+"])[3] for orf in orfs], dtype=int)
+    lo = numpy.searchsorted(position, start, "left")
+    hi = numpy.searchsorted(position, end, "right")
+    counts = numpy.maximum(hi - lo, 0)
+
+    gene = numpy.repeat(numpy.arange(len(orfs)), counts)
+    site = numpy.arange(numpy.sum(counts)) + numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        fraction = (position[site] - start[gene]) / (end - start)[gene].astype(float)
+    keep = (fraction >= (nterm/100.0)) & (fraction <= ((100-cterm)/100.0))
+    return (orfs, site[keep], gene[keep])
+
 # format:
 #   header lines (prefixed by '#'), followed by lines with counts
 #   counts lines contain the following columns: TA coord, counts, other info like gene/annotation
@@ -66,6 +109,40 @@ def read_combined_wig(fname):
 
     return (numpy.array(sites), numpy.array(countsByWig), files)
 
+def read_combined_wig_filenames(fname):
+    """
+        Read only the "#File: " header lines of a combined wig-file
+        :: Filename -> [Filename]
+    """
+    files = []
+    with open(fname) as f:
+        for line in f:
+            if line.startswith("#File: "):
+                files.append(line.rstrip()[7:])
+    return files
+
+def read_combined_wig_chunks(fname, chunksize=100000):
+    """
+        Iterate over a combined wig-file in blocks of at most chunksize sites,
+        so that the full (K,N) matrix never has to be held in memory
+        :: (Filename, Integer) -> Iterator(Tuple([Site], [WigData]))
+        Site :: Integer
+        WigData :: [Number]  (one row per file, one column per site in the block)
+    """
+    nfiles = len(read_combined_wig_filenames(fname))
+    sites, counts = [], []
+    with open(fname) as f:
+        for line in f:
+            if line[0]=='#': continue
+            cols = line.split("\t")[0:1+nfiles] # additional columns at end could contain gene info
+            sites.append(int(cols[0]))
+            counts.append([float(c) for c in cols[1:]])
+            if len(sites) >= chunksize:
+                yield (numpy.array(sites), numpy.array(counts).reshape(-1, nfiles).T)
+                sites, counts = [], []
+    if sites:
+        yield (numpy.array(sites), numpy.array(counts).reshape(-1, nfiles).T)
+
 def read_samples_metadata(metadata_file, covarsToRead = [], interactionsToRead = [], condition_name="Condition"):
     """
       Filename -> ConditionMap
@@ -442,6 +519,10 @@ class Genes:
             cterm (float): Float number of the fraction of the C-terminus to ignore.
             include_nc (bool): Boolean determining whether to include non-coding areas.
             data (list): List of data. Used to define the object without files.
+                Note that the Genes object takes ownership of this array: counts
+                below minread are zeroed in place, and normalization (if norm
+                is given) rescales it in place. Pass a copy if the original
+                counts are still needed.
             position (list): List of position of sites. Used to define the object without files.
 
 
@@ -473,13 +554,14 @@ class Genes:
             else:
                 (data, position) = get_data_zero_fill(self.wigList)
 
-        ii_min = data < self.minread
-        data[ii_min] = 0
+        # One row at a time, so the mask is (N) instead of (K,N)
+        for row in data:
+            row[row < self.minread] = 0
 
         hash = get_pos_hash(self.annotation)
 
         if not noNorm:
-            (data, factors) = norm_tools.normalize_data(data, norm, self.wigList, self.annotation)
+            (data, factors) = norm_tools.normalize_data(data, norm, self.wigList, self.annotation, inplace=True)
         else:
             factors = []
 
@@ -757,6 +839,27 @@ def tossify(data):
 
 #
 
+def run_intervals(data):
+    """Returns the coordinates of the runs of consecutive non-insertions.
+
+    The runs are found from the edges of the non-insertion indicator
+    (numpy.diff), without iterating over the sites in Python.
+
+    Arguments:
+        data (list): List of numeric data. Sites with values > 0 are insertions.
+
+    Returns:
+        tuple: (start, end, length) numpy arrays of the runs, with 1-based
+            inclusive start and end coordinates, ordered by start.
+    """
+    empty = numpy.concatenate(([0], numpy.asarray(data) <= 0, [0])).astype(int)
+    edges = numpy.diff(empty)
+    start = numpy.flatnonzero(edges == 1)
+    stop = numpy.flatnonzero(edges == -1)
+    return (start + 1, stop, stop - start)
+
+#
+
 def runs(data):
     """Return list of all the runs of consecutive non-insertions.
 
@@ -764,25 +867,18 @@ def runs(data):
         data (list): List of numeric data.
 
     Returns:
-        list: List of the length of the runs of non-insertions. Non-zero sites are treated as runs of zero.
+        narray: Numpy array with the length of the runs of non-insertions. Non-zero sites are treated as runs of zero.
     """
-    runs = []
-    current_r = 0
-    for read in data:
-        if read > 0: # If ending a run of zeros
-            if current_r > 0: # If we were in a run, add to list
-                runs.append(current_r)
-            current_r = 0
-            runs.append(current_r)
-        else:
-            current_r += 1
-    # If we ended in a run, add it
-    if current_r > 0:
-        runs.append(current_r)
-
-    if not runs:
-        return [0]
-    return runs
+    data = numpy.asarray(data)
+    (start, end, length) = run_intervals(data)
+    if len(data) == 0:
+        return numpy.zeros(1, dtype=int)
+    # One entry per run (at its first site) and one per insertion
+    runs = numpy.zeros(len(data), dtype=int)
+    runs[start - 1] = length
+    keep = data > 0
+    keep[start - 1] = True
+    return runs[keep]
 
 #
 
@@ -793,21 +889,10 @@ def runindex(runs):
         runs (list): List of numeric data.
 
     Returns:
-        list: List of the index of the runs of non-insertions. Non-zero sites are treated as runs of zero.
+        narray: Numpy array with the index of the runs of non-insertions. Non-zero sites are treated as runs of zero.
     """
-    index = 0
-    index_list = []
-    runindex = 0
-    for r in runs:
-        for i in range(r):
-            if i == 0:
-                runindex = index
-            index+=1
-        if r == 0:
-            runindex = index
-            index+=1
-        index_list.append(runindex)
-    return index_list
+    width = numpy.maximum(numpy.asarray(runs, dtype=int), 1)
+    return numpy.cumsum(width) - width
 
 #
 
@@ -1472,6 +1557,62 @@ def getGamma():
 
 #
 
+def ExpectedRunsExact(nmax, pnon):
+    """Exact expected value of the maximum run of non-insertions, for all numbers
+    of sites below nmax at once.
+
+    Uses the recurrence relations for F(n,k), the probability that the maximum
+    run in n sites has length at most k (Eqn 17-20 in Boyd,
+    https://www.math.ubc.ca/~boyd/bern.runs/bernoulli.html). Each row of F only
+    depends on the previous rows, so all k are updated together, one n at a time.
+
+    Arguments:
+        nmax (int): Integer representing the (exclusive) maximum number of sites.
+        pnon (float): Floating point number representing the probability of non-insertion.
+
+    Returns:
+        numpy.array: Array with the expected maximum run for n = 0, ..., nmax-1 sites.
+    """
+    p,q = 1-pnon,pnon
+    k = numpy.arange(nmax)
+    pqk = p*numpy.power(q, k+1)
+    F = numpy.ones((nmax,nmax))
+    F[k[1:],k[:-1]] = 1-numpy.power(q, k[:-1]+1)
+    flat = F.ravel()
+    for n in range(2, nmax):
+        # F[n-k-2,k] for k = 0..n-2 (n >= k+2) is a diagonal of F, read as a strided view
+        Fprev = flat[(n-2)*nmax::-(nmax-1)][:n-1]
+        F[n,:n-1] = F[n-1,:n-1] - pqk[:n-1]*Fprev
+    # ER_n = sum_k k*(F[n,k]-F[n,k-1]) for k <= n
+    dF = numpy.tril(numpy.diff(F, axis=1))
+    return numpy.dot(dF, k[1:].astype(float))
+
+#
+
+def ExpectedRunsArray(N, pnon, exact=20):
+    """Expected value of the maximum run of non-insertions for an array of
+    numbers of sites, see ExpectedRuns.
+
+    Arguments:
+        N (numpy.array): Array with the number of sites of each gene.
+        pnon (float): Floating point number representing the probability of non-insertion.
+        exact (int): Numbers of sites below which the exact calculation is used.
+
+    Returns:
+        numpy.array: Array with the expected maximum run for each element of N.
+    """
+    N = numpy.asarray(N)
+    small = N < exact
+    ER = numpy.zeros(N.shape)
+    if numpy.any(small):
+        ER[small] = ExpectedRunsExact(exact, pnon)[N[small].astype(int)]
+    if not numpy.all(small):
+        n = N[~small]
+        ER[~small] = numpy.log(n*(1-pnon))/math.log(1.0/pnon) + getGamma()/math.log(1.0/pnon) - 0.5 + getR1(n) + getE1(n)
+    return ER
+
+#
+
 def ExpectedRuns(n,pnon):
     """Expected value of the run of non=insertions (Schilling, 1990):
 
@@ -1486,17 +1627,7 @@ def ExpectedRuns(n,pnon):
 
     """
     if n<20: # use exact calculation for genes with less than 20 TA sites
-      # Eqn 17-20 in Boyd, https://www.math.ubc.ca/~boyd/bern.runs/bernoulli.html
-      #  recurrence relations for F(n,k) = prob that max run has length k
-      p,q = 1-pnon,pnon
-      F = numpy.ones((n+1,n+1))
-      for k in range(n): F[k+1,k] = 1-numpy.power(q,k+1)
-      for k in range(n+1):
-        for n in range(n+1):
-          if n>=k+2: F[n,k] = F[n-1,k]-p*numpy.power(q,k+1)*F[n-k-2,k]
-      ERn = 0
-      for k in range(1,n+1): ERn += k*(F[n,k]-F[n,k-1])
-      return ERn
+      return ExpectedRunsExact(n+1, pnon)[n]
 
     pins = 1-pnon
     gamma = getGamma()
@@ -1538,14 +1669,47 @@ def GumbelCDF(x,u,B):
         e^(-e^( (u-x)/B))
 
     Arguments:
-        x (int): Length of the max run.
-        u (float): Location parameter of the Gumbel dist.
+        x (int): Length of the max run (or numpy array of lengths).
+        u (float): Location parameter of the Gumbel dist (or numpy array).
         B (float): Scale parameter of the Gumbel dist.
 
     Returns:
-        float: Cumulative probability o the Gumbel distribution.
+        float: Cumulative probability o the Gumbel distribution (numpy array for array arguments).
+    """
+    return (numpy.exp( -1 * numpy.exp((u-x)/B )))
+
+#
+
+def griffin_pvalues(N, R, pins, moments=True):
+    """Expected maximum runs of non-insertion and p-values of the observed runs
+    (Griffin et al. 2011), for all genes at once.
+
+    Arguments:
+        N (numpy.array): Number of TA sites of each gene.
+        R (numpy.array): Length of the maximum run of non-insertion of each gene.
+        pins (float): The probability of insertion.
+        moments (bool): If True, the location of the Gumbel distribution is
+            matched to the expected run (as in griffin_analysis). Otherwise it is
+            log(n*pins) in base 1/pnon (as in the Griffin method).
+
+    Returns:
+        tuple: (expected runs, p-values) as numpy arrays. Genes without sites
+            have an expected run of 0 and a p-value of 1.
     """
-    return (math.exp( -1 * math.exp((u-x)/B )))
+    N = numpy.asarray(N, dtype=float)
+    R = numpy.asarray(R, dtype=float)
+    pnon = 1.0 - pins
+    B = 1.0/math.log(1.0/pnon)
+    exprun = numpy.zeros(N.shape)
+    pval = numpy.ones(N.shape)
+    ii = N > 0
+    exprun[ii] = ExpectedRunsArray(N[ii], pnon)
+    if moments:
+        u = exprun[ii] - getGamma()/math.log(1.0/pnon)
+    else:
+        u = numpy.log(N[ii]*pins)/math.log(1.0/pnon)
+    pval[ii] = 1.0 - GumbelCDF(R[ii], u, B)
+    return (exprun, pval)
 
 #
 
@@ -1574,20 +1738,11 @@ def griffin_analysis(genes_obj, pins):
             - p-value of the observed run.
     """
 
-    pnon = 1.0 - pins
+    # u is mu of Gumbel (mean=mu+gamma*beta); matching of moments; like Eq 5 in Schilling, but subtract off unneeded terms
+    (exprun, pval) = griffin_pvalues(genes_obj.local_sites(), genes_obj.local_runs(), pins, moments=True)
     results = []
-    for gene in genes_obj:
-        if gene.n == 0:
-            results.append([gene.orf, gene.name, gene.desc, gene.k, gene.n, gene.r, 0.0, 1.000])
-        else:
-            # do I need to estimate B better (using exact calc for variance) for small genes too?
-            B = 1.0/math.log(1.0/pnon) # beta param of Gumbel distn; like tau in our Bioinfo paper
-            #u = math.log(gene.n*pins, 1.0/pnon) # instead, calculate this based on estimate of ExpectedRun() length below
-            exprun = ExpectedRuns(gene.n, pnon)
-            # u is mu of Gumbel (mean=mu+gamma*beta); matching of moments; like Eq 5 in Schilling, but subtract off unneeded terms
-            u = exprun-getGamma()/math.log(1.0/pnon)
-            pval = 1.0 - GumbelCDF(gene.r, u, B)
-            results.append([gene.orf, gene.name, gene.desc, gene.k, gene.n, gene.r, exprun, pval])
+    for (i, gene) in enumerate(genes_obj):
+        results.append([gene.orf, gene.name, gene.desc, gene.k, gene.n, gene.r, float(exprun[i]), float(pval[i])])
     return(results)
 
 #
@@ -1600,25 +1755,11 @@ def runs_w_info(data):
 
     Returns:
         list: List of dictionary from run to length and position information of the tun.
-    """
-    runs = []
-    start = 1
-    current_r = 0
-    for read in data:
-        if read > 0: # If ending a run of zeros
-            if current_r > 0: # If we were in a run, add to list
-                end = start + current_r - 1
-                runs.append(dict(length = current_r, start = start, end = end))
-            start = start + (current_r + 1)
-            current_r = 0
-        else:
-            current_r += 1
 
-    # If we ended in a run, add it
-    if current_r > 0:
-        end = start + current_r - 1
-        runs.append(dict(length = current_r, start = start, end = end))
-    return runs
+    .. seealso:: :func:`run_intervals`, which returns the same information as arrays.
+    """
+    (start, end, length) = run_intervals(data)
+    return [dict(length = int(l), start = int(s), end = int(e)) for (s, e, l) in zip(start, end, length)]
 
 #
 
@@ -1642,6 +1783,36 @@ def get_genes_in_range(pos_hash, start, end):
 
     return list(sorted(genes))
 
+#
+
+def get_run_gene_overlaps(run_start, run_end, gene_start, gene_end):
+    """Returns all the pairs of a run and a gene whose coordinates overlap.
+
+    The runs do not overlap each other, so when sorted the runs overlapping a
+    gene are a contiguous range, found by binary search on the run boundaries.
+    This takes O((runs + genes) log(runs)) time plus the number of overlaps,
+    instead of a lookup for each coordinate of each run (get_genes_in_range).
+
+    Arguments:
+        run_start (numpy.array): Start coordinate of each run, sorted.
+        run_end (numpy.array): End coordinate (inclusive) of each run, sorted.
+        gene_start (numpy.array): Start coordinate of each gene.
+        gene_end (numpy.array): End coordinate (inclusive) of each gene.
+
+    Returns:
+        tuple: (run indices, gene indices) of the overlapping pairs, as numpy
+            arrays ordered by run.
+    """
+    first = numpy.searchsorted(run_end, gene_start, side="left")
+    last = numpy.searchsorted(run_start, gene_end, side="right")
+    count = numpy.maximum(last - first, 0)
+    gene = numpy.repeat(numpy.arange(len(count)), count)
+    # Index of each pair within the runs of its gene
+    offset = numpy.arange(numpy.sum(count)) - numpy.repeat(numpy.cumsum(count) - count, count)
+    run = numpy.repeat(first, count) + offset
+    order = numpy.argsort(run, kind="stable")
+    return (run[order], gene[order])
+
 
 
 if __name__ == "__main__":
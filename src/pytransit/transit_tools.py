@@ -38,6 +38,7 @@ if hasWx:
     import wx.adv
 
 import math
+import json
 import ntpath
 import numpy
 import scipy.optimize
@@ -396,7 +397,7 @@ def convertToIGV(self, dataset_list, annotationPath, path, normchoice=None):
         normchoice = "nonorm"
 
     (fulldata, position) = tnseq_tools.get_data(dataset_list)
-    (fulldata, factors) = norm_tools.normalize_data(fulldata, normchoice, dataset_list, annotationPath)
+    (fulldata, factors) = norm_tools.normalize_data(fulldata, normchoice, dataset_list, annotationPath, inplace=True)
     position = position.astype(int)
 
     output = open(path, "w")
@@ -428,7 +429,7 @@ def convertToCombinedWig(dataset_list, annotationPath, outputPath, normchoice="n
 
 
     (fulldata, position) = tnseq_tools.get_data(dataset_list)
-    (fulldata, factors) = norm_tools.normalize_data(fulldata, normchoice, dataset_list, annotationPath)
+    (fulldata, factors) = norm_tools.normalize_data(fulldata, normchoice, dataset_list, annotationPath, inplace=True)
     position = position.astype(int)
 
     hash = get_pos_hash(annotationPath)
@@ -467,7 +468,7 @@ def convertToGeneCountSummary(dataset_list, annotationPath, outputPath, normchoi
     """
 
     (fulldata, position) = tnseq_tools.get_data(dataset_list) 
-    (fulldata, factors) = norm_tools.normalize_data(fulldata, normchoice, dataset_list, annotationPath)
+    (fulldata, factors) = norm_tools.normalize_data(fulldata, normchoice, dataset_list, annotationPath, inplace=True)
     output = open(outputPath, "w")
     output.write("#Summarized to Mean Gene Counts with TRANSIT.\n")
     if normchoice != "nonorm":
@@ -535,3 +536,104 @@ def get_validated_data(wig_list, wxobj=None):
     else:
         return tnseq_tools.get_data([])
 
+
+
+class ResultCheckpoint:
+    """Incremental store of per-gene results, used to resume long analyses.
+
+    Rows are appended to "<output>.checkpoint" (one JSON list per line) as soon
+    as each gene finishes, next to a "<output>.manifest" file holding the
+    parameters of the run. With resume=True, the rows of a previous run with
+    the same parameters are loaded so the method can skip those genes; the
+    multiple-testing correction and the final sorted output are only done once
+    all genes are in. A partially written last line (e.g. if the process was
+    killed while writing) is ignored.
+
+    Arguments:
+        output_path (str): Path of the final output file.
+        parameters (dict): JSON-serializable parameters of the run. Resuming
+            requires the same parameters.
+        resume (bool): Load the rows of a previous run instead of starting over.
+
+    :Example:
+
+        >>> checkpoint = ResultCheckpoint("output.dat", {"samples": 10000}, resume=True)
+        >>> for gene in G:
+        ...     if gene.orf in checkpoint: row = checkpoint[gene.orf]
+        ...     else: row = analyze(gene); checkpoint.add(gene.orf, row)
+        >>> checkpoint.close()
+    """
+
+    def __init__(self, output_path, parameters, resume=False):
+        self.rows_path = output_path + ".checkpoint"
+        self.manifest_path = output_path + ".manifest"
+        self.parameters = json.loads(json.dumps(parameters, default=self.to_json))
+        self.rows = {}
+
+        if resume and os.path.exists(self.manifest_path):
+            saved = ResultCheckpoint.load_parameters(output_path)
+            if saved != self.parameters:
+                changed = sorted(k for k in set(saved) | set(self.parameters) if saved.get(k) != self.parameters.get(k))
+                raise ValueError("Cannot resume from %s: parameters differ from the previous run (%s)" % (self.manifest_path, ", ".join(changed)))
+            if os.path.exists(self.rows_path):
+                for line in open(self.rows_path):
+                    try:
+                        (key, row) = json.loads(line)
+                    except ValueError:
+                        break
+                    self.rows[key] = row
+            # Rewrite the rows that were read completely, dropping a partial line. They are
+            # written to a temporary file first, so the saved rows survive if this is interrupted
+            tmp_path = self.rows_path + ".tmp"
+            with open(tmp_path, "w") as tmp:
+                for key, row in self.rows.items():
+                    tmp.write(json.dumps([key, row]) + "\n")
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, self.rows_path)
+            self.file = open(self.rows_path, "a")
+        else:
+            with open(self.manifest_path, "w") as manifest:
+                json.dump(self.parameters, manifest, indent=1, sort_keys=True)
+            self.file = open(self.rows_path, "w")
+        self.file.flush()
+
+    @staticmethod
+    def load_parameters(output_path):
+        """Returns the parameters saved in the manifest for the given output, or None."""
+        manifest_path = output_path + ".manifest"
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as manifest:
+            return json.load(manifest)
+
+    @staticmethod
+    def to_json(x):
+        # numpy scalars (e.g. numpy.int64, numpy.bool_) are not JSON-serializable
+        if isinstance(x, numpy.generic):
+            return x.item()
+        raise TypeError("Object of type %s is not JSON serializable" % type(x).__name__)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __getitem__(self, key):
+        return self.rows[key]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, key, row):
+        """Records the result row of a gene and writes it to disk."""
+        row = json.loads(json.dumps(row, default=self.to_json))
+        self.rows[key] = row
+        self.file.write(json.dumps([key, row]) + "\n")
+        self.file.flush()
+
+    def close(self, remove=True):
+        """Closes the checkpoint, removing its files once the output is complete."""
+        self.file.close()
+        if remove:
+            for path in [self.rows_path, self.manifest_path]:
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,14 @@
+# Writes data/zinb_R_pvals.txt, the per-gene results of "zinb --engine R" (pscl::zeroinfl and
+# MASS::glm.nb) on the bundled data, which test_zinb_R_pvals compares the native engine to.
+# Requires R with the MASS and pscl packages, and rpy2.
+#
+#   python3 make_zinb_R_pvals.py
+
+import rpy2.robjects
+
+from transit_test import *
+
+if __name__ == "__main__":
+    version = rpy2.robjects.r('paste(R.version.string, "pscl", packageVersion("pscl"), "MASS", packageVersion("MASS"))')[0]
+    write_zinb_pvals(zinb_R_pvals, "Per-gene results of zinb --engine R (pscl::zeroinfl / MASS::glm.nb; %s) on cholesterol_glycerol_combined.dat and test.prot_table" % version,
+            ["--engine", "R"])
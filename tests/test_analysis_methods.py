@@ -8,13 +8,18 @@ basedir = os.path.dirname(__file__)
 sys.path.insert(0, basedir + '/../src/')
 
 import shutil
+import numpy
+import scipy.stats
 import unittest
+from unittest import mock
 
 from transit_test import *
 
 import pytransit
 from pytransit import norm_tools
 from pytransit import tnseq_tools
+from pytransit import transit_tools
+from pytransit import stat_tools
 
 # Single condition methods
 from pytransit.analysis.gumbel import GumbelMethod
@@ -25,7 +30,7 @@ from pytransit.analysis.anova import AnovaMethod
 from pytransit.analysis.zinb import ZinbMethod
 
 # Comparative methods
-from pytransit.analysis.resampling import ResamplingMethod
+from pytransit.analysis.resampling import ResamplingMethod, HistogramStore, render_histograms
 from pytransit.analysis.rankproduct import RankProductMethod
 from pytransit.analysis.utest import UTestMethod
 
@@ -47,12 +52,72 @@ class TestMethods(TransitTestCase):
         G.Run()
         self.assertTrue(os.path.exists(output))
 
+    def test_Gumbel_chains(self):
+        # Chains carry their own random states, so the result does not depend on -j
+        import random
+        results = []
+        for nprocs in ["1", "2"]:
+            args = [ctrl_data_txt, small_annotation, output, "-s", "200", "-b", "50", "--chains", "2", "-j", nprocs, "--seed", "3"]
+            G = GumbelMethod.fromargs(args)
+            state = (random.getstate(), numpy.random.get_state()[1].copy())
+            G.Run()
+            results.append([line for line in open(output) if not line.startswith("#Time") and not line.startswith("#Console")])
+            # ... and the global random number generators are left alone
+            self.assertEqual(random.getstate(), state[0])
+            self.assertTrue(numpy.array_equal(numpy.random.get_state()[1], state[1]))
+        self.assertEqual(results[0], results[1])
+        header = dict(line[1:].rstrip("\n").split(":\t", 1) for line in results[0] if ":\t" in line)
+        self.assertEqual(header["Chains"], "2")
+        # The random start of the second chain is not a sample
+        self.assertEqual(header["Sample Size"], "399")
+        self.assertTrue(all(float(x) > 0 for x in header["R-hat (phi, essentials)"].split("\t")))
+
+    def test_Gumbel_trace(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "200", "-b", "50", "--chains", "2", "--trace", "50"]
+        G = GumbelMethod.fromargs(args)
+        G.Run()
+        trace_path = output.rsplit(".", 1)[0] + "_trace." + output.rsplit(".", 1)[1]
+        rows = [line.rstrip("\n").split("\t") for line in open(trace_path) if not line.startswith("#")]
+        os.remove(trace_path)
+        self.assertEqual(sorted((int(r[0]), int(r[1])) for r in rows), [(c, i) for c in [0, 1] for i in [0, 50, 100, 150]])
+        # Each row has the number of essentials, then Z of each gene
+        for r in rows:
+            self.assertEqual(int(r[4]), sum(int(z) for z in r[5:]))
+
     def test_Binomial(self):
         args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100"]
         G = BinomialMethod.fromargs(args)
         G.Run()
         self.assertTrue(os.path.exists(output))
 
+    def test_Binomial_trace(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "100", "-b", "20", "--trace", "40"]
+        G = BinomialMethod.fromargs(args)
+        G.Run()
+        trace_path = output.rsplit(".", 1)[0] + "_trace." + output.rsplit(".", 1)[1]
+        rows = [line.rstrip("\n").split("\t") for line in open(trace_path) if not line.startswith("#")]
+        os.remove(trace_path)
+        self.assertEqual([int(r[0]) for r in rows], [0, 40, 80])
+        self.assertTrue(os.path.exists(output))
+
+    def test_Binomial_sampler(self):
+        # The Metropolis steps use the closed-form log-likelihood of the beta-distributed theta
+        theta = numpy.random.RandomState(0).beta(2, 5, size=50)
+        rho = numpy.array([0.3, 0.6]); Kp = numpy.array([4.0, 7.0])
+        S1 = numpy.full(2, numpy.sum(numpy.log(theta))); S2 = numpy.full(2, numpy.sum(numpy.log(1-theta)))
+        loglik = BinomialMethod.class_loglik(None, rho, Kp, numpy.array([50, 50]), S1, S2)
+        for c in range(2):
+            self.assertAlmostEqual(loglik[c], numpy.sum(scipy.stats.beta.logpdf(theta, Kp[c]*rho[c], Kp[c]*(1-rho[c]))))
+
+        # A seed gives the same samples
+        results = []
+        for i in range(2):
+            args = [ctrl_data_txt, small_annotation, output, "-s", "100", "-b", "20", "--seed", "5"]
+            G = BinomialMethod.fromargs(args)
+            G.Run()
+            results.append([line for line in open(output) if not line.startswith("#Console")])
+        self.assertEqual(results[0], results[1])
+
     def test_Griffin(self):
         args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100"]
         G = GriffinMethod.fromargs(args)
@@ -67,6 +132,80 @@ class TestMethods(TransitTestCase):
         genes_path = output.rsplit(".", 1)[0] + "_genes." + output.rsplit(".", 1)[1]
         self.assertTrue(os.path.exists(genes_path))
 
+    def test_HMM_lean(self):
+        genes_path = output.rsplit(".", 1)[0] + "_genes." + output.rsplit(".", 1)[1]
+        results = []
+        for args in [[], ["--lean"]]:
+            G = HMMMethod.fromargs([mini_wig, small_annotation, output] + args)
+            G.Run()
+            sites = [line for line in open(output) if not line.startswith("#Console")]
+            results.append((sites, open(genes_path).read()))
+        # Decoding in segments gives the same output
+        self.assertGreater(len(results[1][0]), 9000)
+        self.assertEqual(results[0], results[1])
+
+    def test_HMM_recursions(self):
+        import itertools
+        import scipy.stats
+        G = HMMMethod.fromargs([mini_wig, small_annotation, output])
+        G.output.close()
+        numpy.random.seed(3)
+        O = numpy.random.geometric(0.2, 8).astype(float)
+        O[2:5] = 1
+        L = numpy.array([0.99, 0.5, 0.2, 0.05])
+        A = numpy.log(numpy.full((4,4), 0.02) + numpy.eye(4)*0.92)
+        PI = numpy.array([0.7, 0.1, 0.1, 0.1])
+        B = G.emission_log_probabilities(L, O)
+        self.assertEqual(B.shape, (4, len(O)))
+        self.assertAlmostEqual(B[2,0], scipy.stats.geom(L[2]).logpmf(O[0]))
+
+        # Brute-force enumeration of all state paths
+        best, total = None, 0.0
+        occupancy, transitions = numpy.zeros((4, len(O))), numpy.zeros((4, 4))
+        for path in itertools.product(range(4), repeat=len(O)):
+            logp = numpy.log(PI[path[0]]) + sum(A[path[t-1],path[t]] for t in range(1, len(O))) + sum(B[s,t] for t,s in enumerate(path))
+            total += numpy.exp(logp)
+            occupancy[path, range(len(O))] += numpy.exp(logp)
+            for t in range(1, len(O)): transitions[path[t-1],path[t]] += numpy.exp(logp)
+            if best is None or logp > best[0]: best = (logp, path)
+
+        (log_Prob_Obs, alpha) = G.forward_procedure(A, B, PI)
+        self.assertAlmostEqual(log_Prob_Obs, numpy.log(total))
+        self.assertTrue(numpy.allclose(numpy.exp(alpha).sum(0), 1.0))
+        (Q_opt, delta, Q) = G.viterbi(A, B, PI)
+        self.assertEqual(list(Q_opt), list(best[1]))
+        self.assertAlmostEqual(delta[:,-1].max(), best[0])
+        gamma = G.posterior_probabilities(alpha, G.backward_procedure(A, B))
+        self.assertTrue(numpy.allclose(gamma.sum(0), 1.0))
+
+        # Expected counts used by Baum-Welch
+        # The backward pass of Baum-Welch uses the emission at the next site (none after the last one)
+        B_next = numpy.hstack([B[:,1:], numpy.zeros((4, 1))])
+        (gamma, xi) = G.expected_counts(A, B, alpha, G.backward_procedure(A, B_next))
+        self.assertTrue(numpy.allclose(gamma, occupancy/total))
+        self.assertTrue(numpy.allclose(xi, transitions/total))
+        # Accumulated over segments, as in the memory-lean mode
+        for size in [1, 3, len(O)]:
+            (ll, gamma0, weights, gammaO, xi) = G.expected_counts_segments(A, L, O, PI, size)
+            self.assertAlmostEqual(ll, numpy.log(total))
+            self.assertTrue(numpy.allclose(gamma0, occupancy[:,0]/total))
+            self.assertTrue(numpy.allclose(weights, occupancy.sum(1)/total))
+            self.assertTrue(numpy.allclose(gammaO, numpy.dot(occupancy, O)/total))
+            self.assertTrue(numpy.allclose(xi, transitions/total))
+
+    def test_HMM_baum_welch(self):
+        args = [mini_wig, small_annotation, output, "--em", "--em-iter", "5"]
+        G = HMMMethod.fromargs(args)
+        G.Run()
+        sites = [line for line in open(output) if not line.startswith("#Console")]
+        loglik = [line.split("\t")[1:] for line in open(output) if line.startswith("# Log-likelihood:")][0]
+        loglik = [float(ll) for ll in loglik]
+        self.assertEqual(len(loglik), 6)
+        self.assertTrue(all(numpy.diff(loglik) > 0))
+        # The memory-lean mode runs the E-step in segments, with the same estimates
+        HMMMethod.fromargs(args + ["--lean"]).Run()
+        self.assertEqual([line for line in open(output) if not line.startswith("#Console")], sites)
+
 
     def test_resampling(self):
         args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-l"]
@@ -115,6 +254,32 @@ class TestMethods(TransitTestCase):
                 2,
                 "sig_qvals expected in range: %s, actual: %d" % ("[34, 36]", len(sig_qvals)))
 
+    def test_resampling_parallel(self):
+        results = []
+        for nprocs in ["1", "2"]:
+            args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-s", "1000", "-j", nprocs, "--seed", "7"]
+            G = ResamplingMethod.fromargs(args)
+            G.Run()
+            self.assertTrue(os.path.exists(output))
+            results.append([line for line in open(output) if not line.startswith("#")])
+        self.assertGreater(len(results[0]), 0)
+        self.assertEqual(results[0], results[1])
+
+    def test_resampling_sequential(self):
+        args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "--sequential", "--seed", "7"]
+        G = ResamplingMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        header = [line for line in open(output) if line.startswith("#Orf")][0]
+        self.assertEqual(header.strip().split("\t")[-3], "Permutations")
+        nperms = [int(line.split("\t")[-3]) for line in open(output) if not line.startswith("#")]
+        self.assertLess(sum(nperms), 10000*len(nperms))
+        (sig_pvals, sig_qvals) = (significant_pvals_qvals(output, pcol=-2, qcol=-1))
+        self.assertLessEqual(
+                abs(len(sig_pvals) - 37),
+                2,
+                "sig_pvals expected in range: %s, actual: %d" % ("[35, 39]", len(sig_pvals)))
+
     def test_resampling_histogram(self):
         args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-s", "1000", "-h"]
         G = ResamplingMethod.fromargs(args)
@@ -124,6 +289,27 @@ class TestMethods(TransitTestCase):
                 os.path.isdir(hist_path),
                 "histpath expected: %s" % (hist_path))
 
+    def test_resampling_histogram_store(self):
+        args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-s", "1000", "-h", "--seed", "7"]
+        G = ResamplingMethod.fromargs(args)
+        G.Run()
+        records = HistogramStore.read(hist_path)
+        orfs = [line.split("\t")[0] for line in open(output) if not line.startswith("#")]
+        self.assertEqual(sorted(records), sorted(orfs))
+        for orf in orfs:
+            self.assertTrue(os.path.exists(os.path.join(hist_path, orf + ".png")))
+
+        # The stored counts are the binned permutation statistics of the gene
+        gene = tnseq_tools.read_genes(small_annotation)[0]["rv"]
+        record = records[gene]
+        self.assertEqual(numpy.sum(record["counts"]), 1000)
+        self.assertLessEqual(record["lo"], record["hi"])
+
+        # Images can be rendered again on request
+        os.remove(os.path.join(hist_path, gene + ".png"))
+        render_histograms(hist_path, orfs=[gene])
+        self.assertTrue(os.path.exists(os.path.join(hist_path, gene + ".png")))
+
     def test_resampling_multistrain(self):
         args = [ctrl_data_txt, exp_data_txt, ','.join([small_annotation, small_annotation]), output, "-h"]
         G = ResamplingMethod.fromargs(args)
@@ -149,7 +335,45 @@ class TestMethods(TransitTestCase):
             28,
             "sig_qvals expected: %d, actual: %d" % (28, len(sig_qvals)))
 
-    @unittest.skipUnless(hasR, "requires R, rpy2")
+    def test_anova_by_gene(self):
+        G = AnovaMethod.fromargs([combined_wig, samples_metadata, small_annotation, output])
+        conditions = ["a", "a", "b", "c", "c", "c"]
+        rng = numpy.random.RandomState(0)
+        nsites = numpy.array([5, 0, 1, 3, 4, 2])
+        data = rng.poisson(3, (len(conditions), numpy.sum(nsites))).astype(float)
+        # Constant within each condition, and constant everywhere
+        data[:, 9:13] = numpy.array([1, 1, 2, 3, 3, 3])[:, numpy.newaxis]
+        data[:, 13:15] = 4.0
+        (f, pvals) = G.f_oneway_by_gene(data, nsites, conditions)
+        start = numpy.cumsum(nsites) - nsites
+        for g in [0, 3, 4, 5]:
+            counts = data[:, start[g]:start[g]+nsites[g]]
+            groups = [counts[[i for i,c in enumerate(conditions) if c == cond]].flatten() for cond in "abc"]
+            (f_exp, p_exp) = scipy.stats.f_oneway(*groups)
+            self.assertEqual(numpy.isnan(f[g]), numpy.isnan(f_exp))
+            if not numpy.isnan(f_exp):
+                self.assertAlmostEqual(f[g], f_exp)
+                self.assertAlmostEqual(pvals[g], p_exp)
+        self.assertEqual(f[4], numpy.inf)
+
+    def test_zinb_stats_by_rv(self):
+        G = ZinbMethod.fromargs([combined_wig, samples_metadata, small_annotation, output])
+        conditions = ["a", "a", "b", "b"]
+        interactions = [["x", "y", "x", "x"]]
+        genes = [{"rv": "g1"}, {"rv": "g2"}, {"rv": "g3"}]
+        RvSiteindexesMap = {"g1": [0, 1, 2], "g2": [], "g3": [3, 4]}
+        data = numpy.array([[0, 2, 4, 0, 0], [1, 0, 0, 0, 0], [3, 3, 0, 5, 0], [0, 0, 6, 0, 0]], dtype=float)
+        (stats, groups) = G.stats_by_rv(data, RvSiteindexesMap, genes, conditions, interactions)
+        self.assertEqual([g.split("\1") for g in groups], [["a", "x"], ["a", "y"], ["b", "x"]])
+        # Gene g1 in the wigs of b_x, and gene g2 without sites
+        self.assertAlmostEqual(stats["mean"][0, 2], 2.0)
+        self.assertAlmostEqual(stats["nz_mean"][0, 2], 4.0)
+        self.assertAlmostEqual(stats["nz_perc"][0, 2], 0.5)
+        self.assertEqual(list(stats["mean"][1]), [0, 0, 0])
+        # Gene g3 without counts in a_x
+        self.assertEqual((stats["mean"][2, 0], stats["nz_mean"][2, 0], stats["nz_perc"][2, 0]), (0, 0, 0))
+        self.assertAlmostEqual(stats["nz_mean"][2, 2], 5.0)
+
     def test_zinb(self):
         args = [combined_wig, samples_metadata, small_annotation, output]
         G = ZinbMethod.fromargs(args)
@@ -166,7 +390,6 @@ class TestMethods(TransitTestCase):
             30,
             "sig_qvals expected: %d, actual: %d" % (30, len(sig_qvals)))
 
-    @unittest.skipUnless(hasR, "requires R, rpy2")
     def test_zinb_covariates(self):
         args = [combined_wig, samples_metadata_covariates, small_annotation, output, "--covars", "batch", "--condition", "NewConditionCol"]
         G = ZinbMethod.fromargs(args)
@@ -183,7 +406,6 @@ class TestMethods(TransitTestCase):
             10,
             "sig_qvals expected: %d, actual: %d" % (10, len(sig_qvals)))
 
-    @unittest.skipUnless(hasR, "requires R, rpy2")
     def test_zinb_interactions(self):
         args = [combined_wig, samples_metadata_interactions, small_annotation, output, "--covars", "batch", "--interactions", "atm"]
         G = ZinbMethod.fromargs(args)
@@ -200,6 +422,83 @@ class TestMethods(TransitTestCase):
             0,
             "sig_qvals expected: %d, actual: %d" % (0, len(sig_qvals)))
 
+    def test_zinb_model_error(self):
+        G = ZinbMethod.fromargs([combined_wig, samples_metadata, small_annotation, output])
+        rng = numpy.random.RandomState(0)
+        cnt = rng.negative_binomial(2, 0.2, 40)
+        cnt[::3] = 0
+        variables = {"cond": numpy.repeat(["A", "B"], 20)}
+        (NZmean, logitZperc) = (numpy.full(40, 8.0), numpy.full(40, -1.0))
+        (pval, status) = G.zinb_signif(cnt, variables, NZmean, logitZperc)
+        self.assertEqual(status, "-")
+        # A fit that does not converge is reported instead of giving a p-value
+        fit = stat_tools.zinb_fit
+        def failed_fit(*args, **kwargs):
+            return fit(*args, **kwargs)[:3] + (False, "Maximum number of iterations has been exceeded.")
+        with mock.patch("pytransit.stat_tools.zinb_fit", side_effect=failed_fit):
+            (pval, status) = G.zinb_signif(cnt, variables, NZmean, logitZperc)
+        self.assertEqual((pval, status), (1, "Model Error. Maximum number of iterations has been exceeded."))
+
+    def test_zinb_parallel(self):
+        args = [combined_wig, samples_metadata_covariates, small_annotation, output, "--covars", "batch", "--condition", "NewConditionCol"]
+        ZinbMethod.fromargs(args).Run()
+        expected = [line for line in open(output) if not line.startswith("#")]
+        ZinbMethod.fromargs(args + ["-j", "2"]).Run()
+        self.assertEqual([line for line in open(output) if not line.startswith("#")], expected)
+
+    def assert_zinb_pvals_equal(self, results, expected, tol):
+        self.assertEqual(sorted(results), sorted(expected))
+        rvs = sorted(expected)
+        self.assertEqual([results[rv][1] for rv in rvs], [expected[rv][1] for rv in rvs])
+        with numpy.errstate(divide="ignore"):
+            numpy.testing.assert_allclose(numpy.log([results[rv][0] for rv in rvs]),
+                    numpy.log([expected[rv][0] for rv in rvs]), rtol=0, atol=tol)
+
+    @unittest.skipUnless(os.path.exists(zinb_R_pvals), "requires the R results, see make_zinb_R_pvals.py")
+    def test_zinb_R_pvals(self):
+        # The native engine gives the statuses and p-values of pscl/MASS, gene by gene,
+        # for the plain, covariate and interaction models
+        expected = read_zinb_pvals(zinb_R_pvals)
+        for (model, extra) in zinb_models:
+            results = zinb_pvals([combined_wig, zinb_models_metadata[model], small_annotation, output] + extra)
+            self.assert_zinb_pvals_equal(results, expected[model], 0.05)
+
+    @unittest.skipUnless(hasR, "requires R, rpy2")
+    def test_zinb_R_parity(self):
+        # Same comparison, with the R engine run on this system
+        for (model, extra) in zinb_models:
+            args = [combined_wig, zinb_models_metadata[model], small_annotation, output] + extra
+            self.assert_zinb_pvals_equal(zinb_pvals(args), zinb_pvals(args + ["--engine", "R"]), 0.05)
+
+    def test_zinb_native_snapshot(self):
+        # Regression check of the native engine against its own earlier results (not a reference)
+        expected = read_zinb_pvals(zinb_native_pvals)
+        for (model, extra) in zinb_models:
+            results = zinb_pvals([combined_wig, zinb_models_metadata[model], small_annotation, output] + extra)
+            self.assert_zinb_pvals_equal(results, expected[model], 1e-3)
+
+    def test_rankproduct(self):
+        import pytransit.analysis.rankproduct as rankproduct
+        # Replicates are paired between conditions
+        args = [ctrl_data_txt, ",".join(exp_data_txt.split(",")[:2]), small_annotation, output, "-s", "20"]
+        G = RankProductMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+
+        # Batched counts match the full matrix of null rank products
+        obsRP = numpy.array([1.0, 2.5, 3.0, numpy.sqrt(12), 7.0, 2.0])
+        numpy.random.seed(3)
+        permutations = numpy.array([numpy.power(numpy.prod([numpy.random.permutation(numpy.arange(1, 7)) for k in range(2)], 0), 0.5) for s in range(20)])
+        expected = [numpy.sum(permutations <= rp) for rp in obsRP]
+        batch = rankproduct.PERMUTATION_BATCH
+        try:
+            rankproduct.PERMUTATION_BATCH = 15
+            numpy.random.seed(3)
+            self.assertEqual(list(G.null_counts(obsRP, 2)), expected)
+        finally:
+            rankproduct.PERMUTATION_BATCH = batch
+
+
     def test_utest(self):
         args = [ctrl_data_txt, exp_data_txt, small_annotation, output]
         G = UTestMethod.fromargs(args)
@@ -207,6 +506,27 @@ class TestMethods(TransitTestCase):
         self.assertTrue(os.path.exists(output))
 
 
+    def test_utest_resume(self):
+        args = [ctrl_data_txt, exp_data_txt, small_annotation, output]
+        G = UTestMethod.fromargs(args)
+        G.Run()
+        expected = [line.split("\t")[:-1] for line in open(output) if not line.startswith("#")]
+
+        # Save the result of the first gene as if an earlier run had been interrupted
+        orf = tnseq_tools.read_genes(small_annotation)[0]["rv"]
+        saved = [row for row in expected if row[0] == orf][0]
+        saved[2] = "from checkpoint"
+        G = UTestMethod.fromargs(args + ["--resume"])
+        checkpoint = transit_tools.ResultCheckpoint(output, G.checkpoint_parameters())
+        checkpoint.add(0, saved[:3] + [int(saved[3])] + [float(x) for x in saved[4:]])
+        checkpoint.close(remove=False)
+
+        G.Run()
+        resumed = [line.split("\t")[:-1] for line in open(output) if not line.startswith("#")]
+        self.assertEqual(resumed, [saved if row[0] == orf else row for row in expected])
+        self.assertFalse(os.path.exists(output + ".checkpoint"))
+        self.assertFalse(os.path.exists(output + ".manifest"))
+
     def test_GI(self):
         args = [ctrl_data_txt, exp_data_txt, ctrl_data_txt, exp_data_txt, small_annotation, output,
                     "-s", "1000"]
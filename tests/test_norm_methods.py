@@ -8,6 +8,7 @@ import shutil
 import unittest
 import os
 import numpy
+import tracemalloc
 
 from transit_test import *
 
@@ -21,6 +22,7 @@ from pytransit.analysis.hmm import HMMMethod
 
 from pytransit.analysis.resampling import ResamplingMethod
 from pytransit.analysis.rankproduct import RankProductMethod
+from pytransit.analysis.normalize import NormalizeMethod
 
 
 # RAW STATISTICS:
@@ -61,6 +63,59 @@ class TestNormMethods(TransitTestCase):
            self.assertNotEqual(numpy.mean(norm_data[k]), raw_means[k])
 #    """
 
+    def test_inplace(self):
+        data,position = tnseq_tools.get_data(all_data_list)
+        for method in ["nonorm", "nzmean", "totreads", "TTR"]:
+            norm_data,factors = norm_tools.normalize_data(data, method)
+            buffer = data.copy()
+            inplace_data,inplace_factors = norm_tools.normalize_data(buffer, method, inplace=True)
+            self.assertTrue(inplace_data is buffer)
+            self.assertTrue(numpy.array_equal(inplace_data, norm_data))
+            self.assertTrue(numpy.array_equal(inplace_factors, factors))
+
+    def test_inplace_peak_memory(self):
+        data,position = tnseq_tools.get_data(all_data_list)
+        for method in ["nzmean", "totreads", "TTR"]:
+            buffer = data.copy()
+            tracemalloc.start()
+            norm_tools.normalize_data(buffer, method, inplace=True)
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # Only per-dataset temporaries, never a second (K,N) matrix
+            self.assertLess(peak, 0.5 * data.nbytes)
+
+            tracemalloc.start()
+            norm_tools.normalize_data(buffer, method)
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertGreaterEqual(peak, data.nbytes)
+
+    def test_trimmed_mean_from_histogram(self):
+        data,position = tnseq_tools.get_data(all_data_list)
+        for k in range(len(data)):
+            hist = None
+            for chunk in numpy.array_split(data[k], 7):
+                hist = norm_tools.update_count_histogram(hist, chunk)
+            (values, counts) = hist
+            self.assertEqual(numpy.sum(counts), numpy.sum(data[k] > 0))
+            self.assertAlmostEqual(norm_tools.trimmed_mean_from_histogram(values, counts), norm_tools.trimmed_empirical_mu(data[k]))
+
+    def test_streaming_factors(self):
+        (position, data, files) = tnseq_tools.read_combined_wig(combined_wig)
+        for method in ["TTR", "nzmean", "totreads"]:
+            norm_data,factors = norm_tools.normalize_data(data.copy(), method)
+            chunks = (D for (sites, D) in tnseq_tools.read_combined_wig_chunks(combined_wig, 5000))
+            stream_factors = norm_tools.streaming_factors(chunks, method)
+            self.assertTrue(numpy.allclose(factors, stream_factors))
+
+    def test_normalize_stream(self):
+        G = NormalizeMethod.fromargs(["-c", combined_wig, output, "-n", "TTR"])
+        G.Run()
+        expected = open(output).read()
+        G = NormalizeMethod.fromargs(["-c", combined_wig, output, "-n", "TTR", "--stream", "--chunk_size", "5000"])
+        G.Run()
+        self.assertEqual(open(output).read(), expected)
+
     def test_resampling_nonorm(self):
         args = [ctrl_rep1, ctrl_rep2, small_annotation, output, "-s", "1000", "-n", "nonorm"]
         G = ResamplingMethod.fromargs(args)
@@ -4,8 +4,10 @@ sys.path.insert(0, '../src/')
 import os
 import shutil
 import unittest
+from unittest import mock
 import os
 import numpy
+import scipy.stats
 
 from transit_test import *
 
@@ -62,6 +64,173 @@ class TestTnSeqTools(TransitTestCase):
         self.assertEqual(G[0].name, test_name)
 
 
+    def test_gene_site_index(self):
+        data,position = tnseq_tools.get_data(all_data_list[:1])
+        G = tnseq_tools.Genes([], annotation, data=data.copy(), position=position, ignoreCodon=False, nterm=5.0, cterm=10.0)
+        (orfs, site, gene) = tnseq_tools.gene_site_index(annotation, position, nterm=5.0, cterm=10.0)
+        self.assertEqual(orfs, [g.orf for g in G])
+        self.assertTrue(numpy.all(numpy.diff(gene) >= 0))
+        n = numpy.bincount(gene, minlength=len(orfs))
+        for i,g in enumerate(G):
+            self.assertEqual(n[i], g.n)
+            self.assertEqual(list(position[site[gene == i]]), list(g.position))
+
+
+    def test_run_intervals(self):
+        data = [0, 0, 3, 0, 1, 1, 0, 0, 0]
+        (start, end, length) = tnseq_tools.run_intervals(data)
+        self.assertEqual(list(start), [1, 4, 7])
+        self.assertEqual(list(end), [2, 4, 9])
+        self.assertEqual(list(length), [2, 1, 3])
+        self.assertEqual(list(tnseq_tools.runs(data)), [2, 0, 1, 0, 0, 3])
+        self.assertEqual(list(tnseq_tools.runindex(tnseq_tools.runs(data))), [0, 2, 3, 4, 5, 6])
+        self.assertEqual(tnseq_tools.runs_w_info(data)[1], dict(length=1, start=4, end=4))
+        self.assertEqual(list(tnseq_tools.runs([1, 2])), [0, 0])
+        self.assertEqual(list(tnseq_tools.runs([])), [0])
+
+
+    def test_run_gene_overlaps(self):
+        rng = numpy.random.RandomState(0)
+        # Disjoint runs and overlapping genes over a 1000 bp genome
+        bounds = numpy.sort(rng.choice(numpy.arange(1, 1001), 60, replace=False))
+        run_start, run_end = bounds[0::2], bounds[1::2]
+        gene_start = rng.randint(1, 1000, 40)
+        gene_end = gene_start + rng.randint(0, 80, 40)
+        pos_hash = {}
+        for g in range(40):
+            for pos in range(gene_start[g], gene_end[g] + 1):
+                pos_hash.setdefault(pos, []).append(g)
+        (run_idx, gene_idx) = tnseq_tools.get_run_gene_overlaps(run_start, run_end, gene_start, gene_end)
+        self.assertTrue(numpy.all(numpy.diff(run_idx) >= 0))
+        for r in range(len(run_start)):
+            expected = tnseq_tools.get_genes_in_range(pos_hash, run_start[r], run_end[r])
+            self.assertEqual(sorted(gene_idx[run_idx == r]), expected)
+
+
+    def test_expected_runs(self):
+        import itertools
+        pnon = 0.4
+        table = tnseq_tools.ExpectedRunsExact(20, pnon)
+        # Brute-force expectation over all sequences of insertions (0) and non-insertions (1)
+        for n in range(0, 11):
+            ER = 0.0
+            for seq in itertools.product([0, 1], repeat=n):
+                ER += tnseq_tools.maxrun(seq, item=1) * pnon**sum(seq) * (1-pnon)**(n-sum(seq))
+            self.assertAlmostEqual(table[n], ER)
+        N = numpy.array([3, 19, 20, 57, 5, 400])
+        ER = tnseq_tools.ExpectedRunsArray(N, pnon)
+        for i,n in enumerate(N):
+            self.assertAlmostEqual(ER[i], tnseq_tools.ExpectedRuns(n, pnon))
+
+
+    def test_griffin_pvalues(self):
+        pins = 0.4
+        pnon = 1 - pins
+        N = numpy.array([0, 1, 5, 19, 20, 60, 300])
+        R = numpy.array([0, 1, 5, 3, 10, 4, 12])
+        for moments in [True, False]:
+            (exprun, pval) = tnseq_tools.griffin_pvalues(N, R, pins, moments=moments)
+            self.assertEqual((exprun[0], pval[0]), (0.0, 1.0))
+            for i in range(1, len(N)):
+                self.assertAlmostEqual(exprun[i], tnseq_tools.ExpectedRuns(N[i], pnon))
+                u = exprun[i] - tnseq_tools.getGamma()/numpy.log(1/pnon) if moments else numpy.log(N[i]*pins)/numpy.log(1/pnon)
+                self.assertAlmostEqual(pval[i], 1 - scipy.stats.gumbel_r.cdf(R[i], u, 1/numpy.log(1/pnon)))
+
+
+    def test_BH_fdr_correction(self):
+        # p*n/rank, then the running minimum from the largest p-value down
+        pvals = [0.01, 0.04, 0.03, 0.2]
+        expected = [0.04, 0.04*4/3, 0.04*4/3, 0.2]
+        for (q, e) in zip(stat_tools.BH_fdr_correction(pvals), expected):
+            self.assertAlmostEqual(q, e)
+        # Tied p-values get the same adjusted value
+        pvals = [0.01, 0.04, 0.04, 0.2]
+        expected = [0.04, 0.04*4/3, 0.04*4/3, 0.2]
+        for (q, e) in zip(stat_tools.BH_fdr_correction(pvals), expected):
+            self.assertAlmostEqual(q, e)
+        self.assertEqual(len(stat_tools.BH_fdr_correction([])), 0)
+        # Non-finite p-values are left out of the adjustment
+        qvals = stat_tools.BH_fdr_correction([0.01, float("nan"), 0.04, 0.03, 0.2])
+        self.assertTrue(numpy.isnan(qvals[1]))
+        for (q, e) in zip(qvals[[0, 2, 3, 4]], [0.04, 0.04*4/3, 0.04*4/3, 0.2]):
+            self.assertAlmostEqual(q, e)
+        self.assertTrue(numpy.all(numpy.isnan(stat_tools.BH_fdr_correction([float("nan")]))))
+
+
+    def test_mannwhitneyu_segments(self):
+        rng = numpy.random.RandomState(0)
+        # Large samples with ties (normal approximation), small ones without (exact)
+        # and an empty sample
+        samples = [(rng.poisson(3, 20), rng.poisson(5, 30)), (rng.rand(5), rng.rand(40)),
+                   (rng.poisson(1, 4), rng.poisson(1, 6)), (numpy.ones(12), numpy.ones(9)),
+                   (numpy.array([]), rng.rand(3))]
+        x = numpy.concatenate([s[0] for s in samples])
+        y = numpy.concatenate([s[1] for s in samples])
+        xseg = numpy.repeat(numpy.arange(len(samples)), [len(s[0]) for s in samples])
+        yseg = numpy.repeat(numpy.arange(len(samples)), [len(s[1]) for s in samples])
+        (U, pval) = stat_tools.mannwhitneyu_segments(x, y, xseg, yseg, len(samples))
+        for (i, (a, b)) in enumerate(samples[:-1]):
+            (u_exp, p_exp) = scipy.stats.mannwhitneyu(a, b, alternative="two-sided")
+            self.assertEqual(U[i], u_exp)
+            self.assertAlmostEqual(pval[i], p_exp)
+        self.assertTrue(numpy.isnan(U[-1]) and numpy.isnan(pval[-1]))
+
+
+    def test_zinb_loglik(self):
+        X = numpy.column_stack([numpy.ones(6), [0, 0, 0, 1, 1, 1]])
+        y = numpy.array([0, 3, 5, 0, 0, 12])
+        params = numpy.array([1.2, 0.5, -0.3, 0.4, numpy.log(2.0)])
+        (ll, grad) = stat_tools.zinb_loglik(params, y, X, X)
+        mu = numpy.exp(X.dot(params[:2]))
+        pi = 1.0 / (1.0 + numpy.exp(-X.dot(params[2:4])))
+        nb = scipy.stats.nbinom.pmf(y, 2.0, 2.0 / (2.0 + mu))
+        self.assertAlmostEqual(ll, numpy.sum(numpy.log(numpy.where(y == 0, pi, 0) + (1 - pi) * nb)))
+        # Analytic gradient against central differences
+        for i in range(len(params)):
+            h = numpy.zeros(len(params))
+            h[i] = 1e-6
+            fd = (stat_tools.zinb_loglik(params + h, y, X, X)[0] - stat_tools.zinb_loglik(params - h, y, X, X)[0]) / 2e-6
+            self.assertAlmostEqual(grad[i], fd, places=5)
+
+
+    def test_zinb_fit(self):
+        import statsmodels.api as sm
+        rng = numpy.random.RandomState(1)
+        X = numpy.column_stack([numpy.ones(40), numpy.repeat([0, 1], 20)])
+        y = rng.negative_binomial(2, 2.0 / (2.0 + numpy.exp(X.dot([1.0, 1.5]))))
+        y[rng.rand(40) < 0.3] = 0
+        # Without zero-inflation this is a negative binomial regression
+        (params, ll, H, converged, message) = stat_tools.zinb_fit(y, X)
+        self.assertTrue(converged)
+        res = sm.NegativeBinomial(y, X).fit(disp=0)
+        self.assertAlmostEqual(ll, res.llf, places=4)
+        numpy.testing.assert_allclose(params[:2], res.params[:2], atol=1e-3)
+        # The zero-inflated model nests it and is fitted to a stationary maximum
+        (params, ll_zinb, H, converged, message) = stat_tools.zinb_fit(y, X, X, hessian=True)
+        self.assertTrue(converged)
+        self.assertGreaterEqual(ll_zinb, ll)
+        self.assertTrue(numpy.all(numpy.abs(stat_tools.zinb_loglik(params, y, X, X)[1]) < 1e-4))
+        self.assertTrue(numpy.all(numpy.linalg.eigvalsh(H) < 0))
+
+
+    def test_mcmc_diagnostics(self):
+        rng = numpy.random.RandomState(0)
+        X = rng.normal(size=(4, 1000))
+        self.assertAlmostEqual(stat_tools.split_rhat(X), 1.0, delta=0.01)
+        self.assertAlmostEqual(stat_tools.effective_sample_size(X), 4000, delta=400)
+        # Chains around different values have not mixed
+        self.assertGreater(stat_tools.split_rhat(X + numpy.arange(4)[:,numpy.newaxis]), 1.5)
+        # AR(1) chains with coefficient 0.9 have an ESS of about (1-0.9)/(1+0.9) of the samples
+        A = numpy.zeros((4, 10000))
+        for t in range(1, A.shape[1]):
+            A[:,t] = 0.9*A[:,t-1] + rng.normal(size=4)
+        self.assertAlmostEqual(stat_tools.effective_sample_size(A) / 40000.0, 0.1/1.9, delta=0.01)
+        # Several parameters at once, NaN for constant ones
+        ess = stat_tools.effective_sample_size(numpy.stack([X, numpy.ones(X.shape)], axis=2))
+        self.assertAlmostEqual(ess[0], stat_tools.effective_sample_size(X))
+        self.assertTrue(numpy.isnan(ess[1]))
+
+
     def test_file_types(self):
         types = tnseq_tools.get_file_types(all_data_list)
         types = set(types)
@@ -78,6 +247,133 @@ class TestTnSeqTools(TransitTestCase):
 
 #
 
+    def test_resampling_batched_kernel(self):
+        numpy.random.seed(0)
+        data1 = numpy.random.poisson(5, 30).astype(float)
+        data2 = numpy.random.poisson(7, 40).astype(float)
+        batched = stat_tools.resampling(data1, data2, S=10000)
+        # An equivalent custom test function goes through the one-permutation-at-a-time loop
+        looped = stat_tools.resampling(data1, data2, S=10000, testFunc=lambda A,B: numpy.mean(B) - numpy.mean(A))
+        self.assertEqual(batched[:4], looped[:4])
+        self.assertEqual(len(batched[-1]), 10000)
+        for i in [4, 5, 6]:
+            self.assertAlmostEqual(batched[i], looped[i], delta=0.01)
+
+        # All permutations are ties with the observed statistic
+        zeros = numpy.zeros(10)
+        self.assertEqual(stat_tools.resampling(zeros, zeros, S=100)[4:7], (1.0, 1.0, 1.0))
+
+        # Adaptive stops at the first (1%) checkpoint for a non-significant gene
+        pvals = stat_tools.resampling(data1, data1, S=10000, adaptive=True, blocksize=333)
+        self.assertEqual(len(pvals[-1]), 100)
+
+#
+
+    def test_resampling_libraries(self):
+        nTAs = 15
+        numpy.random.seed(2)
+        data1 = numpy.random.poisson(10, 2*nTAs).astype(float)
+        data2 = numpy.random.poisson(14, 3*nTAs).astype(float)
+        # Libraries with different numbers of datasets in each condition
+        batched = stat_tools.resampling(data1, data2, S=10000, testFunc=stat_tools.F_mean_diff_dict,
+                permFunc=stat_tools.F_shuffle_dict_libraries, lib_str1="AB", lib_str2="AAB")
+        looped = stat_tools.resampling(data1, data2, S=10000, testFunc=lambda D: stat_tools.F_mean_diff_dict(D),
+                permFunc=stat_tools.F_shuffle_dict_libraries, lib_str1="AB", lib_str2="AAB")
+        self.assertAlmostEqual(batched[0], numpy.mean(data2) - numpy.mean(data1))
+        self.assertEqual(batched[:4], looped[:4])
+        self.assertEqual(len(batched[-1]), 10000)
+        for i in [4, 5, 6]:
+            self.assertAlmostEqual(batched[i], looped[i], delta=0.02)
+
+        # Observations are only exchanged within libraries: if every library is
+        # constant, all permutations give the observed statistic.
+        data1 = numpy.array([1.0]*nTAs + [50.0]*nTAs)
+        data2 = numpy.array([1.0]*nTAs + [1.0]*nTAs + [50.0]*nTAs)
+        result = stat_tools.resampling(data1, data2, S=1000, testFunc=stat_tools.F_mean_diff_dict,
+                permFunc=stat_tools.F_shuffle_dict_libraries, lib_str1="AB", lib_str2="AAB")
+        self.assertEqual(result[6], 1.0)
+        self.assertTrue(numpy.allclose(result[-1], result[0]))
+
+    def test_resampling_sequential(self):
+        S = 10000
+        h = stat_tools.sequential_stopping_count(S, 0.05)
+        self.assertEqual(h, 501)
+        numpy.random.seed(1)
+        for shift in [0, 1, 2, 4]:
+            data1 = numpy.random.poisson(10, 20).astype(float)
+            data2 = numpy.random.poisson(10 + shift, 20).astype(float)
+            # The permutations drawn do not depend on the block sizes, so with the
+            # same seed the sequential test sees a prefix of the fixed-S permutations
+            fixed = stat_tools.resampling(data1, data2, S=S, rng=numpy.random.RandomState(shift))
+            seq = stat_tools.resampling(data1, data2, S=S, rng=numpy.random.RandomState(shift), sequential=True)
+            self.assertEqual(fixed[-1][:len(seq[-1])], seq[-1])
+            self.assertEqual(fixed[6] <= 0.05, seq[6] <= 0.05)
+            if len(seq[-1]) < S:
+                self.assertAlmostEqual(seq[6], h / float(len(seq[-1])))
+            else:
+                self.assertEqual(fixed[6], seq[6])
+
+        # With identical groups every permutation is as extreme as the observed
+        # difference (p = 1), so the test stops after exactly h permutations,
+        # both in the batched kernel and in the loop used by custom test functions
+        seq = stat_tools.resampling(data1, data1, S=S, sequential=True)
+        self.assertEqual(len(seq[-1]), h)
+        self.assertEqual(seq[6], 1.0)
+        looped = stat_tools.resampling(data1, data1, S=S, sequential=True, testFunc=lambda A,B: numpy.mean(B) - numpy.mean(A))
+        self.assertEqual(len(looped[-1]), h)
+
+#
+
+    def test_result_checkpoint(self):
+        parameters = {"method": "test", "samples": 100}
+        checkpoint = transit_tools.ResultCheckpoint(output, parameters)
+        checkpoint.add(0, ["Rv0001", numpy.int64(5), numpy.float64(0.25), numpy.bool_(True)])
+        checkpoint.add(1, ["Rv0002", 3, float("nan"), False])
+        checkpoint.close(remove=False)
+        # Simulate a crash while the third row was being written
+        with open(output + ".checkpoint", "a") as f:
+            f.write('[2, ["Rv00')
+
+        with self.assertRaises(ValueError):
+            transit_tools.ResultCheckpoint(output, {"method": "test", "samples": 1000}, resume=True)
+
+        checkpoint = transit_tools.ResultCheckpoint(output, parameters, resume=True)
+        self.assertEqual(len(checkpoint), 2)
+        self.assertEqual(checkpoint[0], ["Rv0001", 5, 0.25, True])
+        self.assertTrue(numpy.isnan(checkpoint[1][2]))
+        self.assertFalse(2 in checkpoint)
+        checkpoint.add(2, ["Rv0003", 1, 1.0, False])
+        checkpoint.close(remove=False)
+        self.assertEqual(len(transit_tools.ResultCheckpoint(output, parameters, resume=True)), 3)
+
+        # Without resume, earlier rows are discarded
+        checkpoint = transit_tools.ResultCheckpoint(output, parameters)
+        self.assertEqual(len(checkpoint), 0)
+        checkpoint.close()
+        self.assertFalse(os.path.exists(output + ".checkpoint"))
+        self.assertFalse(os.path.exists(output + ".manifest"))
+
+    def test_result_checkpoint_interrupted_resume(self):
+        parameters = {"method": "test"}
+        checkpoint = transit_tools.ResultCheckpoint(output, parameters)
+        for i in range(3):
+            checkpoint.add(i, ["Rv%04d" % i, i])
+        checkpoint.close(remove=False)
+        # Last line truncated by a crash
+        with open(output + ".checkpoint", "a") as f:
+            f.write('[3, ["Rv0')
+        # A resume that is killed while dropping the partial line keeps the saved rows
+        with mock.patch("os.replace", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                transit_tools.ResultCheckpoint(output, parameters, resume=True)
+        checkpoint = transit_tools.ResultCheckpoint(output, parameters, resume=True)
+        self.assertEqual(len(checkpoint), 3)
+        self.assertFalse(os.path.exists(output + ".checkpoint.tmp"))
+        checkpoint.add(3, ["Rv0003", 3])
+        checkpoint.close(remove=False)
+        self.assertEqual(len(open(output + ".checkpoint").readlines()), 4)
+        transit_tools.ResultCheckpoint(output, parameters).close()
+
     def test_cleanargs_negative_arguments(self):
         TEST_RAWARGS = ["test", "-p", "-10"]
         args, kwargs = transit_tools.cleanargs(TEST_RAWARGS)
@@ -12,6 +12,14 @@ combined_wig = basedir + "/../src/pytransit/data/cholesterol_glycerol_combined.d
 samples_metadata = basedir + "/../src/pytransit/data/samples_metadata_cg.txt"
 samples_metadata_covariates = basedir + "/../src/pytransit/data/samples_metadata_cg_covar.txt"
 samples_metadata_interactions = basedir + "/../src/pytransit/data/samples_metadata_cg_interactions.txt"
+# Per-gene ZINB results on the bundled data: R output (pscl/MASS, written by make_zinb_R_pvals.py)
+# and a regression snapshot of the native engine
+zinb_R_pvals = basedir + "/data/zinb_R_pvals.txt"
+zinb_native_pvals = basedir + "/data/zinb_native_pvals.txt"
+zinb_models = [("plain", []), ("covariates", ["--covars", "batch", "--condition", "NewConditionCol"]),
+        ("interactions", ["--covars", "batch", "--interactions", "atm"])]
+zinb_models_metadata = {"plain": samples_metadata, "covariates": samples_metadata_covariates,
+        "interactions": samples_metadata_interactions}
 
 exp_rep1 = basedir + "/../src/pytransit/data/cholesterol_H37Rv_rep1.wig"
 exp_rep2 = basedir + "/../src/pytransit/data/cholesterol_H37Rv_rep2.wig"
@@ -58,7 +66,12 @@ class TransitTestCase(unittest.TestCase):
             print("Removing output file...")
             os.remove(output)
 
-        genes_path = output.rsplit(".", 1)[0] + "_genes" + output.rsplit(".", 1)[1]
+        for f in [output + ".checkpoint", output + ".manifest"]:
+            if os.path.exists(f):
+                print("Removing checkpoint file...")
+                os.remove(f)
+
+        genes_path = output.rsplit(".", 1)[0] + "_genes." + output.rsplit(".", 1)[1]
 
         if os.path.exists(genes_path):
             print("Removing genes file...")
@@ -96,3 +109,36 @@ def significant_pvals_qvals(fname, pcol=-2, qcol=-1):
 
     return (list(filter(lambda p: p < 0.05, pvals)), list(filter(lambda q: q < 0.05, qvals)))
 
+
+# ZINB p-values (at full precision) and statuses of each gene
+
+def zinb_pvals(args):
+    """Runs ZINB and returns {Rv: (pval, status)}."""
+    from pytransit.analysis.zinb import ZinbMethod
+    G = ZinbMethod.fromargs(args)
+    results = []
+    run_zinb = G.run_zinb
+    G.run_zinb = lambda *a: results.append(run_zinb(*a)) or results[0]
+    G.Run()
+    (pvals, qvals, status) = results[0]
+    return dict((rv, (float(pvals[rv]), status[rv])) for rv in pvals)
+
+def read_zinb_pvals(path):
+    """Reads a file of per-gene ZINB results: {model: {Rv: (pval, status)}}."""
+    results = {}
+    for line in open(path):
+        if line.startswith("#"): continue
+        (model, rv, pval, status) = line.rstrip("\n").split("\t")
+        results.setdefault(model, {})[rv] = (float(pval), status)
+    return results
+
+def write_zinb_pvals(path, header, engine_args=[]):
+    """Runs ZINB on the bundled data for each model and writes the per-gene results."""
+    out = open(path, "w")
+    out.write("#%s\n" % header)
+    out.write("#model\tRv\tpval\tstatus\n")
+    for (model, extra) in zinb_models:
+        results = zinb_pvals([combined_wig, zinb_models_metadata[model], small_annotation, output] + extra + engine_args)
+        for (rv, (pval, status)) in results.items():
+            out.write("%s\t%s\t%r\t%s\n" % (model, rv, pval, status))
+    out.close()